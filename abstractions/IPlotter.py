@@ -14,7 +14,10 @@ class IPlotter(ABC):
                   ) -> None: ...
 
     @abstractmethod
-    def highlight_intersection_points(self, show_uncertainties: bool = False) -> None: ...
+    def add_lines(self, segments: ArrayLike, line_style: Optional[Dict] = None) -> None: ...
+
+    @abstractmethod
+    def highlight_intersection_points(self, show_uncertainties: bool = False, density: Optional[bool] = None) -> None: ...
 
     @abstractmethod
     def highlight_source(self, show_uncertainty: bool = False) -> None: ...
@@ -0,0 +1,98 @@
+"""
+Runs many datasets through the PET pipeline in a process pool with a non-interactive matplotlib backend.
+
+The manifest is a JSON file with a list of datasets, e.g.:
+{
+  "datasets": [
+    {"filename": "double_source_2_Weaker", "lab_data": "double_source_2", "thetas": "thetas_weaker", "S_thetas": "S_thetas_weaker", "k_epsilon": 0.4},
+    {"filename": "my_run", "thetas": [[180, 14.1], [160, -0.17]], "S_thetas": [[0, 0.16], [0, 0.13]], "scale": 3}
+  ]
+}
+thetas/S_thetas are either names of lists in the lab_data module, or the lists themselves.
+Instead of them, "events" can point to an event file (csv, npy or bin) read with EventLoader.
+Any other keyword of main.run (output_dir, scale, k_epsilon, save_plot, save_source, save_intersection_points, estimator, output_format, capture, cache_dir, uncertainty, sinogram) can be set per dataset.
+
+Usage:
+    python -m PET_radioactive_source_localization.batch lab_data/manifest.json [--summary processed_data/batch_summary.json] [--workers 4]
+"""
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional
+import argparse
+import importlib
+import json
+import os
+import sys
+import time
+import traceback
+
+RUN_OPTIONS = ("output_dir", "scale", "k_epsilon", "save_plot", "save_source", "save_intersection_points", "estimator", "output_format", "capture", "cache_dir", "uncertainty", "sinogram")
+
+def _init_worker() -> None:
+    """Select a non-interactive backend before anything imports matplotlib.pyplot in the worker, and keep DEBUG data dumps out of the logs"""
+    import matplotlib
+    from loguru import logger
+    matplotlib.use("Agg")
+    logger.remove()
+    logger.add(sys.stderr, level="INFO")
+
+def _resolve(dataset: Dict[str, Any], key: str) -> Optional[List[Any]]:
+    value = dataset.get(key)
+    if isinstance(value, str):
+        if "lab_data" not in dataset:
+            raise ValueError(f'{key} refers to "{value}", but the dataset has no lab_data module')
+        module = importlib.import_module(f'PET_radioactive_source_localization.lab_data.{dataset["lab_data"]}')
+        value = getattr(module, value)
+    return None if value is None else [tuple(pair) for pair in value]
+
+def run_dataset(dataset: Dict[str, Any]) -> Dict[str, Any]:
+    """Run one manifest entry and describe the outcome, never raising"""
+    start = time.perf_counter()
+    result: Dict[str, Any] = {"filename": dataset.get("filename")}
+    try:
+        import matplotlib.pyplot as plt
+        from PET_radioactive_source_localization.main import run
+        from PET_radioactive_source_localization.implementations import DataHolder, EventLoader
+        if not dataset.get("filename"):
+            raise ValueError(f'dataset has no filename: {dataset}')
+        if "events" in dataset:
+            events = EventLoader(dataset["events"]).fill_dataholder(DataHolder())
+            dataset = {**dataset, "thetas": events.thetas, "S_thetas": events.S_thetas}
+        thetas = _resolve(dataset, "thetas")
+        if not thetas:
+            raise ValueError(f'dataset {dataset["filename"]} has no thetas')
+        options = {key: dataset[key] for key in RUN_OPTIONS if key in dataset}
+        source = run(thetas, dataset["filename"], S_thetas=_resolve(dataset, "S_thetas"), show_plot=False, **options)
+        plt.close("all")
+        result.update({"status": "ok", "source": None if source is None else [float(value) for value in source]})
+    except Exception as e:
+        result.update({"status": "failed", "error": f'{type(e).__name__}: {e}', "traceback": traceback.format_exc()})
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+def run_batch(manifest_path: str, summary_path: Optional[str] = None, n_workers: Optional[int] = None) -> List[Dict[str, Any]]:
+    """Run every dataset of the manifest on all cores and write per-dataset results and failures to summary_path"""
+    with open(manifest_path) as f:
+        datasets = json.load(f)["datasets"]
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker) as executor:
+        results = list(executor.map(run_dataset, datasets))
+    if summary_path:
+        os.makedirs(os.path.dirname(os.path.abspath(summary_path)), exist_ok=True)
+        summary = {"n_datasets": len(results), "n_failed": sum(result["status"] == "failed" for result in results), "results": results}
+        with open(summary_path, "w") as f:
+            json.dump(summary, f, indent=2)
+    return results
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("manifest")
+    parser.add_argument("--summary", default=os.path.join("processed_data", "batch_summary.json"))
+    parser.add_argument("--workers", type=int, default=None, help="number of processes, all cores by default")
+    args = parser.parse_args(argv)
+
+    results = run_batch(args.manifest, summary_path=args.summary, n_workers=args.workers)
+    for result in results:
+        print(f'{result["filename"]}: {result["status"]} ({result["seconds"]:.2f}s) {result.get("source") or result.get("error")}')
+    return 1 if any(result["status"] == "failed" for result in results) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
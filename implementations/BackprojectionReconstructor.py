@@ -0,0 +1,121 @@
+from PET_radioactive_source_localization.implementations.DataHolder import DataHolder
+from concurrent.futures import ProcessPoolExecutor
+from numpy.typing import ArrayLike
+from typing import List, Tuple, Optional
+import numpy as np
+
+def _lor_samples(points: np.ndarray, radius: float, n_bins: int, n_samples: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Sample every line of response evenly along its chord through the circle of given radius.
+    Returns (N, n_samples) flat pixel indices (-1 outside of the grid) and (N,) length of a chord covered by one sample
+    """
+    p1, p2 = points[:, 0], points[:, 1]
+    d = p2-p1
+    # |p1 + t*d|^2 = radius^2
+    a = np.sum(d*d, axis=1)
+    b = 2*np.sum(p1*d, axis=1)
+    c = np.sum(p1*p1, axis=1) - radius**2
+    discriminant = np.sqrt(np.clip(b**2-4*a*c, 0, None))
+    t0 = (-b-discriminant)/(2*a)
+    t1 = (-b+discriminant)/(2*a)
+    t = t0[:, None] + (t1-t0)[:, None]*(np.arange(n_samples)+0.5)/n_samples
+    x = p1[:, 0:1] + t*d[:, 0:1]
+    y = p1[:, 1:2] + t*d[:, 1:2]
+    pixel = 2*radius/n_bins
+    ix = np.floor((x+radius)/pixel).astype(np.int64)
+    iy = np.floor((y+radius)/pixel).astype(np.int64)
+    inside = (ix >= 0) & (ix < n_bins) & (iy >= 0) & (iy < n_bins)
+    flat = np.where(inside, iy*n_bins+ix, -1)
+    step = (t1-t0)*np.sqrt(a)/n_samples
+    return flat, step
+
+def _backproject_chunk(points: np.ndarray, radius: float, n_bins: int, n_samples: int, image: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Accumulate lines of response into a flat n_bins*n_bins image.
+    Without image, every line adds its intersection length to the pixels it crosses (plain backprojection).
+    With image, the MLEM ratio 1/(forward projection of the line through image) is backprojected instead
+    """
+    flat, step = _lor_samples(points, radius, n_bins, n_samples)
+    valid = flat >= 0
+    weights = np.broadcast_to(step[:, None], flat.shape)
+    if image is not None:
+        forward = np.sum(np.where(valid, image[np.clip(flat, 0, None)], 0)*weights, axis=1)
+        ratio = np.divide(1, forward, out=np.zeros_like(forward), where=forward > 0)
+        weights = weights*ratio[:, None]
+    return np.bincount(flat[valid], weights=weights[valid], minlength=n_bins*n_bins)
+
+class BackprojectionReconstructor:
+    """
+    Reconstructs an activity image instead of a point estimate. Every line of response from dataholder.points is
+    rasterized onto an n_bins x n_bins grid covering the circle of radius R2, optionally refined with MLEM iterations,
+    and peaks are read off the image.
+    Lines are processed in chunks of chunk_size (in n_workers processes if n_workers > 1), so memory is bounded by
+    the grid and the chunk size rather than by the number of events.
+    MLEM assumes uniform sensitivity of all pixels inside R2, the total activity of the image is kept constant between iterations
+    """
+    def __init__(self, dataholder: DataHolder, n_bins: int = 200, samples_per_pixel: float = 2, chunk_size: int = 10_000, n_workers: int = 1) -> None:
+        self.dataholder = dataholder
+        self.n_bins = n_bins
+        self.radius = float(dataholder.R2)
+        self.n_samples = int(np.ceil(n_bins*samples_per_pixel))
+        self.chunk_size = chunk_size
+        self.n_workers = n_workers
+        self.image = np.zeros((n_bins, n_bins))
+
+    @property
+    def extent(self) -> Tuple[float, float, float, float]:
+        """(x_min, x_max, y_min, y_max) of the grid, in the format of plt.imshow(extent=...)"""
+        return (-self.radius, self.radius, -self.radius, self.radius)
+
+    @property
+    def pixel_centers(self) -> np.ndarray:
+        pixel = 2*self.radius/self.n_bins
+        return -self.radius + pixel*(np.arange(self.n_bins)+0.5)
+
+    def add_lines(self, points: ArrayLike) -> np.ndarray:
+        """Backproject an (N, 2, 2) chunk of point pairs into the running image and return it"""
+        self.image += self.backproject(points)
+        return self.image
+
+    def backproject(self, points: ArrayLike, image: Optional[np.ndarray] = None) -> np.ndarray:
+        """Backproject (N, 2, 2) point pairs onto a new (n_bins, n_bins) image, see _backproject_chunk"""
+        points = np.asarray(points, dtype=float).reshape(-1, 2, 2)
+        flat_image = None if image is None else image.ravel()
+        chunks = [points[start:start+self.chunk_size] for start in range(0, len(points), self.chunk_size)]
+        args = [(chunk, self.radius, self.n_bins, self.n_samples, flat_image) for chunk in chunks]
+        result = np.zeros(self.n_bins*self.n_bins)
+        if self.n_workers > 1 and len(chunks) > 1:
+            with ProcessPoolExecutor(max_workers=self.n_workers) as executor:
+                for partial in executor.map(_backproject_chunk, *zip(*args)):
+                    result += partial
+        else:
+            for arg in args:
+                result += _backproject_chunk(*arg)
+        return result.reshape(self.n_bins, self.n_bins)
+
+    def reconstruct(self, n_iterations: int = 0) -> np.ndarray:
+        """Backproject all dataholder.points and refine the image with n_iterations of MLEM"""
+        if len(self.dataholder.points) == 0:
+            raise ValueError(f'can\'t reconstruct image, because points is empty: {self.dataholder.points}')
+        points = np.asarray(self.dataholder.points, dtype=float).reshape(-1, 2, 2)
+        image = self.backproject(points)
+        x = self.pixel_centers
+        in_fov = (x[None, :]**2 + x[:, None]**2) <= self.radius**2
+        image = np.where(in_fov, image, 0)
+        total = image.sum()
+        for _ in range(n_iterations):
+            image = image*self.backproject(points, image=image)
+            image *= total/image.sum()
+        self.image = image
+        self.dataholder.image = image
+        return image
+
+    def find_peaks(self, n_peaks: int = 1, min_distance: int = 3) -> List[Tuple[float, float]]:
+        """(x, y) of the n_peaks highest local maxima of the image, at least min_distance pixels apart"""
+        window = 2*min_distance+1
+        padded = np.pad(self.image, min_distance, constant_values=-np.inf)
+        local_max = np.lib.stride_tricks.sliding_window_view(padded, (window, window)).max(axis=(2, 3))
+        iy, ix = np.nonzero((self.image == local_max) & (self.image > 0))
+        order = np.argsort(self.image[iy, ix])[::-1][:n_peaks]
+        x = self.pixel_centers
+        return [(float(x[ix[i]]), float(x[iy[i]])) for i in order]
@@ -0,0 +1,73 @@
+from PET_radioactive_source_localization.implementations.DataHolder import DataHolder
+from typing import Tuple, Optional, Sequence
+import numpy as np
+
+class CoincidenceSimulator:
+    """
+    Monte Carlo generator of coincidences in the geometry of a dataholder (R1, R2, U_thetas, u_R1, u_R2).
+    Every event picks a source with probability proportional to its activity and emits two back-to-back gammas
+    in a random direction. The first one hits the detector circle R1, the second one the circle R2, each at a radius
+    smeared by u_R1/u_R2, and the angles of both hits are smeared by angular_smearing degrees.
+    A background_fraction of events are random coincidences with uniformly distributed angles.
+    Everything is vectorized and seeded, events are generated in chunks of chunk_size to bound temporary memory
+    """
+    def __init__(self, dataholder: DataHolder, sources: Sequence[Tuple[float, float]], activities: Optional[Sequence[float]] = None,
+                 background_fraction: float = 0.0, angular_smearing: Optional[float] = None, seed: Optional[int] = None, chunk_size: int = 1_000_000) -> None:
+        self.dataholder = dataholder
+        self.sources = np.asarray(sources, dtype=float).reshape(-1, 2)
+        if np.any(np.hypot(self.sources[:, 0], self.sources[:, 1]) >= min(dataholder.R1, dataholder.R2)):
+            raise ValueError(f'sources must lie inside both detector circles: {self.sources}')
+        activities = np.ones(len(self.sources)) if activities is None else np.asarray(activities, dtype=float)
+        if len(activities) != len(self.sources) or np.any(activities < 0) or activities.sum() == 0:
+            raise ValueError(f'invalid activities {activities} for {len(self.sources)} sources')
+        if not 0 <= background_fraction <= 1:
+            raise ValueError(f'background fraction must be within [0, 1]: {background_fraction}')
+        self.probabilities = activities/activities.sum()
+        self.background_fraction = background_fraction
+        self.angular_smearing = dataholder.U_thetas if angular_smearing is None else angular_smearing
+        self.chunk_size = chunk_size
+        self.rng = np.random.default_rng(seed)
+
+    def simulate(self, n_events: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Returns:
+            thetas (N, 2) in degrees, S_thetas (N, 2) equal to the angular smearing and labels (N,)
+            with the index of the emitting source, or -1 for background events.
+        """
+        thetas = np.empty((n_events, 2))
+        labels = np.empty(n_events, dtype=np.int64)
+        for start in range(0, n_events, self.chunk_size):
+            stop = min(start+self.chunk_size, n_events)
+            thetas[start:stop], labels[start:stop] = self._simulate_chunk(stop-start)
+        S_thetas = np.full((n_events, 2), self.angular_smearing, dtype=float)
+        return thetas, S_thetas, labels
+
+    def fill_dataholder(self, n_events: int) -> DataHolder:
+        """Simulate n_events and put them into dataholder.thetas and S_thetas in the format of lab_data"""
+        thetas, S_thetas, _ = self.simulate(n_events)
+        self.dataholder.thetas = list(zip(*thetas.T.tolist()))
+        self.dataholder.S_thetas = list(zip(*S_thetas.T.tolist()))
+        return self.dataholder
+
+    def _simulate_chunk(self, n_events: int) -> Tuple[np.ndarray, np.ndarray]:
+        labels = self.rng.choice(len(self.sources), size=n_events, p=self.probabilities)
+        sources = self.sources[labels]
+        phi = self.rng.uniform(0, 2*np.pi, n_events)
+        directions = np.column_stack((np.cos(phi), np.sin(phi)))
+        r1 = self.dataholder.R1 + self.rng.normal(0, self.dataholder.u_R1, n_events)
+        r2 = self.dataholder.R2 + self.rng.normal(0, self.dataholder.u_R2, n_events)
+        hit1 = self._hit_circle(sources, directions, r1)
+        hit2 = self._hit_circle(sources, -directions, r2)
+        thetas = np.column_stack((np.degrees(np.arctan2(hit1[:, 1], hit1[:, 0])), np.degrees(np.arctan2(hit2[:, 1], hit2[:, 0]))))
+        thetas += self.rng.normal(0, self.angular_smearing, thetas.shape)
+
+        background = self.rng.random(n_events) < self.background_fraction
+        thetas[background] = self.rng.uniform(-180, 180, (int(background.sum()), 2))
+        labels[background] = -1
+        return thetas, labels
+
+    def _hit_circle(self, origins: np.ndarray, directions: np.ndarray, radii: np.ndarray) -> np.ndarray:
+        """Point where a ray from origin (inside the circle) along a unit direction leaves a circle of given radius"""
+        projection = np.sum(origins*directions, axis=1)
+        t = -projection + np.sqrt(projection**2 - np.sum(origins**2, axis=1) + radii**2)
+        return origins + t[:, None]*directions
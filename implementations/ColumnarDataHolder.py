@@ -0,0 +1,151 @@
+from PET_radioactive_source_localization.implementations.DataHolder import DataHolder
+from numpy.typing import ArrayLike
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+import numpy as np
+
+class Column:
+    """
+    Growable contiguous float64 buffer of items of a fixed shape, e.g. (2,) for (x, y) or (2, 2) for a pair of points.
+    Reads like the list of tuples DataHolder keeps (len, iteration, indexing, slicing, ==), but items are only
+    converted to tuples when they are read one by one. np.asarray(column) is a read-only view of the buffer without copying.
+    Appending grows the capacity geometrically, so building a column item by item stays amortized O(1)
+    """
+    def __init__(self, item_shape: Tuple[int, ...], values: Optional[ArrayLike] = None, capacity: int = 0) -> None:
+        self.item_shape = item_shape
+        self._data = np.empty((capacity, *item_shape))
+        self._size = 0
+        self._owned = True # False while _data is an array given by the caller, which must not be written to
+        if values is not None:
+            self.assign(values)
+
+    @property
+    def array(self) -> np.ndarray:
+        view = self._data[:self._size]
+        view.flags.writeable = False
+        return view
+
+    @property
+    def capacity(self) -> int:
+        return len(self._data)
+
+    def assign(self, values: ArrayLike) -> None:
+        """Replace the content, keeping values without a copy if it already is a contiguous float64 array"""
+        arr = np.asarray(values, dtype=float)
+        arr = arr.reshape(-1, *self.item_shape) if arr.size else np.empty((0, *self.item_shape))
+        self._data = np.ascontiguousarray(arr)
+        self._size = len(arr)
+        self._owned = not isinstance(values, (np.ndarray, Column))
+
+    def reserve(self, capacity: int) -> None:
+        if capacity > self.capacity or not self._owned:
+            data = np.empty((max(capacity, self._size), *self.item_shape))
+            data[:self._size] = self._data[:self._size]
+            self._data = data
+            self._owned = True
+
+    def append(self, item: ArrayLike) -> None:
+        if self._size == self.capacity or not self._owned:
+            self.reserve(max(2*self.capacity, 16))
+        self._data[self._size] = item
+        self._size += 1
+
+    def extend(self, items: Any) -> None:
+        items = np.asarray(items if isinstance(items, (np.ndarray, Column, list, tuple)) else list(items), dtype=float)
+        if items.size == 0:
+            return
+        items = items.reshape(-1, *self.item_shape)
+        if self._size + len(items) > self.capacity or not self._owned:
+            self.reserve(max(2*self.capacity, self._size + len(items)))
+        self._data[self._size:self._size+len(items)] = items
+        self._size += len(items)
+
+    def clear(self) -> None:
+        self._size = 0
+
+    def tolist(self) -> List[Any]:
+        """Items as (nested) tuples, like the lists of a DataHolder"""
+        return [self._to_item(item) for item in self.array.tolist()]
+
+    def _to_item(self, item: Any) -> Any:
+        if isinstance(item, list):
+            return tuple(self._to_item(value) for value in item)
+        return item
+
+    def __array__(self, dtype: Any = None, copy: Optional[bool] = None) -> np.ndarray:
+        if copy:
+            return np.array(self.array, dtype=dtype)
+        return self.array if dtype is None else self.array.astype(dtype, copy=False)
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __bool__(self) -> bool:
+        return self._size > 0
+
+    def __iter__(self) -> Iterator[Any]:
+        return iter(self.tolist())
+
+    def __getitem__(self, index: Any) -> Any:
+        if isinstance(index, slice):
+            return [self._to_item(item) for item in self.array[index].tolist()]
+        if not -self._size <= index < self._size:
+            raise IndexError(f'column index out of range: {index}')
+        return self._to_item(self.array[index].tolist())
+
+    def __eq__(self, other: object) -> bool:
+        if isinstance(other, Column):
+            return self.item_shape == other.item_shape and np.array_equal(self.array, other.array)
+        if isinstance(other, (list, tuple)):
+            return self.tolist() == list(other)
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return repr(self.tolist())
+
+def _column_property(name: str, item_shape: Tuple[int, ...], optional: bool) -> property:
+    """Property storing an attribute of DataHolder in a Column. Assigning a list or an array replaces its content"""
+    def get(self: "ColumnarDataHolder") -> Optional[Column]:
+        return self.__dict__[f'_{name}']
+
+    def set(self: "ColumnarDataHolder", value: Any) -> None:
+        if value is None and optional:
+            self.__dict__[f'_{name}'] = None
+        elif isinstance(value, Column):
+            self.__dict__[f'_{name}'] = value
+        else:
+            self.__dict__[f'_{name}'] = Column(item_shape, value)
+    return property(get, set)
+
+class ColumnarDataHolder(DataHolder):
+    """
+    DataHolder keeping every per-line and per-pair quantity as a contiguous float64 Column instead of a list of tuples:
+    (N, 2) thetas, line parameters and intersection points, (N, 2, 2) point pairs and (N,) all_x/all_y.
+    Columns read like the lists of DataHolder, so LineCalculator, Plotter and PET.save work unchanged,
+    while VectorizedLineCalculator stores its arrays into them directly and reads them back without copying
+    """
+    columns: Dict[str, Tuple[Tuple[int, ...], bool]] = {
+        "thetas": ((2,), False),
+        "S_thetas": ((2,), True),
+        "u_thetas": ((2,), True),
+        "points": ((2, 2), False),
+        "u_points": ((2, 2), False),
+        "all_lines_params": ((2,), False),
+        "u_all_lines_params": ((2,), False),
+        "line_weights": ((), False),
+        "intersection_points": ((2,), False),
+        "u_intersection_points": ((2,), False),
+        "sources": ((2,), False),
+        "u_sources": ((2,), False),
+        "all_x": ((), False),
+        "all_y": ((), False),
+    }
+
+    def reserve(self, n_lines: int, n_intersection_points: int = 0) -> None:
+        """Preallocate columns for n_lines lines and n_intersection_points intersection points"""
+        for name in ("points", "u_points", "all_lines_params", "u_all_lines_params"):
+            getattr(self, name).reserve(n_lines)
+        for name in ("intersection_points", "u_intersection_points"):
+            getattr(self, name).reserve(n_intersection_points)
+
+for _name, (_item_shape, _optional) in ColumnarDataHolder.columns.items():
+    setattr(ColumnarDataHolder, _name, _column_property(_name, _item_shape, _optional))
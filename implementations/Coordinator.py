@@ -1,71 +1,72 @@
 from PET_radioactive_source_localization.implementations.DataHolder import DataHolder
+from PET_radioactive_source_localization.implementations.LeastSquaresEstimator import LeastSquaresEstimator
+from PET_radioactive_source_localization.implementations.ResultWriter import ResultWriter
+from PET_radioactive_source_localization.implementations.RunMetrics import RunMetrics
+from PET_radioactive_source_localization.implementations.ResultCache import ResultCache
+from PET_radioactive_source_localization.implementations.MonteCarloUncertainty import MonteCarloUncertainty
+from PET_radioactive_source_localization.implementations.ModeSeeker import ModeSeeker
+from PET_radioactive_source_localization.implementations.ShardedIntersector import ShardedIntersector
+from PET_radioactive_source_localization.implementations.SinogramBinner import SinogramBinner
+from PET_radioactive_source_localization.implementations.VectorizedLineCalculator import VectorizedLineCalculator
+from PET_radioactive_source_localization.implementations.LazyImport import LazyImport
 from PET_radioactive_source_localization.abstractions import *
-from typing import List, Tuple, Literal, Optional
-import json
+from typing import Any, Callable, Dict, List, Tuple, Literal, Optional
 import os
-import matplotlib.pyplot as plt
+import numpy as np
+plt = LazyImport("matplotlib.pyplot")
+logger = LazyImport("loguru", "logger")
 
 class PET:
-    def __init__(self, dataholder: DataHolder, calculator: ICalculator, plotter: IPlotter) -> None:
+    def __init__(self, dataholder: DataHolder, calculator: ICalculator, plotter: IPlotter, cache: Optional[ResultCache] = None) -> None:
         self.dataholder: DataHolder = dataholder
         self.calculator: ICalculator = calculator
         self.plotter: IPlotter = plotter
+        self.cache: Optional[ResultCache] = cache # reuses lines and intersections of earlier runs on the same inputs
+        self.metrics: Optional[RunMetrics] = None
     
     def save(self, what: Literal["source", "intersection_points", "both"], 
-         output_dir: str, filename_with_ext: str, save_u: bool = True) -> None:
-        """Save data to JSON file with optional uncertainties.
+         output_dir: str, filename_with_ext: str, save_u: bool = True, output_format: Literal["json", "npz", "npy"] = "json") -> None:
+        """Save data in a single pass with optional uncertainties.
         
         Args:
             what: Data to save ("source", "intersection_points", or "both")
             output_dir: Output directory path
-            filename_with_ext: Filename with extension (e.g., "data.json")
+            filename_with_ext: Filename with extension (e.g., "data.json"), the extension is replaced by the format's own
             save_u: Whether to save uncertainties
+            output_format: "json" for one JSON file, "npz"/"npy" for binary arrays with a JSON summary, see ResultWriter
         """
         # Create directory if it doesn't exist
         os.makedirs(output_dir, exist_ok=True)
         
-        filepath = os.path.join(output_dir, filename_with_ext)
+        filepath_stem = os.path.join(output_dir, os.path.splitext(filename_with_ext)[0])
         
-        # Clear file if it's the first write
-        if what == "both" or not os.path.exists(filepath):
-            open(filepath, 'w').close()
-        
-        if what == "both":
-            self.save_attr_to_json("source", filepath)
-            self.save_attr_to_json("intersection_points", filepath)
-            if save_u:
-                self.save_attr_to_json("u_source", filepath)
-                self.save_attr_to_json("u_intersection_points", filepath)
-        else:
-            self.save_attr_to_json(what, filepath)
-            if save_u:
-                self.save_attr_to_json(f"u_{what}", filepath)
+        attr_names = ["source", "intersection_points"] if what == "both" else [what]
+        if save_u:
+            attr_names += [f"u_{attr_name}" for attr_name in attr_names]
+        if output_format != "json" and self.dataholder.cov_source is not None and "source" in attr_names:
+            attr_names.append("cov_source")
+        # a single attribute is merged into the file, so source and intersection points can be saved by separate calls
+        ResultWriter(self.dataholder).write(filepath_stem, attr_names, output_format=output_format, merge=what != "both")
 
+    def line_segments(self, scale: float = 5) -> np.ndarray:
+        """(N, 2, 2) segments of all lines, spanning x from -scale to +scale around the middle of the points the line was found from"""
+        lines = np.asarray(self.dataholder.all_lines_params, dtype=float).reshape(-1, 2)
+        points = np.asarray(self.dataholder.points, dtype=float).reshape(-1, 2, 2)
+        x_center = points[:, :, 0].mean(axis=1)
+        x = np.column_stack((x_center-scale, x_center+scale))
+        y = lines[:, 0:1]*x + lines[:, 1:2]
+        return np.stack((x, y), axis=-1)
 
-    def save_attr_to_json(self, attr_name: str, filepath: str, round: bool = True) -> None:
-        """Internal method to save a single attribute to JSON file."""
-        if not hasattr(self.dataholder, attr_name):
-            raise AttributeError(f"DataHolder has no attribute '{attr_name}'")
-        
-        attr_value = getattr(self.dataholder, attr_name)
-        if attr_value is None:
-            raise ValueError(f"Cannot save None value for attribute '{attr_name}'")
-        
-        if round:
-            attr_value = self.calculator.round(attr_value) #type: ignore
-        
-        existing_data = {}
-        if os.path.exists(filepath) and os.path.getsize(filepath) > 0:
-            with open(filepath, 'r') as f:
-                existing_data = json.load(f)
-        
-        existing_data[attr_name] = attr_value
-        
-        with open(filepath, 'w') as f:
-            json.dump(existing_data, f, indent=2)
-                
-            
-    def run(self, filename: str, output_dir: str = r"processed_data", scale: float = 5, k_epsilon: float = 0.2, save_plot: bool = True, save_source: bool = True, save_intersection_points: bool = True) -> Optional[Tuple[float, float]]: 
+    def run(self, filename: str, output_dir: str = r"processed_data", scale: float = 5, k_epsilon: float = 0.2, save_plot: bool = True, save_source: bool = True, save_intersection_points: bool = True, estimator: Literal["intersections", "least_squares", "mode", "sharded"] = "intersections", show_plot: bool = True, output_format: Literal["json", "npz", "npy"] = "json", capture: Optional[Literal["cprofile", "tracemalloc"]] = None, uncertainty: Literal["linear", "monte_carlo"] = "linear", sinogram: bool = False) -> Optional[Tuple[float, float]]: 
+        """Run the whole pipeline and return the source. estimator="least_squares" finds the source with LeastSquaresEstimator and skips the O(n^2) intersection stage,
+        estimator="mode" takes the densest spot of intersection points found by ModeSeeker instead of their mean.
+        estimator="sharded" finds the same source as "intersections" with ShardedIntersector, which never keeps the intersection points.
+        show_plot=False never opens a GUI window, so runs with a non-interactive matplotlib backend don't block.
+        output_format selects how results are saved, see ResultWriter.
+        Timings and counts of the run are kept in self.metrics (RunMetrics), capture adds cProfile or tracemalloc measurements.
+        Intermediate data is only logged at DEBUG level.
+        uncertainty="monte_carlo" replaces the linearly propagated u_source by the spread of MonteCarloUncertainty replicates.
+        sinogram=True bins the lines with SinogramBinner, so the source is found from weighted bins instead of single events"""
         output_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", output_dir))
         if not os.path.isdir(output_dir):
             raise FileNotFoundError(f'output directory: {output_dir} is not a valid directory')
@@ -74,46 +75,128 @@ class PET:
             raise ValueError(f'can\'t find thetas in dataholder: {self.dataholder.thetas}')
         if len(self.dataholder.thetas) == 0:
             raise ValueError(f'No thetas provided: {self.dataholder.thetas}')
+        if uncertainty == "monte_carlo" and estimator == "mode":
+            raise ValueError(f'MonteCarloUncertainty has no replicate of the estimator: {estimator}')
+        if sinogram and estimator not in ("intersections", "least_squares"):
+            raise ValueError(f'estimator {estimator} doesn\'t weight sinogram bins, use "intersections" or "least_squares"')
+        if sinogram and estimator == "intersections" and not isinstance(self.calculator, VectorizedLineCalculator):
+            raise ValueError(f'weighted sinogram bins need VectorizedLineCalculator for intersections: {type(self.calculator).__name__}')
         
         
-        self.calculator.find_theta_uncertainities()
-        print(f'u_thetas: {self.dataholder.u_thetas}')
-        self.calculator.find_points(find_u=True)
-        print(f'\n\nprinting points: {self.dataholder.points} \n\n')
-        print(f'\n\nprinting points\'s uncertainties: {self.dataholder.u_points} \n\n')
-        self.calculator.find_line_params(find_u=True)
-        print(f'\n\nprinting params: {self.dataholder.all_lines_params} \n\n')
-        print(f'\n\nprinting params\'s uncertainties: {self.dataholder.u_all_lines_params} \n\n')
-        self.calculator.find_all_intersection_points(k_epsilon=k_epsilon, find_u=True)
-        print(f'\n\nprinting intersection points: {self.dataholder.intersection_points} \n\n')
-        print(f'\n\nprinting intersection points\'s uncertainties: {self.dataholder.u_intersection_points} \n\n')
-        self.calculator.find_source(find_u=True)
-        print(f'\n\nprinting source: {self.dataholder.source} \n\n')
-        print(f'\n\nprinting source uncertainty: {self.dataholder.u_source} \n\n')
-        
-        x_arr, y_arr = ([], [])
-        for (k, b), ((x1, y1), (x2, y2)) in zip(self.dataholder.all_lines_params, self.dataholder.points):
-            points = self.calculator.get_more_points_from_params(k, b, central_point=(x1/2+x2/2, y1/2+y2/2), scale = scale)[0]
-            x_arr = points[:, 0]
-            y_arr = points[:, 1]
-            self.plotter.add_points(x_arr, y_arr)
-        self.plotter.highlight_intersection_points(show_uncertainties=True)
-        self.plotter.highlight_source(show_uncertainty=True)
+        self.metrics = RunMetrics(filename=filename, capture=capture)
+        self.metrics.start()
+        try:
+            self._run_stages(filename, output_dir, scale, k_epsilon, save_plot, save_source, save_intersection_points, estimator, show_plot, output_format, uncertainty, sinogram)
+        finally:
+            self.metrics.stop()
+        return self.dataholder.source
 
-        if save_plot:
-            filepath = os.path.join(output_dir, "images", filename+".png")
-            if not os.path.exists(os.path.dirname(filepath)):
-                raise FileNotFoundError(f'directory of filepath: {filepath} does not exist')
-            plt.savefig(filepath)
-            self.plotter.finalize(save = True, filepath=filepath) #type: ignore
-        else: 
-            self.plotter.finalize() #type: ignore
+    def _cached_stage(self, name: str, key: str, outputs: List[str], compute: Callable[[], Optional[Dict[str, Any]]]) -> Dict[str, Any]:
+        """
+        Restore outputs of a stage from the cache, or compute and store them.
+        compute may return extra values that are no dataholder attributes, e.g. counts, they are cached too and returned
+        """
+        if self.cache is None:
+            return compute() or {}
+        with self.metrics.stage(f'cached_{name}'): #type: ignore
+            arrays = self.cache.get(key)
+            if arrays is not None:
+                self.cache.restore(self.dataholder, {attr_name: arr for attr_name, arr in arrays.items() if attr_name in outputs})
+        if arrays is None:
+            extras = compute() or {}
+            self.cache.put(key, {**self.cache.collect(self.dataholder, outputs), **extras})
+            return extras
+        logger.info(f'reused cached {name}')
+        return {extra_name: arr for extra_name, arr in arrays.items() if extra_name not in outputs}
 
-        if save_source and save_intersection_points:
-            self.save("both", output_dir=output_dir, filename_with_ext=filename+".json")
+    def _run_stages(self, filename: str, output_dir: str, scale: float, k_epsilon: float, save_plot: bool, save_source: bool, save_intersection_points: bool,
+                    estimator: Literal["intersections", "least_squares", "mode", "sharded"], show_plot: bool, output_format: Literal["json", "npz", "npy"],
+                    uncertainty: Literal["linear", "monte_carlo"] = "linear", sinogram: bool = False) -> None:
+        debug = logger.opt(lazy=True).debug
+        metrics = self.metrics
+        lines_key = self.cache.lines_key(self.dataholder, type(self.calculator).__name__, getattr(self.calculator, "geometry", None)) if self.cache else ""
+        def find_lines() -> None:
+            with metrics.stage("find_theta_uncertainities"):
+                self.calculator.find_theta_uncertainities()
+            with metrics.stage("find_points"):
+                self.calculator.find_points(find_u=True)
+            with metrics.stage("find_line_params"):
+                self.calculator.find_line_params(find_u=True)
+        self._cached_stage("lines", lines_key, ResultCache.line_outputs, find_lines)
+        event_weights = None
+        if sinogram and uncertainty == "monte_carlo" and estimator == "least_squares":
+            # replicates perturb single events, so they are weighted by the unbinned lines
+            event_weights = LeastSquaresEstimator(self.dataholder).find_line_weights()
+        if sinogram:
+            with metrics.stage("bin_sinogram"):
+                n_bins = SinogramBinner(self.dataholder).bin_lines(find_u=True)
+            logger.info(f'{filename}: {len(self.dataholder.thetas)} events binned into {n_bins} sinogram bins')
+            lines_key = self.cache.key("sinogram", lines=lines_key) if self.cache else ""
+        metrics.count_lines(self.dataholder)
+        debug("u_thetas: {}", lambda: self.dataholder.u_thetas)
+        debug("points: {}", lambda: self.dataholder.points)
+        debug("points's uncertainties: {}", lambda: self.dataholder.u_points)
+        debug("params: {}", lambda: self.dataholder.all_lines_params)
+        debug("params's uncertainties: {}", lambda: self.dataholder.u_all_lines_params)
+        if estimator == "least_squares":
+            def find_source() -> None:
+                with metrics.stage("find_source"):
+                    LeastSquaresEstimator(self.dataholder).find_source(find_u=True)
+            key = self.cache.key("least_squares", lines=lines_key) if self.cache else ""
+            self._cached_stage("least_squares", key, ResultCache.least_squares_outputs, find_source)
+            metrics.skip_pairs()
+        elif estimator == "sharded":
+            def find_sharded() -> Dict[str, Any]:
+                with metrics.stage("find_source"):
+                    intersector = ShardedIntersector(self.dataholder)
+                    intersector.find_source(k_epsilon=k_epsilon, find_u=True)
+                assert intersector.sums is not None
+                # the intersection points are never kept, so the count comes from the sums
+                return {"n_accepted_pairs": intersector.sums.n_accepted}
+            key = self.cache.key("sharded", lines=lines_key, k_epsilon=k_epsilon) if self.cache else ""
+            counts = self._cached_stage("sharded", key, ResultCache.least_squares_outputs, find_sharded)
+            metrics.count_pairs(self.dataholder, n_accepted=int(counts["n_accepted_pairs"]))
         else:
-            if save_source:
-                self.save("source", output_dir=output_dir, filename_with_ext=filename+".json")
-            if save_intersection_points:
-                self.save("intersection_points", output_dir=output_dir, filename_with_ext=filename+".json")
+            def find_intersections() -> None:
+                with metrics.stage("find_all_intersection_points"):
+                    self.calculator.find_all_intersection_points(k_epsilon=k_epsilon, find_u=True)
+                with metrics.stage("find_source"):
+                    self.calculator.find_source(find_u=True)
+            key = self.cache.key("intersections", lines=lines_key, k_epsilon=k_epsilon) if self.cache else ""
+            self._cached_stage("intersections", key, ResultCache.intersection_outputs, find_intersections)
+            metrics.count_pairs(self.dataholder)
+            if estimator == "mode":
+                with metrics.stage("find_mode"):
+                    ModeSeeker(self.dataholder).find_source(find_u=True)
+            debug("intersection points: {}", lambda: self.dataholder.intersection_points)
+            debug("intersection points's uncertainties: {}", lambda: self.dataholder.u_intersection_points)
+        if uncertainty == "monte_carlo":
+            with metrics.stage("monte_carlo_uncertainty"):
+                # sharded computes the mean of intersections, so its replicates are the ones of "intersections"
+                replicated = "intersections" if estimator == "sharded" else estimator
+                MonteCarloUncertainty(self.dataholder, estimator=replicated, k_epsilon=k_epsilon, weights=event_weights).find_uncertainty() #type: ignore
+        logger.info(f'{filename} source: {self.dataholder.source} +- {self.dataholder.u_source}')
+        
+        with metrics.stage("plotting"):
+            self.plotter.add_lines(self.line_segments(scale=scale))
+            self.plotter.highlight_intersection_points(show_uncertainties=True)
+            self.plotter.highlight_source(show_uncertainty=True)
+
+            if save_plot:
+                filepath = os.path.join(output_dir, "images", filename+".png")
+                if not os.path.exists(os.path.dirname(filepath)):
+                    raise FileNotFoundError(f'directory of filepath: {filepath} does not exist')
+                plt.savefig(filepath)
+                self.plotter.finalize(save = True, filepath=filepath, show=show_plot) #type: ignore
+            else: 
+                self.plotter.finalize(show=show_plot) #type: ignore
+
+        with metrics.stage("save"):
+            if save_source and save_intersection_points:
+                self.save("both", output_dir=output_dir, filename_with_ext=filename+".json", output_format=output_format)
+            else:
+                if save_source:
+                    self.save("source", output_dir=output_dir, filename_with_ext=filename+".json", output_format=output_format)
+                if save_intersection_points:
+                    self.save("intersection_points", output_dir=output_dir, filename_with_ext=filename+".json", output_format=output_format)
 
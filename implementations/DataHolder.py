@@ -1,5 +1,6 @@
 from dataclasses import dataclass, field
 from typing import List, Tuple, Optional
+import numpy as np
 
 @dataclass
 class DataHolder:
@@ -12,6 +13,7 @@ class DataHolder:
     """
     
     thetas: List[Tuple[float, float]] = field(default_factory=list)
+    detector_ids: Optional[List[Tuple[int, int]]] = None # events as pairs of detector IDs of a DetectorGeometry, instead of thetas
     S_thetas: Optional[List[Tuple[float, float]]] = None
     U_thetas: float = 0.5
     u_thetas: Optional[List[Tuple[float, float]]] = None
@@ -26,12 +28,20 @@ class DataHolder:
 
     all_lines_params: List[Tuple[float, float]] = field(default_factory=list)
     u_all_lines_params: List[Tuple[float, float]] = field(default_factory=list)
+    line_weights: List[float] = field(default_factory=list) # number of events every line stands for, e.g. after SinogramBinner. Empty means 1 for all lines
 
     intersection_points: List[Tuple[float, float]] = field(default_factory=list)
     u_intersection_points: List[Tuple[float, float]] = field(default_factory=list)
 
     source: Optional[Tuple[float, float]] = None
     u_source: Tuple[float, float] = field(default_factory=tuple)
+    cov_source: Optional[Tuple[Tuple[float, float], Tuple[float, float]]] = None # full covariance matrix, for estimators that provide it
+
+    sources: List[Tuple[float, float]] = field(default_factory=list) # one source per cluster of lines, when several sources are localized at once
+    u_sources: List[Tuple[float, float]] = field(default_factory=list)
+    line_labels: List[int] = field(default_factory=list) # index in sources of the source every line was assigned to
+
+    image: Optional[np.ndarray] = None # reconstructed activity image on a square grid covering the circle R2
 
     all_x: List[float]  = field(default_factory=list) # all x coordinates generated on some line for matplotlib.pyplot drawings. Not to confuse with points used to find lines parameters
     all_y: List[float] = field(default_factory=list)
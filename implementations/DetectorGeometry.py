@@ -0,0 +1,99 @@
+from PET_radioactive_source_localization.implementations.DataHolder import DataHolder
+from numpy.typing import ArrayLike
+from typing import List, Optional, Tuple
+import numpy as np
+
+class DetectorGeometry:
+    """
+    Lookup table of detectors by ID: (D, 2) cartesian positions, (D, 2, 2) covariance matrices of the positions
+    and (D, 2) derivatives of the positions by the detector angle in degrees, which turn a per-event angular
+    uncertainty into a position uncertainty. Events given as pairs of detector IDs are mapped to coordinates
+    by indexing these arrays, so no trigonometry is evaluated per event.
+    A geometry is either a set of rings (the two-ring R1/R2 layout of the lab), whose detectors sit at known angles,
+    or an arbitrary list of positions
+    """
+    def __init__(self, positions: ArrayLike, covariances: Optional[ArrayLike] = None, tangents: Optional[ArrayLike] = None) -> None:
+        self.positions = np.asarray(positions, dtype=float).reshape(-1, 2)
+        self.covariances = np.zeros((len(self.positions), 2, 2)) if covariances is None else np.asarray(covariances, dtype=float).reshape(-1, 2, 2)
+        self.tangents = np.zeros((len(self.positions), 2)) if tangents is None else np.asarray(tangents, dtype=float).reshape(-1, 2)
+        if not len(self.positions) == len(self.covariances) == len(self.tangents):
+            raise ValueError(f'positions, covariances and tangents describe different numbers of detectors: {len(self.positions)}, {len(self.covariances)}, {len(self.tangents)}')
+        self.rings: List[Tuple[np.ndarray, int]] = [] # sorted angles of every ring and the ID of its first detector
+
+    @property
+    def n_detectors(self) -> int:
+        return len(self.positions)
+
+    @classmethod
+    def from_rings(cls, radii: ArrayLike, angles: List[ArrayLike], u_radii: Optional[ArrayLike] = None, u_angle: float = 0.0) -> "DetectorGeometry":
+        """
+        Detectors on concentric rings, e.g. from_rings((R1, R2), (angles1, angles2), (u_R1, u_R2), U_thetas).
+        IDs go ring by ring, in increasing order of angle (degrees) within a ring. Covariances combine the radial
+        uncertainty of the ring with the systematic angular uncertainty u_angle (degrees) of every detector
+        """
+        radii = np.asarray(radii, dtype=float).reshape(-1)
+        u_radii = np.zeros(len(radii)) if u_radii is None else np.asarray(u_radii, dtype=float).reshape(-1)
+        if len(angles) != len(radii) or len(u_radii) != len(radii):
+            raise ValueError(f'need angles and a radial uncertainty for each of {len(radii)} rings: {len(angles)}, {len(u_radii)}')
+        positions, covariances, tangents, rings = [], [], [], []
+        n_detectors = 0
+        for r, u_r, ring_angles in zip(radii, u_radii, angles):
+            ring_angles = np.unique(np.asarray(ring_angles, dtype=float))
+            radians = np.deg2rad(ring_angles)
+            radial = np.column_stack((np.cos(radians), np.sin(radians)))
+            tangent = r*np.pi/180*np.column_stack((-np.sin(radians), np.cos(radians)))
+            positions.append(r*radial)
+            covariances.append(u_r**2*radial[:, :, None]*radial[:, None, :] + u_angle**2*tangent[:, :, None]*tangent[:, None, :])
+            tangents.append(tangent)
+            rings.append((ring_angles, n_detectors))
+            n_detectors += len(ring_angles)
+        geometry = cls(np.concatenate(positions), np.concatenate(covariances), np.concatenate(tangents))
+        geometry.rings = rings
+        return geometry
+
+    @classmethod
+    def from_dataholder(cls, dataholder: DataHolder) -> "DetectorGeometry":
+        """Two rings R1 and R2 with a detector at every distinct angle of dataholder.thetas, systematic angular uncertainty U_thetas"""
+        thetas = np.asarray(dataholder.thetas, dtype=float).reshape(-1, 2)
+        return cls.from_rings((dataholder.R1, dataholder.R2), [thetas[:, 0], thetas[:, 1]], (dataholder.u_R1, dataholder.u_R2), dataholder.U_thetas)
+
+    def ids_of(self, thetas: ArrayLike) -> np.ndarray:
+        """(N, 2) detector IDs of (N, 2) angle pairs, one angle per ring, found by binary search over the angles of every ring"""
+        if not self.rings:
+            raise ValueError(f'detectors of this geometry are not placed on rings, events must be given as detector IDs')
+        thetas = np.asarray(thetas, dtype=float).reshape(-1, len(self.rings))
+        ids = np.empty(thetas.shape, dtype=np.int64)
+        for ring, (ring_angles, first_id) in enumerate(self.rings):
+            indices = np.clip(np.searchsorted(ring_angles, thetas[:, ring]), 0, len(ring_angles)-1)
+            unknown = ~np.isclose(ring_angles[indices], thetas[:, ring], rtol=0, atol=1e-9)
+            if np.any(unknown):
+                raise ValueError(f'no detector of ring {ring} at angles: {np.unique(thetas[unknown, ring])}')
+            ids[:, ring] = first_id + indices
+        return ids
+
+    def coordinates(self, ids: ArrayLike) -> np.ndarray:
+        """(N, 2, 2) pairs of points ((x1, y1), (x2, y2)) of (N, 2) detector ID pairs"""
+        return self.positions[self._check(ids)]
+
+    def covariances_of(self, ids: ArrayLike, S_angles: Optional[ArrayLike] = None) -> np.ndarray:
+        """(N, 2, 2, 2) covariance matrices of both points of every event, adding per-event angular uncertainties S_angles (degrees) if given"""
+        ids = self._check(ids)
+        covariances = self.covariances[ids]
+        if S_angles is not None:
+            tangents = self.tangents[ids]*np.asarray(S_angles, dtype=float).reshape(ids.shape)[..., None]
+            covariances = covariances + tangents[..., :, None]*tangents[..., None, :]
+        return covariances
+
+    def u_coordinates(self, ids: ArrayLike, S_angles: Optional[ArrayLike] = None) -> np.ndarray:
+        """(N, 2, 2) uncertainties ((u_x1, u_y1), (u_x2, u_y2)) of coordinates, in the format of DataHolder.u_points"""
+        ids = self._check(ids)
+        variances = np.diagonal(self.covariances[ids], axis1=-2, axis2=-1)
+        if S_angles is not None:
+            variances = variances + (self.tangents[ids]*np.asarray(S_angles, dtype=float).reshape(ids.shape)[..., None])**2
+        return np.sqrt(variances)
+
+    def _check(self, ids: ArrayLike) -> np.ndarray:
+        ids = np.asarray(ids, dtype=np.int64).reshape(-1, 2)
+        if ids.size and (ids.min() < 0 or ids.max() >= self.n_detectors):
+            raise ValueError(f'detector IDs must be within [0, {self.n_detectors}): {ids[(ids < 0) | (ids >= self.n_detectors)]}')
+        return ids
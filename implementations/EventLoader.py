@@ -0,0 +1,129 @@
+from PET_radioactive_source_localization.implementations.DataHolder import DataHolder
+from PET_radioactive_source_localization.implementations.StreamingLocalizer import StreamingLocalizer
+from numpy.typing import ArrayLike
+from itertools import islice
+from typing import Iterator, Literal, Optional, Tuple
+import os
+import numpy as np
+
+event_dtype = np.dtype([("theta1", "<f8"), ("theta2", "<f8"), ("S_theta1", "<f8"), ("S_theta2", "<f8")])
+
+class EventLoader:
+    """
+    Reads coincidence events (theta1, theta2 and optionally S_theta1, S_theta2, in degrees) from files instead of lab_data modules.
+    Supported formats:
+        "csv": text with 2 or 4 comma separated columns, an optional header line and # comments. Read chunk by chunk.
+        "npy": (N, 2) or (N, 4) float array, memory-mapped.
+        "bin": raw little-endian records of event_dtype, memory-mapped.
+    chunks() yields fixed-size arrays, so files larger than RAM can be fed to StreamingLocalizer without building lists of tuples
+    """
+    extensions = {".csv": "csv", ".txt": "csv", ".npy": "npy", ".bin": "bin", ".dat": "bin"}
+
+    def __init__(self, path: str, input_format: Optional[Literal["csv", "npy", "bin"]] = None) -> None:
+        if not os.path.exists(path):
+            raise ValueError(f'event file does not exist: {path}')
+        if input_format is None:
+            extension = os.path.splitext(path)[1].lower()
+            if extension not in self.extensions:
+                raise ValueError(f'unsupported event file extension: {path}. Expected one of {list(self.extensions)}')
+            input_format = self.extensions[extension] #type: ignore
+        if input_format not in ("csv", "npy", "bin"):
+            raise ValueError(f'unsupported event file format: {input_format}')
+        self.path = path
+        self.input_format = input_format
+        self._n_events: Optional[int] = None
+
+    @property
+    def n_events(self) -> int:
+        if self._n_events is None:
+            if self.input_format == "csv":
+                self._n_events = sum(1 for _ in self._csv_rows())
+            else:
+                self._n_events = len(self._memmap())
+        return self._n_events
+
+    def chunks(self, chunk_size: int = 100_000) -> Iterator[Tuple[np.ndarray, Optional[np.ndarray]]]:
+        """Yield (thetas, S_thetas) chunks of at most chunk_size events, S_thetas is None for files with only two columns"""
+        if chunk_size < 1:
+            raise ValueError(f'chunk size must be positive: {chunk_size}')
+        if self.input_format == "csv":
+            rows = self._csv_rows()
+            while True:
+                lines = list(islice(rows, chunk_size))
+                if not lines:
+                    return
+                yield self._split(np.loadtxt(lines, delimiter=",", ndmin=2))
+        else:
+            table = self._memmap()
+            for start in range(0, len(table), chunk_size):
+                # copy only the current chunk out of the mapped file
+                yield self._split(np.array(table[start:start+chunk_size]))
+
+    def load(self) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+        """Whole file as (thetas, S_thetas) arrays"""
+        chunks = list(self.chunks())
+        if not chunks:
+            return np.empty((0, 2)), None
+        thetas = np.concatenate([thetas for thetas, _ in chunks])
+        S_thetas = None if chunks[0][1] is None else np.concatenate([S_thetas for _, S_thetas in chunks]) #type: ignore
+        return thetas, S_thetas
+
+    def fill_dataholder(self, dataholder: DataHolder) -> DataHolder:
+        """Put all events into dataholder.thetas and S_thetas in the format of lab_data, for the full pipeline of PET.run"""
+        thetas, S_thetas = self.load()
+        dataholder.thetas = list(zip(*thetas.T.tolist()))
+        if S_thetas is not None:
+            dataholder.S_thetas = list(zip(*S_thetas.T.tolist()))
+        return dataholder
+
+    def localize(self, dataholder: DataHolder, chunk_size: int = 100_000) -> Optional[Tuple[float, float]]:
+        """Find the source with StreamingLocalizer chunk by chunk, memory use doesn't grow with the size of the file"""
+        localizer = StreamingLocalizer(dataholder)
+        source = None
+        for thetas, S_thetas in self.chunks(chunk_size):
+            source = localizer.add_lines(thetas, S_thetas)
+        return source
+
+    @staticmethod
+    def write(path: str, thetas: ArrayLike, S_thetas: Optional[ArrayLike] = None) -> None:
+        """Write events in the format given by the extension of path, e.g. to convert a lab_data module or a simulation"""
+        thetas = np.asarray(thetas, dtype=float).reshape(-1, 2)
+        S_thetas = np.zeros_like(thetas) if S_thetas is None else np.asarray(S_thetas, dtype=float).reshape(-1, 2)
+        if S_thetas.shape != thetas.shape:
+            raise ValueError(f'shapes of thetas and S_thetas don\'t match: {thetas.shape}, {S_thetas.shape}')
+        file_format = EventLoader.extensions.get(os.path.splitext(path)[1].lower())
+        table = np.column_stack((thetas, S_thetas))
+        if file_format == "csv":
+            np.savetxt(path, table, delimiter=",", header=",".join(event_dtype.names), comments="") #type: ignore
+        elif file_format == "npy":
+            np.save(path, table)
+        elif file_format == "bin":
+            table.astype("<f8").tofile(path)
+        else:
+            raise ValueError(f'unsupported event file extension: {path}. Expected one of {list(EventLoader.extensions)}')
+
+    def _memmap(self) -> np.ndarray:
+        if self.input_format == "npy":
+            table = np.load(self.path, mmap_mode="r")
+            if table.ndim != 2 or table.shape[1] not in (2, 4):
+                raise ValueError(f'expected an (N, 2) or (N, 4) array in {self.path}, got shape {table.shape}')
+            return table
+        if os.path.getsize(self.path) % event_dtype.itemsize:
+            raise ValueError(f'size of {self.path} is not a multiple of the {event_dtype.itemsize} byte event record')
+        if os.path.getsize(self.path) == 0:
+            return np.empty((0, 4))
+        return np.memmap(self.path, dtype="<f8", mode="r").reshape(-1, 4)
+
+    def _csv_rows(self) -> Iterator[str]:
+        """Data lines of the csv file, without blank lines, comments and the header"""
+        with open(self.path) as f:
+            for line in f:
+                line = line.split("#", 1)[0].strip()
+                if not line or line[0].isalpha():
+                    continue
+                yield line
+
+    def _split(self, table: np.ndarray) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+        if table.shape[1] not in (2, 4):
+            raise ValueError(f'expected 2 or 4 columns in {self.path}, got {table.shape[1]}')
+        return table[:, :2], (table[:, 2:] if table.shape[1] == 4 else None)
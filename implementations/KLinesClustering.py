@@ -0,0 +1,117 @@
+from PET_radioactive_source_localization.implementations.DataHolder import DataHolder
+from PET_radioactive_source_localization.implementations.LeastSquaresEstimator import LeastSquaresEstimator
+from PET_radioactive_source_localization.implementations.LazyImport import LazyImport
+from typing import Tuple, Optional
+import numpy as np
+logger = LazyImport("loguru", "logger")
+
+class KLinesClustering:
+    """
+    Splits a mixed set of lines between n_sources sources with k-lines clustering, so weaker and stronger sources
+    don't have to be separated by hand.
+    Seeds are found RANSAC-style from the intersections of a fixed number of random line pairs, then every iteration
+    assigns each line to its closest source by perpendicular distance (O(n*K)) and refits every source with
+    LeastSquaresEstimator (O(n)). No iteration scans the O(n^2) set of pairwise intersections
+    """
+    def __init__(self, dataholder: DataHolder, n_sources: int = 2, n_init: int = 5, max_iter: int = 100,
+                 n_seed_pairs: int = 256, inlier_distance: float = 1.0, k_epsilon: float = 0.2, seed: Optional[int] = None, chunk_size: int = 4096) -> None:
+        if n_sources < 1:
+            raise ValueError(f'number of sources must be positive: {n_sources}')
+        self.dataholder = dataholder
+        self.estimator = LeastSquaresEstimator(dataholder)
+        self.n_sources = n_sources
+        self.n_init = n_init
+        self.max_iter = max_iter
+        self.n_seed_pairs = n_seed_pairs
+        self.inlier_distance = inlier_distance
+        self.k_epsilon = k_epsilon
+        self.chunk_size = chunk_size # lines scored against the seed candidates at once, bounds the (chunk_size, n_seed_pairs) temporaries
+        self.rng = np.random.default_rng(seed)
+
+    def distances(self, lines: np.ndarray, sources: np.ndarray) -> np.ndarray:
+        """(N, K) perpendicular distances from every (k, b) line to every source"""
+        k, b = lines[:, 0:1], lines[:, 1:2]
+        return np.abs(k*sources[:, 0] - sources[:, 1] + b)/np.sqrt(1+k**2)
+
+    def seed_sources(self, lines: np.ndarray) -> np.ndarray:
+        """
+        Pick n_sources starting points among intersections of random line pairs, each explaining the most lines not explained yet.
+        Lines are scored in chunks and only inlier counts per candidate are kept, so memory doesn't grow with the number of lines
+        """
+        i = self.rng.integers(0, len(lines), self.n_seed_pairs)
+        j = self.rng.integers(0, len(lines), self.n_seed_pairs)
+        (k_i, b_i), (k_j, b_j) = lines[i].T, lines[j].T
+        mask = np.abs(k_i-k_j) > self.k_epsilon
+        if not np.any(mask):
+            raise ValueError(f'no pair of sampled lines passes the k_epsilon={self.k_epsilon} test')
+        x = (b_j[mask]-b_i[mask])/(k_i[mask]-k_j[mask])
+        candidates = np.column_stack((x, k_i[mask]*x+b_i[mask]))
+
+        sources = np.empty((0, 2))
+        for _ in range(self.n_sources):
+            counts = np.zeros(len(candidates), dtype=np.int64)
+            for start in range(0, len(lines), self.chunk_size):
+                chunk = lines[start:start+self.chunk_size]
+                # lines within inlier_distance of a source picked before are explained already
+                unexplained = np.all(self.distances(chunk, sources) >= self.inlier_distance, axis=1)
+                counts += np.sum(self.distances(chunk[unexplained], candidates) < self.inlier_distance, axis=0)
+            sources = np.vstack((sources, candidates[np.argmax(counts)]))
+        return sources
+
+    def fit(self, lines: np.ndarray, u_lines: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Cluster (N, 2) lines of (k, b), weighted by their (N, 2) uncertainties if provided.
+
+        Returns:
+            labels (N,) with the source index of every line, sources (K, 2) and their covariance matrices (K, 2, 2).
+        """
+        lines = np.asarray(lines, dtype=float).reshape(-1, 2)
+        if u_lines is not None:
+            u_lines = np.asarray(u_lines, dtype=float).reshape(-1, 2)
+        if len(lines) < 2*self.n_sources:
+            raise ValueError(f'can\'t split {len(lines)} lines between {self.n_sources} sources, at least 2 lines per source are needed')
+
+        best: Optional[Tuple[float, np.ndarray, np.ndarray, np.ndarray]] = None
+        for _ in range(self.n_init):
+            labels, sources, covs = self._lloyd(lines, u_lines, self.seed_sources(lines))
+            cost = self._cost(lines, u_lines, labels, sources)
+            if best is None or cost < best[0]:
+                best = (cost, labels, sources, covs)
+        assert best is not None
+        return best[1], best[2], best[3]
+
+    def find_sources(self, find_u: bool = False) -> Tuple[Tuple[float, float], ...]:
+        """Cluster dataholder.all_lines_params and store a source (and uncertainty) per cluster and a label per line"""
+        if len(self.dataholder.all_lines_params) == 0:
+            raise ValueError(f'can\'t find sources, because all_lines_params is empty: {self.dataholder.all_lines_params}')
+        u_lines = self.dataholder.u_all_lines_params if len(self.dataholder.u_all_lines_params) > 0 else None
+        labels, sources, covs = self.fit(np.asarray(self.dataholder.all_lines_params, dtype=float), u_lines)
+        self.dataholder.line_labels = labels.tolist()
+        self.dataholder.sources = [tuple(source) for source in sources.tolist()]
+        if find_u:
+            self.dataholder.u_sources = [tuple(np.sqrt(np.diag(cov)).tolist()) for cov in covs]
+        return tuple(self.dataholder.sources)
+
+    def _lloyd(self, lines: np.ndarray, u_lines: Optional[np.ndarray], sources: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        labels = np.full(len(lines), -1)
+        covs = np.full((self.n_sources, 2, 2), np.nan)
+        for _ in range(self.max_iter):
+            new_labels = np.argmin(self.distances(lines, sources), axis=1)
+            if np.array_equal(new_labels, labels):
+                break
+            labels = new_labels
+            for cluster in range(self.n_sources):
+                members = labels == cluster
+                try:
+                    source, cov = self.estimator.solve(self.estimator.line_statistics(lines[members], None if u_lines is None else u_lines[members]),
+                                                       weighted=u_lines is not None)
+                except ValueError as e:
+                    logger.debug(f'keeping previous position of source {cluster}: {e}')
+                    continue
+                sources[cluster], covs[cluster] = source, cov
+        return labels, sources, covs
+
+    def _cost(self, lines: np.ndarray, u_lines: Optional[np.ndarray], labels: np.ndarray, sources: np.ndarray) -> float:
+        d = self.distances(lines, sources)[np.arange(len(lines)), labels]
+        w = np.ones(len(lines)) if u_lines is None else self.estimator.line_weights(lines, u_lines)
+        return float(np.sum(w*d**2))
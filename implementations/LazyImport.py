@@ -0,0 +1,31 @@
+from typing import Any, Optional
+import importlib
+
+class LazyImport:
+    """
+    Stand-in for a module, or for an attribute of a module, that imports it on first attribute access.
+    plt = LazyImport("matplotlib.pyplot") and logger = LazyImport("loguru", "logger") keep matplotlib and loguru
+    out of processes that only compute a source, while plt.savefig(...) and logger.warning(...) work as usual
+    """
+    def __init__(self, module_name: str, attr_name: Optional[str] = None) -> None:
+        self._module_name = module_name
+        self._attr_name = attr_name
+        self._target: Any = None
+
+    def resolve(self) -> Any:
+        if self._target is None:
+            module = importlib.import_module(self._module_name)
+            self._target = module if self._attr_name is None else getattr(module, self._attr_name)
+        return self._target
+
+    def __getattr__(self, name: str) -> Any:
+        if name.startswith("__") or name in ("_module_name", "_attr_name", "_target"):
+            raise AttributeError(name) # e.g. copy and pickle probing an instance that has no state yet
+        return getattr(self.resolve(), name)
+
+    def __call__(self, *args: Any, **kwargs: Any) -> Any:
+        return self.resolve()(*args, **kwargs)
+
+    def __repr__(self) -> str:
+        target = self._module_name if self._attr_name is None else f'{self._module_name}.{self._attr_name}'
+        return f'LazyImport({target}, {"imported" if self._target is not None else "not imported"})'
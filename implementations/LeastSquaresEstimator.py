@@ -0,0 +1,131 @@
+from PET_radioactive_source_localization.implementations.DataHolder import DataHolder
+from typing import Tuple, Optional
+import numpy as np
+
+class LeastSquaresEstimator:
+    """
+    Estimates the source as the point with the smallest weighted sum of squared perpendicular distances to all lines,
+    instead of the mean of pairwise intersections. It needs one O(n) pass over the lines and no k_epsilon cutoff.
+
+    A line y=kx+b is written as n.p + c = 0 with unit normal n = (k, -1)/sqrt(1+k^2) and c = b/sqrt(1+k^2),
+    so the source solves the 2x2 normal equations (sum w*n*n^T) p = -(sum w*n*c).
+    Each line is weighted by 1/u_d^2, where u_d is the uncertainty of its distance to reference_point
+    (the centre of the detector rings by default). It is propagated from the angles and radii of the two detector points
+    when they are known, see distance_weights, and from u_all_lines_params otherwise, see line_weights.
+    The sums are kept in a statistics vector of constant size, so statistics of separate chunks of lines can simply be added
+    """
+    # order of the sums in a statistics vector
+    statistics_fields: Tuple[str, ...] = ("n", "w", "w_nx_nx", "w_nx_ny", "w_ny_ny", "w_nx_c", "w_ny_c", "w_c_c")
+
+    def __init__(self, dataholder: DataHolder, reference_point: Tuple[float, float] = (0.0, 0.0)) -> None:
+        self.dataholder = dataholder
+        self.reference_point = reference_point
+
+    def line_weights(self, lines: np.ndarray, u_lines: np.ndarray) -> np.ndarray:
+        """Inverse variances of the perpendicular distance from reference_point to every (k, b) line"""
+        k, b = lines[:, 0], lines[:, 1]
+        u_k, u_b = u_lines[:, 0], u_lines[:, 1]
+        x0, y0 = self.reference_point
+        norm_sq = 1+k**2
+        dd_dk = x0/np.sqrt(norm_sq) - k*(k*x0-y0+b)/norm_sq**1.5
+        dd_db = 1/np.sqrt(norm_sq)
+        u_d_sq = (dd_dk*u_k)**2 + (dd_db*u_b)**2
+        if np.any(u_d_sq <= 0):
+            raise ValueError(f'can\'t weight lines with zero uncertainty: {u_lines[u_d_sq <= 0]}')
+        return 1/u_d_sq
+
+    def distance_weights(self, points: np.ndarray, u_thetas: np.ndarray) -> np.ndarray:
+        """
+        Inverse variances of the distance from reference_point to the lines through (N, 2, 2) detector points, propagated from
+        u_thetas (degrees) along the rings and u_R1, u_R2 across them. k and b of a line come from the same two points,
+        so their errors are correlated, which line_weights can't see from u_k and u_b alone: it misjudges u_d and the covariance of solve
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 2, 2)
+        u_thetas = np.asarray(u_thetas, dtype=float).reshape(-1, 2)
+        v = points[:, 1] - points[:, 0]
+        q = points[:, 0] - np.asarray(self.reference_point, dtype=float)
+        length = np.hypot(v[:, 0], v[:, 1])
+        d = (v[:, 0]*q[:, 1] - v[:, 1]*q[:, 0])/length
+        dd_dv = np.column_stack((q[:, 1], -q[:, 0]))/length[:, None] - (d/length**2)[:, None]*v
+        dd_dq = np.column_stack((-v[:, 1], v[:, 0]))/length[:, None]
+        u_d_sq = np.zeros(len(points))
+        # the first point moves both q and v, the second one only v
+        for end, gradient, u_R in ((0, dd_dq-dd_dv, self.dataholder.u_R1), (1, dd_dv, self.dataholder.u_R2)):
+            radius = np.hypot(points[:, end, 0], points[:, end, 1])
+            radial = points[:, end]/radius[:, None]
+            tangential = np.column_stack((-radial[:, 1], radial[:, 0]))
+            u_d_sq += (np.sum(gradient*tangential, axis=1)*radius*np.deg2rad(u_thetas[:, end]))**2 + (np.sum(gradient*radial, axis=1)*u_R)**2
+        if np.any(u_d_sq <= 0):
+            raise ValueError(f'can\'t weight lines with zero uncertainty: {u_thetas[u_d_sq <= 0]}')
+        return 1/u_d_sq
+
+    def find_line_weights(self) -> Optional[np.ndarray]:
+        """
+        Inverse variance weights find_source gives the lines of the dataholder: distance_weights when every line still has
+        its detector points and u_thetas, line_weights of u_all_lines_params otherwise, e.g. for binned lines. None without uncertainties
+        """
+        n_lines = len(self.dataholder.all_lines_params)
+        u_thetas = self.dataholder.u_thetas
+        if n_lines > 0 and len(self.dataholder.points) == n_lines and u_thetas is not None and len(u_thetas) == n_lines:
+            return self.distance_weights(self.dataholder.points, u_thetas) #type: ignore
+        if len(self.dataholder.u_all_lines_params) > 0:
+            return self.line_weights(np.asarray(self.dataholder.all_lines_params, dtype=float).reshape(-1, 2),
+                                     np.asarray(self.dataholder.u_all_lines_params, dtype=float).reshape(-1, 2))
+        return None
+
+    def line_statistics(self, lines: np.ndarray, u_lines: Optional[np.ndarray] = None, weights: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Sums needed by the normal equations, in the order of statistics_fields.
+
+        Args:
+            lines: (N, 2) array of (k, b).
+            u_lines: Optional (N, 2) array of (u_k, u_b). Lines are weighted by them if provided, otherwise equally.
+            weights: Optional (N,) array of extra weights, e.g. multiplicities of lines.
+        """
+        lines = np.asarray(lines, dtype=float).reshape(-1, 2)
+        k, b = lines[:, 0], lines[:, 1]
+        norm = np.sqrt(1+k**2)
+        n_x, n_y, c = k/norm, -1/norm, b/norm
+        w = np.ones(len(lines)) if u_lines is None else self.line_weights(lines, np.asarray(u_lines, dtype=float).reshape(-1, 2))
+        if weights is not None:
+            w = w*np.asarray(weights, dtype=float)
+        return np.array([len(lines), w.sum(),
+                         np.sum(w*n_x*n_x), np.sum(w*n_x*n_y), np.sum(w*n_y*n_y),
+                         np.sum(w*n_x*c), np.sum(w*n_y*c), np.sum(w*c*c)])
+
+    def solve(self, statistics: np.ndarray, weighted: bool = True) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Solve the normal equations for the source and its 2x2 covariance matrix.
+        For weighted statistics the covariance is the inverse of the normal matrix. For unweighted statistics
+        it is scaled by the residual variance chi^2/(n-2), because the lines' uncertainties are unknown
+        """
+        n, _, w_nx_nx, w_nx_ny, w_ny_ny, w_nx_c, w_ny_c, w_c_c = statistics
+        if n < 2:
+            raise ValueError(f'can\'t find source from less than 2 lines: {int(n)}')
+        normal_matrix = np.array([[w_nx_nx, w_nx_ny], [w_nx_ny, w_ny_ny]])
+        rhs = -np.array([w_nx_c, w_ny_c])
+        # the condition number doesn't depend on the scale of the weights, unlike the determinant
+        if not np.linalg.cond(normal_matrix) < 1/np.finfo(float).eps:
+            raise ValueError(f'normal matrix is singular, lines are parallel: {normal_matrix}')
+        cov = np.linalg.inv(normal_matrix)
+        source = cov @ rhs
+        if not weighted:
+            chi_sq = max(w_c_c - source @ rhs, 0.0)
+            cov = cov * (chi_sq/(n-2) if n > 2 else np.nan)
+        return source, cov
+
+    def find_source(self, find_u: bool = False) -> Tuple[float, float]:
+        """Find the source from all_lines_params, weighted by find_line_weights when uncertainties are available and by line_weights"""
+        if len(self.dataholder.all_lines_params) == 0:
+            raise ValueError(f'can\'t find source, because all_lines_params is empty: {self.dataholder.all_lines_params}')
+        weights = self.find_line_weights()
+        weighted = weights is not None
+        if len(self.dataholder.line_weights) > 0:
+            multiplicities = np.asarray(self.dataholder.line_weights, dtype=float)
+            weights = multiplicities if weights is None else weights*multiplicities
+        source, cov = self.solve(self.line_statistics(self.dataholder.all_lines_params, weights=weights), weighted=weighted) #type: ignore
+        self.dataholder.source = (float(source[0]), float(source[1]))
+        if find_u:
+            self.dataholder.cov_source = (tuple(cov[0].tolist()), tuple(cov[1].tolist()))
+            self.dataholder.u_source = tuple(np.sqrt(np.diag(cov)).tolist())
+        return self.dataholder.source
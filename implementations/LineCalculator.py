@@ -2,13 +2,15 @@ from PET_radioactive_source_localization.abstractions.ICalculator import ICalcul
 from PET_radioactive_source_localization.implementations.DataHolder import DataHolder
 from typing import List, Tuple, Literal, Any, Callable, Dict, Optional, Iterable
 import numpy as np
-from autograd.numpy import cos, sin #type: ignore
-from autograd import grad
-from loguru import logger
+from PET_radioactive_source_localization.implementations.UncertaintyPropagator import UncertaintyPropagator
+from PET_radioactive_source_localization.implementations.LazyImport import LazyImport
+grad = LazyImport("autograd", "grad")
+logger = LazyImport("loguru", "logger")
 
 class LineCalculator(ICalculator):
     def __init__(self, dataholder: DataHolder) -> None:
         self.dataholder = dataholder
+        self.propagator = UncertaintyPropagator()
 
     def find_theta_uncertainities(self) -> None:
         try:
@@ -57,12 +59,13 @@ class LineCalculator(ICalculator):
                 raise ValueError(f'points is empty: {self.dataholder.points}')
             
         if find_u:
-            for (theta1, theta2), (u_theta1, u_theta2) in zip(self.dataholder.thetas, self.dataholder.u_thetas):
-                u_x1 = self.find_uncertainty_of_composed_function(lambda r, theta: r*cos(theta*np.pi/180), {'r': float(self.dataholder.R1), 'theta': float(theta1)}, {'r': self.dataholder.u_R1, 'theta': u_theta1})
-                u_y1 = self.find_uncertainty_of_composed_function(lambda r, theta: r*sin(theta*np.pi/180), {'r': float(self.dataholder.R1), 'theta': float(theta1)}, {'r': self.dataholder.u_R1, 'theta': u_theta1})
-                u_x2 = self.find_uncertainty_of_composed_function(lambda r, theta: r*cos(theta*np.pi/180), {'r': float(self.dataholder.R1), 'theta': float(theta2)}, {'r': self.dataholder.u_R2, 'theta': u_theta2})
-                u_y2 = self.find_uncertainty_of_composed_function(lambda r, theta: r*sin(theta*np.pi/180), {'r': float(self.dataholder.R1), 'theta': float(theta2)}, {'r': self.dataholder.u_R2, 'theta': u_theta2})
-
+            thetas = np.asarray(self.dataholder.thetas, dtype=float)
+            u_thetas = np.asarray(self.dataholder.u_thetas, dtype=float)
+            r = (float(self.dataholder.R1), float(self.dataholder.R2))
+            u_r = (self.dataholder.u_R1, self.dataholder.u_R2)
+            u_x = self.propagator.propagate("polar_x", (r, thetas), (u_r, u_thetas))
+            u_y = self.propagator.propagate("polar_y", (r, thetas), (u_r, u_thetas))
+            for (u_x1, u_x2), (u_y1, u_y2) in zip(u_x.tolist(), u_y.tolist()):
                 self.dataholder.u_points.append(((u_x1, u_y1), (u_x2, u_y2)))
 
 
@@ -86,16 +89,18 @@ class LineCalculator(ICalculator):
             else:
                 if len(self.dataholder.points) == 0:
                     raise ValueError(f'dataholder points is an empty list: {self.dataholder.points}')
-            for ((x1, y1), (x2, y2)), ((u_x1, u_y1), (u_x2, u_y2)) in zip(self.dataholder.points, self.dataholder.u_points): 
+            for (x1, y1), (x2, y2) in self.dataholder.points:
                 dx = x2-x1
                 dy = y2-y1
                 k = dy/dx
                 b = (y1-k*x1)/2 + (y2-k*x2)/2
                 self.dataholder.all_lines_params.append((k,b))
-                u_k = self.find_uncertainty_of_composed_function(lambda x1, y1, x2, y2: (y2-y1)/(x2-x1), {'x1': x1, 'y1': y1, 'x2': x2, 'y2': y2}, {'x1': u_x1, 'y1': u_y1, 'x2': u_x2, 'y2': u_y2})
-                u_b = self.find_uncertainty_of_composed_function(lambda x1, y1, x2, y2: (y1-k*x1)/2 + (y2-k*x2)/2, {'x1': x1, 'y1': y1, 'x2': x2, 'y2': y2}, {'x1': u_x1, 'y1': u_y1, 'x2': u_x2, 'y2': u_y2})
-                #u_b = np.sqrt(u_y1**2+(x1*u_k)**2+(k*u_x1)**2)
-                self.dataholder.u_all_lines_params.append((u_k, u_b))
+            points = np.asarray(self.dataholder.points, dtype=float).reshape(-1, 4).T
+            u_points = np.asarray(self.dataholder.u_points, dtype=float).reshape(-1, 4).T
+            k = np.asarray(self.dataholder.all_lines_params[-len(self.dataholder.points):], dtype=float)[:, 0]
+            u_k = self.propagator.propagate("line_k", points, u_points)
+            u_b = self.propagator.propagate("line_b", (*points, k), u_points)
+            self.dataholder.u_all_lines_params.extend(zip(u_k.tolist(), u_b.tolist()))
 
     def get_more_points_from_params(self, k: float, b: float, central_point: Tuple[float, float], scale: float = 5, point_number: int = 100) -> np.ndarray[Any, np.dtype[np.floating[Any]]]:
         """Generate points on a line y=kx+b defined by params k and b. This function is used to generate points for plt.plot() function"""
@@ -134,8 +139,8 @@ class LineCalculator(ICalculator):
                     raise ValueError(f'flag find_u to find uncertainties is set to True, meanwhile no uncertainties provided: {u_first_line}, {u_second_line}')
                 u_k1, u_b1 = u_first_line
                 u_k2, u_b2 = u_second_line
-                u_x = self.find_uncertainty_of_composed_function(lambda k1, b1, k2, b2: (b2-b1)/(k1-k2), {"k1": k1, "b1": b1, "k2": k2, "b2": b2}, {"k1": u_k1, "b1": u_b1, "k2": u_k2, "b2": u_b2})
-                u_y = self.find_uncertainty_of_composed_function(lambda k1, b1: k1*x+b1, {"k1": k1, "b1": b1}, {"k1": u_k1, "b1": u_b1})
+                u_x = float(self.propagator.propagate("intersection_x", (k1, b1, k2, b2), (u_k1, u_b1, u_k2, u_b2)))
+                u_y = float(self.propagator.propagate("intersection_y", (k1, b1, x), (u_k1, u_b1)))
                 self.dataholder.u_intersection_points.append((u_x, u_y))
                 return ((x, y), (u_x, u_y))
         
@@ -155,9 +160,21 @@ class LineCalculator(ICalculator):
                 if len(self.dataholder.u_all_lines_params) == 0:
                     raise ValueError(f'lines params is an empty list: {self.dataholder.u_all_lines_params}')
                 
-            for i, ((k_i, b_i), (u_k_i, u_b_i)) in enumerate(zip(self.dataholder.all_lines_params[:-1], self.dataholder.u_all_lines_params[:-1])):
-                for ((k_j, b_j), (u_k_j, u_b_j)) in zip(self.dataholder.all_lines_params[i+1:], self.dataholder.u_all_lines_params[i+1:]):
-                        self.find_intersection_point_of_two_lines((k_i, b_i), (k_j, b_j), k_epsilon = k_epsilon, find_u=True, u_first_line=(u_k_i, u_b_i), u_second_line=(u_k_j, u_b_j))
+            accepted_pairs = []
+            for i, (k_i, b_i) in enumerate(self.dataholder.all_lines_params[:-1]):
+                for j, (k_j, b_j) in enumerate(self.dataholder.all_lines_params[i+1:], start=i+1):
+                        if self.find_intersection_point_of_two_lines((k_i, b_i), (k_j, b_j), k_epsilon = k_epsilon) is not None:
+                            accepted_pairs.append((i, j))
+            if not accepted_pairs:
+                return
+            # uncertainties of all accepted pairs are propagated at once instead of pair by pair
+            i, j = np.array(accepted_pairs).T
+            k, b = np.asarray(self.dataholder.all_lines_params, dtype=float).T
+            u_k, u_b = np.asarray(self.dataholder.u_all_lines_params, dtype=float).T
+            x = np.asarray(self.dataholder.intersection_points[-len(accepted_pairs):], dtype=float)[:, 0]
+            u_x = self.propagator.propagate("intersection_x", (k[i], b[i], k[j], b[j]), (u_k[i], u_b[i], u_k[j], u_b[j]))
+            u_y = self.propagator.propagate("intersection_y", (k[i], b[i], x), (u_k[i], u_b[i]))
+            self.dataholder.u_intersection_points.extend(zip(u_x.tolist(), u_y.tolist()))
     
     def find_source(self, find_u: bool = False) -> Tuple[float, float]:
         """Given intersection points, find their mean coordinates, which is the estimated position of the source"""
@@ -219,10 +236,10 @@ class LineCalculator(ICalculator):
         
     def round(self, arr: Iterable, n_digits=2) -> Optional[List[Tuple[float, float]] | Tuple[float, float]]:
         try: 
-            if isinstance(arr, list):
-                return [(round(float(x), n_digits), round(float(y), n_digits)) for x, y in arr]
-            elif isinstance(arr, tuple):
+            if isinstance(arr, tuple):
                 return (round(float(arr[0]), n_digits), round(float(arr[1]), n_digits))
+            elif isinstance(arr, Iterable):
+                return [(round(float(x), n_digits), round(float(y), n_digits)) for x, y in arr]
         except Exception as e:
             raise ValueError(f'can\'t round {arr}: {e}')
     
@@ -0,0 +1,141 @@
+from PET_radioactive_source_localization.implementations.DataHolder import DataHolder
+from PET_radioactive_source_localization.implementations.StreamingLocalizer import StreamingLocalizer
+from PET_radioactive_source_localization.implementations.LazyImport import LazyImport
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Optional, Tuple
+import asyncio
+import json
+import os
+import numpy as np
+logger = LazyImport("loguru", "logger")
+
+def _init_plot_worker() -> None:
+    """Plots are rendered in a separate process with a non-interactive backend, so they never touch the event loop or open a window"""
+    import matplotlib
+    matplotlib.use("Agg")
+
+def _render_plot(filepath: str, thetas: np.ndarray, geometry: Dict[str, float], source: Optional[Tuple[float, float]],
+                 u_source: Tuple[float, ...], n_lines: int) -> str:
+    """Draw the chords of the most recent lines and the running source into filepath"""
+    import matplotlib.pyplot as plt
+    from PET_radioactive_source_localization.implementations.Plotter import Plotter
+    from PET_radioactive_source_localization.implementations.VectorizedLineCalculator import VectorizedLineCalculator
+    dataholder = DataHolder(source=source, u_source=u_source, **geometry)
+    plotter = Plotter(dataholder)
+    if len(thetas):
+        plotter.add_lines(VectorizedLineCalculator(dataholder).cartesian_from_polar(thetas, dataholder.R1, dataholder.R2))
+    if source is not None:
+        plotter.highlight_source(show_uncertainty=len(u_source) > 0)
+    plotter.finalize(title=f'{n_lines} lines', show=False)
+    plotter.fig.savefig(filepath)
+    plt.close(plotter.fig)
+    return filepath
+
+class LiveService:
+    """
+    asyncio service for data that is still being acquired. Clients connect over TCP or a Unix socket and exchange
+    newline-delimited JSON messages, every request is answered with exactly one message:
+        {"type": "events", "thetas": [[t1, t2], ...], "S_thetas": [[s1, s2], ...]} -> {"type": "ack", "n_lines": ...}
+        {"type": "query"} -> {"type": "estimate", "n_lines": ..., "source": ..., "u_source": ..., "cov_source": ...}
+        {"type": "plot", "filepath": "..."} -> {"type": "plot", "filepath": ...}
+        {"type": "reset"} -> {"type": "ack", "n_lines": 0}
+    Malformed requests are answered with {"type": "error", "message": ...} and the connection stays open.
+    Batches are folded into a StreamingLocalizer: their statistics are computed in a thread and added on the event loop,
+    so queries are answered from the latest estimate while batches are being processed. Plots of the last
+    max_plot_lines lines are rendered in a worker process. source is None until there are enough lines
+    """
+    def __init__(self, dataholder: Optional[DataHolder] = None, max_plot_lines: int = 500) -> None:
+        self.dataholder = dataholder or DataHolder()
+        self.localizer = StreamingLocalizer(self.dataholder)
+        self.max_plot_lines = max_plot_lines
+        self.recent_thetas = np.empty((0, 2))
+        self.server: Optional[asyncio.AbstractServer] = None
+        self._plot_executor: Optional[ProcessPoolExecutor] = None
+
+    @property
+    def address(self) -> Any:
+        """(host, port) of a TCP server, or the path of a Unix socket"""
+        if self.server is None:
+            raise ValueError(f'service is not started: {self.server}')
+        return self.server.sockets[0].getsockname()
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0, path: Optional[str] = None, limit: int = 1 << 24) -> asyncio.AbstractServer:
+        """Listen on a Unix socket if path is given, otherwise on host:port (port 0 picks a free port). limit is the longest accepted message in bytes"""
+        if path is not None:
+            self.server = await asyncio.start_unix_server(self.handle_client, path=path, limit=limit)
+        else:
+            self.server = await asyncio.start_server(self.handle_client, host=host, port=port, limit=limit)
+        logger.info(f'live service listening on {self.address}')
+        return self.server
+
+    async def close(self) -> None:
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        if self._plot_executor is not None:
+            # waiting for a running plot would block the event loop
+            await asyncio.get_running_loop().run_in_executor(None, self._plot_executor.shutdown)
+            self._plot_executor = None
+
+    async def serve_forever(self, **start_kwargs: Any) -> None:
+        await self.start(**start_kwargs)
+        try:
+            await self.server.serve_forever() #type: ignore
+        finally:
+            await self.close()
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    response = await self.handle_message(json.loads(line))
+                except (ValueError, KeyError, TypeError) as e:
+                    response = {"type": "error", "message": f'{type(e).__name__}: {e}'}
+                writer.write(json.dumps(response).encode() + b"\n")
+                await writer.drain()
+        except (ConnectionResetError, ValueError) as e: # readline raises ValueError on messages over limit
+            logger.warning(f'live service client disconnected: {e}')
+        finally:
+            writer.close()
+
+    async def handle_message(self, message: Any) -> Dict[str, Any]:
+        if not isinstance(message, dict):
+            raise ValueError(f'message must be a JSON object: {message}')
+        kind = message.get("type")
+        if kind == "events":
+            n_lines = await self.add_events(message["thetas"], message.get("S_thetas"))
+            return {"type": "ack", "n_lines": n_lines}
+        if kind == "query":
+            return self.estimate()
+        if kind == "plot":
+            return {"type": "plot", "filepath": await self.render_plot(message["filepath"])}
+        if kind == "reset":
+            self.localizer.reset()
+            self.recent_thetas = np.empty((0, 2))
+            self.dataholder.source, self.dataholder.u_source, self.dataholder.cov_source = None, (), None
+            return {"type": "ack", "n_lines": 0}
+        raise ValueError(f'unknown message type: {kind}')
+
+    async def add_events(self, thetas: Any, S_thetas: Optional[Any] = None) -> int:
+        """Fold a batch of angle pairs into the running estimate and return the total number of lines"""
+        thetas = np.asarray(thetas, dtype=float).reshape(-1, 2)
+        statistics = await asyncio.get_running_loop().run_in_executor(None, self.localizer.line_statistics, thetas, S_thetas)
+        self.localizer.add_statistics(statistics)
+        self.recent_thetas = np.concatenate((self.recent_thetas, thetas))[-self.max_plot_lines:]
+        return self.localizer.n_lines
+
+    def estimate(self) -> Dict[str, Any]:
+        return {"type": "estimate", "n_lines": self.localizer.n_lines, "source": self.dataholder.source,
+                "u_source": self.dataholder.u_source, "cov_source": self.dataholder.cov_source}
+
+    async def render_plot(self, filepath: str) -> str:
+        if not os.path.isdir(os.path.dirname(os.path.abspath(filepath))):
+            raise ValueError(f'directory of filepath: {filepath} does not exist')
+        if self._plot_executor is None:
+            self._plot_executor = ProcessPoolExecutor(max_workers=1, initializer=_init_plot_worker)
+        geometry = {name: getattr(self.dataholder, name) for name in ("R1", "R2", "U_thetas", "u_R1", "u_R2")}
+        return await asyncio.get_running_loop().run_in_executor(self._plot_executor, _render_plot, filepath, self.recent_thetas,
+                                                                geometry, self.dataholder.source, self.dataholder.u_source, self.localizer.n_lines)
@@ -0,0 +1,158 @@
+from PET_radioactive_source_localization.implementations.DataHolder import DataHolder
+from dataclasses import dataclass
+from typing import Optional, Tuple
+import numpy as np
+
+@dataclass
+class _Grid:
+    """Occupied cells of a spatial hash: sorted keys x_cell*stride + y_cell, and weighted centroids and masses of the cells"""
+    origin: np.ndarray
+    cell_size: float
+    stride: int
+    keys: np.ndarray
+    centroids: np.ndarray
+    masses: np.ndarray
+
+class ModeSeeker:
+    """
+    Finds the source as the densest spot of intersection points instead of their mean, so a few far-away intersections
+    of nearly parallel lines can't drag it. Points are weighted by 1/(u_x^2+u_y^2) and hashed into a grid of square cells
+    with side bandwidth. Mean shift with a flat kernel of radius bandwidth then runs on the weighted centroids of the cells,
+    starting from the cells that are heavier than their 8 neighbours. Every neighbour query looks up 3x3 cells with
+    a binary search over the sorted cell keys, so the cost is O(n log n) in the number of points, never O(n^2).
+    Several well separated modes are returned for data with several sources
+    """
+    offsets = np.array([(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)])
+
+    def __init__(self, dataholder: DataHolder, bandwidth: Optional[float] = None, max_seeds: int = 20, max_iter: int = 100,
+                 tol: float = 1e-4, min_fraction: float = 0.1) -> None:
+        if bandwidth is not None and bandwidth <= 0:
+            raise ValueError(f'bandwidth must be positive: {bandwidth}')
+        self.dataholder = dataholder
+        self.bandwidth = bandwidth
+        self.max_seeds = max_seeds
+        self.max_iter = max_iter
+        self.tol = tol
+        self.min_fraction = min_fraction
+
+    def weights(self, u_points: Optional[np.ndarray], n_points: int) -> np.ndarray:
+        if u_points is None:
+            return np.ones(n_points)
+        u_sq = np.sum(np.asarray(u_points, dtype=float).reshape(-1, 2)**2, axis=1)
+        if np.any(u_sq <= 0):
+            raise ValueError(f'can\'t weight intersection points with zero uncertainty: {np.flatnonzero(u_sq <= 0)}')
+        return 1/u_sq
+
+    def find_modes(self, points: np.ndarray, u_points: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Modes of (N, 2) points, weighted by their (N, 2) uncertainties if provided.
+
+        Returns:
+            modes (K, 2) sorted from the densest, their densities (K,) as the total weight within bandwidth,
+            and their (K, 2) uncertainties from the weighted mean of those points.
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        weights = self.weights(u_points, len(points))
+        finite = np.all(np.isfinite(points), axis=1)
+        points, weights = points[finite], weights[finite]
+        u_points = None if u_points is None else np.asarray(u_points, dtype=float).reshape(-1, 2)[finite]
+        if len(points) == 0:
+            raise ValueError(f'no finite intersection points to seek modes in: {len(finite)} points given')
+        bandwidth = self._bandwidth(u_points)
+        grid = self._bin(points, weights, bandwidth)
+
+        seeds = grid.centroids[self._local_maxima(grid)]
+        for _ in range(self.max_iter):
+            shifted, _ = self._shift(grid, seeds, bandwidth)
+            converged = np.all(np.hypot(*(shifted-seeds).T) < self.tol*bandwidth)
+            seeds = shifted
+            if converged:
+                break
+        _, densities = self._shift(grid, seeds, bandwidth)
+
+        # merge seeds that climbed to the same mode, keeping the densest
+        modes, mode_densities = [], []
+        for index in np.argsort(-densities, kind="stable"):
+            if densities[index] < self.min_fraction*densities.max():
+                break
+            if all(np.hypot(*(seeds[index]-mode)) > bandwidth for mode in modes):
+                modes.append(seeds[index])
+                mode_densities.append(densities[index])
+        modes_arr = np.array(modes)
+        return modes_arr, np.array(mode_densities), self._uncertainties(points, weights, u_points, modes_arr, bandwidth)
+
+    def find_source(self, find_u: bool = False) -> Tuple[float, float]:
+        """Put the densest mode of dataholder.intersection_points into dataholder.source"""
+        modes, _, u_modes = self._find_modes_of_dataholder()
+        self.dataholder.source = (float(modes[0, 0]), float(modes[0, 1]))
+        if find_u:
+            self.dataholder.u_source = (float(u_modes[0, 0]), float(u_modes[0, 1]))
+        return self.dataholder.source
+
+    def find_sources(self, n_sources: Optional[int] = None, find_u: bool = False) -> Tuple[Tuple[float, float], ...]:
+        """Put up to n_sources modes (all of them by default) into dataholder.sources, from the densest"""
+        modes, _, u_modes = self._find_modes_of_dataholder()
+        self.dataholder.sources = [tuple(mode) for mode in modes[:n_sources].tolist()]
+        if find_u:
+            self.dataholder.u_sources = [tuple(u_mode) for u_mode in u_modes[:n_sources].tolist()]
+        return tuple(self.dataholder.sources)
+
+    def _find_modes_of_dataholder(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        if len(self.dataholder.intersection_points) == 0:
+            raise ValueError(f'can\'t find source, because no intersection points are provided: {self.dataholder.intersection_points}')
+        u_points = self.dataholder.u_intersection_points if len(self.dataholder.u_intersection_points) > 0 else None
+        return self.find_modes(np.asarray(self.dataholder.intersection_points, dtype=float), u_points) #type: ignore
+
+    def _bandwidth(self, u_points: Optional[np.ndarray]) -> float:
+        """Given bandwidth, or twice the median uncertainty of the points, or R2/20 without uncertainties"""
+        if self.bandwidth is not None:
+            return self.bandwidth
+        if u_points is not None:
+            return float(2*np.median(np.hypot(u_points[:, 0], u_points[:, 1])))
+        return self.dataholder.R2/20
+
+    def _bin(self, points: np.ndarray, weights: np.ndarray, bandwidth: float) -> _Grid:
+        # one empty cell of margin on every side, so neighbours of any cell inside the bounding box have valid keys
+        origin = points.min(axis=0) - bandwidth
+        cells = np.floor((points-origin)/bandwidth).astype(np.int64)
+        stride = int(cells[:, 1].max()) + 2
+        keys, inverse = np.unique(cells[:, 0]*stride + cells[:, 1], return_inverse=True)
+        masses = np.bincount(inverse, weights)
+        centroids = np.column_stack((np.bincount(inverse, weights*points[:, 0]), np.bincount(inverse, weights*points[:, 1])))/masses[:, None]
+        return _Grid(origin=origin, cell_size=bandwidth, stride=stride, keys=keys, centroids=centroids, masses=masses)
+
+    def _neighbour_cells(self, grid: _Grid, positions: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """(S, 9) indices of the occupied cells in the 3x3 block around every position, and a mask of which of them exist"""
+        cells = np.floor((positions-grid.origin)/grid.cell_size).astype(np.int64)[:, None, :] + self.offsets
+        query = cells[..., 0]*grid.stride + cells[..., 1]
+        indices = np.clip(np.searchsorted(grid.keys, query), 0, len(grid.keys)-1)
+        return indices, grid.keys[indices] == query
+
+    def _local_maxima(self, grid: _Grid) -> np.ndarray:
+        """Indices of the heaviest cells that are at least as heavy as all their neighbours, at most max_seeds of them"""
+        indices, exists = self._neighbour_cells(grid, grid.centroids)
+        is_max = np.all(np.where(exists, grid.masses[indices], 0) <= grid.masses[:, None], axis=1)
+        candidates = np.flatnonzero(is_max)
+        return candidates[np.argsort(-grid.masses[candidates], kind="stable")][:self.max_seeds]
+
+    def _shift(self, grid: _Grid, positions: np.ndarray, bandwidth: float) -> Tuple[np.ndarray, np.ndarray]:
+        """One mean-shift step of every position: weighted mean of cell centroids within bandwidth, and their total mass"""
+        indices, exists = self._neighbour_cells(grid, positions)
+        neighbours = grid.centroids[indices]
+        within = exists & (np.hypot(*(neighbours-positions[:, None, :]).transpose(2, 0, 1)) <= bandwidth)
+        mass = np.where(within, grid.masses[indices], 0)
+        total = mass.sum(axis=1)
+        shifted = np.where(total[:, None] > 0, np.sum(mass[..., None]*neighbours, axis=1)/np.maximum(total, 1e-300)[:, None], positions)
+        return shifted, total
+
+    def _uncertainties(self, points: np.ndarray, weights: np.ndarray, u_points: Optional[np.ndarray], modes: np.ndarray, bandwidth: float) -> np.ndarray:
+        """Uncertainty of the weighted mean of the points within bandwidth of every mode, or their standard error without u_points"""
+        u_modes = np.full(modes.shape, np.nan)
+        for index, mode in enumerate(modes):
+            near = np.hypot(*(points-mode).T) <= bandwidth
+            w = weights[near]
+            if u_points is not None:
+                u_modes[index] = np.sqrt(np.sum((w[:, None]*u_points[near])**2, axis=0))/w.sum()
+            elif near.sum() > 1:
+                u_modes[index] = points[near].std(axis=0, ddof=1)/np.sqrt(near.sum())
+        return u_modes
@@ -0,0 +1,149 @@
+from PET_radioactive_source_localization.implementations.DataHolder import DataHolder
+from PET_radioactive_source_localization.implementations.LeastSquaresEstimator import LeastSquaresEstimator
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import List, Literal, Optional, Tuple
+import os
+import numpy as np
+
+@dataclass
+class MonteCarloResult:
+    """
+    Empirical distribution of the source over replicates. intervals holds [low, high] of x and y at the given confidence,
+    the ellipse has the same confidence: semi_axes along its principal directions and angle (degrees) of the first axis from +x
+    """
+    sources: np.ndarray
+    mean: np.ndarray
+    cov: np.ndarray
+    u_source: np.ndarray
+    intervals: np.ndarray
+    semi_axes: np.ndarray
+    angle: float
+    confidence: float
+    n_failed: int = 0
+
+def _replicate_sources(thetas: np.ndarray, u_thetas: np.ndarray, geometry: Tuple[float, float, float, float], estimator: str,
+                       k_epsilon: float, weights: Optional[np.ndarray], n_replicates: int, seed: np.random.SeedSequence, max_elements: int) -> np.ndarray:
+    """
+    (n_replicates, 2) sources of perturbed copies of the data. Every replicate draws new angles from N(thetas, u_thetas)
+    and one radius per detector ring from N(R, u_R), the radius being a property of the whole ring.
+    Replicates are processed in batches of (batch, N) arrays, so that no temporary exceeds max_elements
+    """
+    rng = np.random.default_rng(seed)
+    R1, R2, u_R1, u_R2 = geometry
+    n_lines = len(thetas)
+    if estimator == "intersections":
+        i, j = np.triu_indices(n_lines, k=1)
+        per_replicate = len(i)
+    else:
+        per_replicate = n_lines # least squares never forms pairs, so it stays O(n)
+    batch_size = max(1, max_elements//max(per_replicate, 1))
+    sources = np.empty((n_replicates, 2))
+    for start in range(0, n_replicates, batch_size):
+        m = min(batch_size, n_replicates-start)
+        radians = np.deg2rad(thetas + rng.standard_normal((m, n_lines, 2))*u_thetas)
+        r = np.column_stack((rng.normal(R1, u_R1, m), rng.normal(R2, u_R2, m)))[:, None, :]
+        x, y = r*np.cos(radians), r*np.sin(radians)
+        k = (y[..., 1]-y[..., 0])/(x[..., 1]-x[..., 0])
+        b = (y[..., 0]-k*x[..., 0])/2 + (y[..., 1]-k*x[..., 1])/2
+        with np.errstate(invalid="ignore", divide="ignore"):
+            if estimator == "intersections":
+                delta_k = k[:, i]-k[:, j]
+                mask = np.abs(delta_k) > k_epsilon
+                x_pairs = np.where(mask, (b[:, j]-b[:, i])/delta_k, 0)
+                y_pairs = np.where(mask, k[:, i]*x_pairs + b[:, i], 0)
+                n_pairs = mask.sum(axis=1)
+                sources[start:start+m] = np.column_stack((x_pairs.sum(axis=1), y_pairs.sum(axis=1)))/n_pairs[:, None]
+            else:
+                # closed form of LeastSquaresEstimator.solve for a batch of 2x2 normal equations
+                norm = np.sqrt(1+k**2)
+                n_x, n_y, c = k/norm, -1/norm, b/norm
+                w = np.ones(n_lines) if weights is None else weights
+                a_xx, a_xy, a_yy = (w*n_x*n_x).sum(axis=1), (w*n_x*n_y).sum(axis=1), (w*n_y*n_y).sum(axis=1)
+                rhs_x, rhs_y = -(w*n_x*c).sum(axis=1), -(w*n_y*c).sum(axis=1)
+                det = a_xx*a_yy - a_xy**2
+                sources[start:start+m] = np.column_stack(((a_yy*rhs_x - a_xy*rhs_y)/det, (a_xx*rhs_y - a_xy*rhs_x)/det))
+    return sources
+
+class MonteCarloUncertainty:
+    """
+    Uncertainty of the source without linearization: thetas, R1 and R2 are perturbed by u_thetas, u_R1 and u_R2
+    n_replicates times, and every replicate runs through the same computation as the estimator.
+    This stays valid for near-parallel pairs, where (b2-b1)/(k1-k2) is far from linear.
+    Replicates are generated in tasks of task_size, each seeded by its own child of SeedSequence(seed),
+    so results don't depend on n_workers. Tasks run in a process pool of n_workers (all CPUs by default) unless n_workers is 1.
+    Replicates perturb single events, so least squares weights need one entry per event: they are the ones of
+    LeastSquaresEstimator.find_line_weights, or weights when the lines were binned, e.g. by SinogramBinner
+    """
+    def __init__(self, dataholder: DataHolder, n_replicates: int = 10_000, estimator: Literal["intersections", "least_squares"] = "intersections",
+                 k_epsilon: float = 0.2, seed: Optional[int] = None, n_workers: Optional[int] = None, task_size: int = 1000, max_elements: int = 2_000_000,
+                 weights: Optional[np.ndarray] = None) -> None:
+        if n_replicates < 2:
+            raise ValueError(f'need at least 2 replicates: {n_replicates}')
+        if estimator not in ("intersections", "least_squares"):
+            raise ValueError(f'unknown estimator: {estimator}')
+        self.dataholder = dataholder
+        self.n_replicates = n_replicates
+        self.estimator = estimator
+        self.k_epsilon = k_epsilon
+        self.seed = seed
+        self.n_workers = n_workers if n_workers is not None else os.cpu_count() or 1
+        self.task_size = task_size
+        self.max_elements = max_elements
+        self.weights = weights # per-event least squares weights, instead of the ones of u_all_lines_params
+
+    def simulate(self) -> np.ndarray:
+        """(n_replicates, 2) sources of all replicates, NaN where a replicate has no accepted pair"""
+        thetas = np.asarray(self.dataholder.thetas, dtype=float).reshape(-1, 2)
+        if len(thetas) < 2:
+            raise ValueError(f'need at least 2 lines for the source: {self.dataholder.thetas}')
+        u_thetas = self._u_thetas(len(thetas))
+        geometry = (self.dataholder.R1, self.dataholder.R2, self.dataholder.u_R1, self.dataholder.u_R2)
+        weights = None if self.weights is None else np.asarray(self.weights, dtype=float)
+        if self.estimator == "least_squares" and weights is None:
+            # keep the weights of the nominal lines, like LeastSquaresEstimator.find_source would use
+            weights = LeastSquaresEstimator(self.dataholder).find_line_weights()
+        if weights is not None and len(weights) != len(thetas):
+            raise ValueError(f'need one least squares weight per event, got {len(weights)} for {len(thetas)} events, pass per-event weights: {self.weights}')
+        sizes = [min(self.task_size, self.n_replicates-start) for start in range(0, self.n_replicates, self.task_size)]
+        seeds = np.random.SeedSequence(self.seed).spawn(len(sizes))
+        args = ([thetas]*len(sizes), [u_thetas]*len(sizes), [geometry]*len(sizes), [self.estimator]*len(sizes), [self.k_epsilon]*len(sizes),
+                [weights]*len(sizes), sizes, seeds, [self.max_elements]*len(sizes))
+        if self.n_workers == 1 or len(sizes) == 1:
+            results: List[np.ndarray] = list(map(_replicate_sources, *args))
+        else:
+            with ProcessPoolExecutor(max_workers=self.n_workers) as executor:
+                results = list(executor.map(_replicate_sources, *args))
+        return np.concatenate(results)
+
+    def summarize(self, sources: np.ndarray, confidence: float = 0.95) -> MonteCarloResult:
+        if not 0 < confidence < 1:
+            raise ValueError(f'confidence must be within (0, 1): {confidence}')
+        valid = np.all(np.isfinite(sources), axis=1)
+        if valid.sum() < 2:
+            raise ValueError(f'less than 2 replicates gave a source: {int(valid.sum())} of {len(sources)}')
+        kept = sources[valid]
+        cov = np.cov(kept, rowvar=False)
+        tail = 100*(1-confidence)/2
+        intervals = np.percentile(kept, [tail, 100-tail], axis=0).T
+        eigenvalues, eigenvectors = np.linalg.eigh(cov)
+        # quantile of the chi^2 distribution with 2 degrees of freedom
+        scale = -2*np.log(1-confidence)
+        return MonteCarloResult(sources=kept, mean=kept.mean(axis=0), cov=cov, u_source=np.sqrt(np.diag(cov)), intervals=intervals,
+                                semi_axes=np.sqrt(np.maximum(eigenvalues[::-1], 0)*scale),
+                                angle=float((np.degrees(np.arctan2(eigenvectors[1, -1], eigenvectors[0, -1]))+90) % 180 - 90),
+                                confidence=confidence, n_failed=int((~valid).sum()))
+
+    def find_uncertainty(self, confidence: float = 0.95) -> MonteCarloResult:
+        """Simulate replicates and set dataholder.u_source and cov_source from their empirical covariance"""
+        result = self.summarize(self.simulate(), confidence=confidence)
+        self.dataholder.u_source = tuple(result.u_source.tolist())
+        self.dataholder.cov_source = (tuple(result.cov[0].tolist()), tuple(result.cov[1].tolist()))
+        return result
+
+    def _u_thetas(self, n_lines: int) -> np.ndarray:
+        if self.dataholder.u_thetas is not None and len(self.dataholder.u_thetas) == n_lines:
+            return np.asarray(self.dataholder.u_thetas, dtype=float).reshape(-1, 2)
+        if self.dataholder.S_thetas:
+            return np.hypot(np.asarray(self.dataholder.S_thetas, dtype=float).reshape(-1, 2), self.dataholder.U_thetas)
+        return np.full((n_lines, 2), self.dataholder.U_thetas, dtype=float)
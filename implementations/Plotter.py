@@ -1,22 +1,41 @@
 from PET_radioactive_source_localization.abstractions.IPlotter import IPlotter
 from PET_radioactive_source_localization.implementations.DataHolder import DataHolder
+from PET_radioactive_source_localization.implementations.LazyImport import LazyImport
 from numpy.typing import ArrayLike
-import matplotlib.pyplot as plt
-from typing import Optional, Tuple, Dict, List
+from typing import Any, Optional, Tuple, Dict, List
 import numpy as np
+plt = LazyImport("matplotlib.pyplot")
+LineCollection = LazyImport("matplotlib.collections", "LineCollection")
 
 class Plotter(IPlotter):
     def __init__(self, dataholder: DataHolder) -> None:
         self.dataholder: DataHolder = dataholder
-        self.fig, self.ax = plt.subplots()
+        self._fig: Any = None # created with the axes on first use, so a plotter that never draws never imports matplotlib
+        self._ax: Any = None
+        self._limits: Optional[List[float]] = None # running [x_min, x_max, y_min, y_max] of all_x and all_y
         self._initialize_plot_settings()
 
+    @property
+    def fig(self) -> Any:
+        if self._fig is None:
+            self._fig, self._ax = plt.subplots()
+        return self._fig
+
+    @property
+    def ax(self) -> Any:
+        if self._ax is None:
+            self._fig, self._ax = plt.subplots()
+        return self._ax
+
     def _initialize_plot_settings(self) -> None:
         """Initialize default plot settings"""
         self.default_line_style = "--k"
         self.default_point_style = {'color': 'red', 's': 100}
         self.intersection_style = {'color': 'blue', 's': 80, 'label': 'Intersections'}
         self.source_style = {'color': 'orange', 's': 120, 'label': 'Source'}
+        self.line_collection_style = {'colors': 'k', 'linestyles': '--', 'linewidths': 1}
+        self.density_style = {'bins': 200, 'cmap': 'viridis', 'cmin': 1}
+        self.density_threshold = 10_000 # above this number of intersection points they are drawn as a 2D histogram
         self.intersection_points_uncertainty_style = {
             'fmt': 'o',
             'capsize': 3,
@@ -74,25 +93,57 @@ class Plotter(IPlotter):
         
         self._update_limits()
 
+    def add_lines(self, segments: ArrayLike, line_style: Optional[Dict] = None) -> None:
+        """
+        Draw many lines at once as a single LineCollection and update limits once
+
+        Args:
+            segments: (N, P, 2) array of N lines with P (x, y) points each, P=2 is enough for straight lines
+            line_style: kwargs for LineCollection
+        """
+        segments = np.asarray(segments, dtype=float)
+        if segments.size == 0:
+            return
+        self.ax.add_collection(LineCollection(segments, **(line_style or self.line_collection_style)))
+        self._update_data_arrays(segments[..., 0].ravel(), segments[..., 1].ravel())
+        self._update_limits()
+
     def _update_data_arrays(self, x_arr: ArrayLike, y_arr: ArrayLike) -> None:
-        """Update stored data arrays with new points"""
-        self.dataholder.all_x = list(np.concatenate([self.dataholder.all_x, np.array(x_arr)]))
-        self.dataholder.all_y = list(np.concatenate([self.dataholder.all_y, np.array(y_arr)]))
+        """Append new points to stored data arrays and update running limits, without copying the history"""
+        x_arr = np.asarray(x_arr, dtype=float).ravel()
+        y_arr = np.asarray(y_arr, dtype=float).ravel()
+        if x_arr.size == 0:
+            return
+        self.dataholder.all_x.extend(x_arr.tolist())
+        self.dataholder.all_y.extend(y_arr.tolist())
+        new_limits = [x_arr.min(), x_arr.max(), y_arr.min(), y_arr.max()]
+        if self._limits is None:
+            self._limits = new_limits
+        else:
+            self._limits = [min(self._limits[0], new_limits[0]), max(self._limits[1], new_limits[1]),
+                            min(self._limits[2], new_limits[2]), max(self._limits[3], new_limits[3])]
 
-    def highlight_intersection_points(self, show_uncertainties: bool = True) -> None:
-        """Plot intersection points with optional uncertainties"""
-        if not self.dataholder.intersection_points:
+    def highlight_intersection_points(self, show_uncertainties: bool = True, density: Optional[bool] = None) -> None:
+        """Plot intersection points with optional uncertainties. With density (by default above density_threshold points) they are drawn as a 2D histogram"""
+        if len(self.dataholder.intersection_points) == 0:
             return
-            
-        x, y = zip(*self.dataholder.intersection_points)
-        self.ax.scatter(x, y, **self.intersection_style)
+
+        points = np.asarray(self.dataholder.intersection_points, dtype=float).reshape(-1, 2)
+        if density is None:
+            density = len(points) > self.density_threshold
+        if density:
+            *_, image = self.ax.hist2d(points[:, 0], points[:, 1], **self.density_style)
+            self.fig.colorbar(image, ax=self.ax, label='Intersections')
+            return
+
+        self.ax.scatter(points[:, 0], points[:, 1], **self.intersection_style)
         
-        if show_uncertainties and hasattr(self.dataholder, 'u_intersection_points'):
-            u_x, u_y = zip(*self.dataholder.u_intersection_points)
+        if show_uncertainties and len(self.dataholder.u_intersection_points) > 0:
+            u_points = np.asarray(self.dataholder.u_intersection_points, dtype=float).reshape(-1, 2)
             self.ax.errorbar(
-                x, y,
-                xerr=u_x,
-                yerr=u_y,
+                points[:, 0], points[:, 1],
+                xerr=u_points[:, 0],
+                yerr=u_points[:, 1],
                 **self.intersection_points_uncertainty_style
             )
 
@@ -120,11 +171,10 @@ class Plotter(IPlotter):
 
     def _update_limits(self, padding_factor: float = 0.1) -> None:
         """Adjust axes limits to fit all data with padding"""
-        if not self.dataholder.all_x:
+        if self._limits is None:
             return
             
-        x_min, x_max = np.min(self.dataholder.all_x), np.max(self.dataholder.all_x)
-        y_min, y_max = np.min(self.dataholder.all_y), np.max(self.dataholder.all_y)
+        x_min, x_max, y_min, y_max = self._limits
         
         x_pad = padding_factor * (x_max - x_min)
         y_pad = padding_factor * (y_max - y_min)
@@ -132,8 +182,8 @@ class Plotter(IPlotter):
         self.ax.set_xlim(x_min - x_pad, x_max + x_pad)
         self.ax.set_ylim(y_min - y_pad, y_max + y_pad)
 
-    def finalize(self, title: str = "Cumulative Plot", save: bool = False, filepath: Optional[str] = None) -> None:
-        """Add finishing touches and show plot"""
+    def finalize(self, title: str = "Cumulative Plot", save: bool = False, filepath: Optional[str] = None, show: bool = True) -> None:
+        """Add finishing touches and show plot. show=False leaves the figure open without blocking, e.g. for headless batch runs"""
         self.ax.grid(True, linestyle='--', alpha=0.5)
         self.ax.set_xlabel("X")
         self.ax.set_ylabel("Y")
@@ -144,4 +194,5 @@ class Plotter(IPlotter):
             if not filepath: 
                 raise ValueError(f'can\'t save figure, because no filepath is provided: {filepath}')
             
-        plt.show()
\ No newline at end of file
+        if show:
+            plt.show()
\ No newline at end of file
@@ -0,0 +1,119 @@
+from PET_radioactive_source_localization.implementations.DataHolder import DataHolder
+from PET_radioactive_source_localization.implementations.ColumnarDataHolder import ColumnarDataHolder
+from PET_radioactive_source_localization.implementations.DetectorGeometry import DetectorGeometry
+from typing import Any, Dict, List, Optional
+import hashlib
+import os
+import tempfile
+import numpy as np
+
+class ResultCache:
+    """
+    Content-addressed disk cache of stage outputs of PET.run. A key is the hash of the stage name and of every input
+    the stage depends on, so changing k_epsilon only invalidates intersections, while changing plotting options invalidates nothing.
+    Entries are .npz files in directory. Reading an entry marks it as recently used, and the least recently used entries
+    are evicted once the directory grows over max_bytes
+    """
+    version: int = 2 # bump when stage outputs change, so stale entries are never read
+    line_inputs: List[str] = ["thetas", "detector_ids", "S_thetas", "U_thetas", "R1", "R2", "u_R1", "u_R2"]
+    line_outputs: List[str] = ["u_thetas", "points", "u_points", "all_lines_params", "u_all_lines_params"]
+    intersection_outputs: List[str] = ["intersection_points", "u_intersection_points", "source", "u_source"]
+    least_squares_outputs: List[str] = ["source", "u_source", "cov_source"]
+
+    def __init__(self, directory: str, max_bytes: int = 1 << 30) -> None:
+        if max_bytes <= 0:
+            raise ValueError(f'cache size must be positive: {max_bytes}')
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, stage: str, **inputs: Any) -> str:
+        """sha256 of the stage name and its inputs. Numbers and array-likes are hashed by their float64 values, so [(1, 2)] and [(1.0, 2.0)] match"""
+        digest = hashlib.sha256(f'{self.version}:{stage}'.encode())
+        for name in sorted(inputs):
+            value = inputs[name]
+            digest.update(f'|{name}:'.encode())
+            if value is None:
+                digest.update(b'None')
+            elif isinstance(value, str):
+                digest.update(value.encode())
+            else:
+                arr = np.ascontiguousarray(np.asarray(value, dtype=float))
+                digest.update(str(arr.shape).encode())
+                digest.update(arr.tobytes())
+        return digest.hexdigest()
+
+    def lines_key(self, dataholder: DataHolder, calculator_name: str, geometry: Optional[DetectorGeometry] = None) -> str:
+        """Key of the lines stage. A DetectorGeometry of the calculator replaces R1 and R2 as the source of the points, so it is part of the key"""
+        geometry_inputs: Dict[str, Any] = {"geometry": None}
+        if geometry is not None:
+            geometry_inputs = {"geometry": geometry.positions, "geometry_covariances": geometry.covariances, "geometry_tangents": geometry.tangents,
+                               "geometry_rings": np.concatenate([[len(angles), first, *angles] for angles, first in geometry.rings]) if geometry.rings else None}
+        return self.key("lines", calculator=calculator_name, **geometry_inputs, **{name: getattr(dataholder, name) for name in self.line_inputs})
+
+    def get(self, key: str) -> Optional[Dict[str, np.ndarray]]:
+        path = self._path(key)
+        try:
+            with np.load(path) as entry:
+                arrays = {name: entry[name] for name in entry.files}
+        except (FileNotFoundError, OSError, ValueError):
+            return None
+        os.utime(path) # mark as recently used
+        return arrays
+
+    def put(self, key: str, arrays: Dict[str, Any]) -> None:
+        """Store arrays under key (None values are skipped) and evict least recently used entries over max_bytes"""
+        arrays = {name: np.asarray(value, dtype=float) for name, value in arrays.items() if value is not None}
+        # write to a temporary file first, so concurrent runs never read a half-written entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, **arrays) #type: ignore
+            os.replace(tmp_path, self._path(key))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.evict()
+
+    def evict(self) -> None:
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".npz"):
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self) -> None:
+        for name in os.listdir(self.directory):
+            if name.endswith(".npz"):
+                os.remove(os.path.join(self.directory, name))
+
+    def collect(self, dataholder: DataHolder, attr_names: List[str]) -> Dict[str, Any]:
+        return {name: getattr(dataholder, name) for name in attr_names}
+
+    def restore(self, dataholder: DataHolder, arrays: Dict[str, np.ndarray]) -> None:
+        """Put cached arrays into the dataholder in its own format: lists of (nested) tuples, or arrays for a ColumnarDataHolder"""
+        for name, arr in arrays.items():
+            if isinstance(dataholder, ColumnarDataHolder) and name in dataholder.columns:
+                value: Any = arr
+            elif name in ("source", "u_source"):
+                value = tuple(arr.tolist())
+            elif name == "cov_source":
+                value = tuple(tuple(row) for row in arr.tolist())
+            elif arr.ndim == 3:
+                value = [tuple(tuple(point) for point in pair) for pair in arr.tolist()]
+            else:
+                value = [tuple(row) for row in arr.reshape(-1, 2).tolist()]
+            setattr(dataholder, name, value)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".npz")
@@ -0,0 +1,107 @@
+from PET_radioactive_source_localization.implementations.DataHolder import DataHolder
+from typing import Any, Dict, List, Literal, Optional
+import json
+import os
+import numpy as np
+
+class ResultWriter:
+    """
+    Writes results of a run in a single pass.
+    "json" writes one rounded JSON file, like PET.save always did.
+    "npz" writes the arrays into one .npz file, "npy" into a directory of .npy files that np.load can memory-map.
+    Both binary formats get a small JSON summary beside them (source, uncertainties, array shapes and where the arrays are),
+    and ResultWriter.load reads any of the formats back in one call
+    """
+    array_attrs: List[str] = ["intersection_points", "u_intersection_points"]
+    summary_attrs: List[str] = ["source", "u_source", "cov_source"]
+
+    def __init__(self, dataholder: DataHolder, n_digits: int = 2) -> None:
+        self.dataholder = dataholder
+        self.n_digits = n_digits
+
+    def collect(self, attr_names: List[str]) -> Dict[str, np.ndarray]:
+        """Dataholder attributes as float arrays, in the given order. Raises on attributes that are missing or None"""
+        results = {}
+        for attr_name in attr_names:
+            if not hasattr(self.dataholder, attr_name):
+                raise AttributeError(f"DataHolder has no attribute '{attr_name}'")
+            value = getattr(self.dataholder, attr_name)
+            if value is None:
+                raise ValueError(f"Cannot save None value for attribute '{attr_name}'")
+            results[attr_name] = np.asarray(value, dtype=float)
+        return results
+
+    def write(self, filepath_stem: str, attr_names: List[str], output_format: Literal["json", "npz", "npy"] = "json", merge: bool = False) -> str:
+        """
+        Write dataholder attributes at once.
+
+        Args:
+            filepath_stem: Output path without extension.
+            attr_names: Attributes to write (e.g., ["source", "intersection_points", "u_source", "u_intersection_points"]).
+            output_format: "json", "npz" or "npy", see the class docstring.
+            merge: Keep attributes already stored under filepath_stem in the same format that are not written now.
+
+        Returns:
+            Path of the written JSON file (the results, or the summary of the binary format).
+        """
+        if output_format not in ("json", "npz", "npy"):
+            raise ValueError(f'unsupported output format: {output_format}. Expected "json", "npz" or "npy"')
+        results = self.collect(attr_names)
+        json_path = filepath_stem + ".json"
+        existing = self._existing(json_path, output_format) if merge else {}
+        if output_format == "json":
+            existing.update({name: self.round(value) for name, value in results.items()})
+            self._dump(json_path, existing, indent=2)
+            return json_path
+
+        arrays = {name: value for name, value in results.items() if name not in self.summary_attrs}
+        summary: Dict[str, Any] = {name: value for name, value in existing.items() if name in self.summary_attrs}
+        summary.update({name: self.round(value) for name, value in results.items() if name in self.summary_attrs})
+        summary["format"] = output_format
+        summary["shapes"] = {**existing.get("shapes", {}), **{name: list(value.shape) for name, value in arrays.items()}}
+        if output_format == "npz":
+            if existing:
+                # an npz archive can't be appended to, so members that are kept are read and written again
+                with np.load(filepath_stem + ".npz") as kept:
+                    arrays = {**{name: kept[name] for name in kept.files if name not in arrays}, **arrays}
+            np.savez(filepath_stem + ".npz", **arrays) #type: ignore
+            summary["arrays"] = os.path.basename(filepath_stem) + ".npz"
+        elif output_format == "npy":
+            os.makedirs(filepath_stem, exist_ok=True)
+            for name, value in arrays.items():
+                np.save(os.path.join(filepath_stem, name + ".npy"), np.ascontiguousarray(value))
+            summary["arrays"] = os.path.basename(filepath_stem)
+        self._dump(json_path, summary, indent=2)
+        return json_path
+
+    def round(self, value: np.ndarray) -> Any:
+        """Round a whole array at once and convert it to nested lists for JSON"""
+        return np.round(value, self.n_digits).tolist()
+
+    @staticmethod
+    def load(json_path: str, mmap: bool = True) -> Dict[str, Any]:
+        """Load results written by write(): the JSON content, plus arrays of binary formats (memory-mapped for "npy" if mmap)"""
+        with open(json_path, 'r') as f:
+            data = json.load(f)
+        if "format" not in data:
+            return data
+        arrays_path = os.path.join(os.path.dirname(json_path), data["arrays"])
+        if data["format"] == "npz":
+            with np.load(arrays_path) as arrays:
+                data.update({name: arrays[name] for name in arrays.files})
+        else:
+            for name in data["shapes"]:
+                data[name] = np.load(os.path.join(arrays_path, name + ".npy"), mmap_mode='r' if mmap else None)
+        return data
+
+    def _existing(self, json_path: str, output_format: str) -> Dict[str, Any]:
+        """Content of a JSON file written before in output_format, empty if there is none. Results of another format are replaced, e.g. of an earlier run"""
+        if not os.path.exists(json_path) or os.path.getsize(json_path) == 0:
+            return {}
+        with open(json_path, 'r') as f:
+            data = json.load(f)
+        return data if data.get("format", "json") == output_format else {}
+
+    def _dump(self, path: str, data: Dict[str, Any], indent: Optional[int] = None) -> None:
+        with open(path, 'w') as f:
+            json.dump(data, f, indent=indent)
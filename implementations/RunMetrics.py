@@ -0,0 +1,115 @@
+from PET_radioactive_source_localization.implementations.DataHolder import DataHolder
+from PET_radioactive_source_localization.implementations.LazyImport import LazyImport
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterator, Literal, Optional
+import cProfile
+import io
+import pstats
+import sys
+import time
+import tracemalloc
+logger = LazyImport("loguru", "logger")
+
+try:
+    import resource
+except ImportError: # not available on Windows
+    resource = None
+
+@dataclass
+class RunMetrics:
+    """
+    Structured record of one PET.run: wall time of every stage, numbers of lines and of intersection pairs
+    accepted or rejected by k_epsilon, and peak memory. Stage timings are logged at INFO level as they finish.
+    capture="tracemalloc" adds peak traced memory of every stage, capture="cprofile" profiles the whole run
+    and keeps the top of its cumulative-time listing in profile
+    """
+    filename: str = ""
+    capture: Optional[Literal["cprofile", "tracemalloc"]] = None
+    stages: Dict[str, Dict[str, float]] = field(default_factory=dict)
+    n_lines: int = 0
+    n_pairs: Optional[int] = 0 # pair counts are None for estimators that don't intersect lines
+    n_accepted_pairs: Optional[int] = 0
+    n_rejected_pairs: Optional[int] = 0
+    peak_rss_bytes: Optional[int] = None # peak resident memory of the process, where the platform reports it
+    profile: Optional[str] = None
+    _profiler: Optional[cProfile.Profile] = field(default=None, repr=False)
+    _stop_tracemalloc: bool = field(default=False, repr=False)
+
+    @property
+    def total_seconds(self) -> float:
+        return sum(stage["seconds"] for stage in self.stages.values())
+
+    def start(self) -> None:
+        if self.capture not in (None, "cprofile", "tracemalloc"):
+            raise ValueError(f'unknown capture mode: {self.capture}. Expected "cprofile", "tracemalloc" or None')
+        if self.capture == "cprofile":
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        elif self.capture == "tracemalloc" and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._stop_tracemalloc = True
+
+    def stop(self, n_profile_lines: int = 25) -> None:
+        if self._profiler is not None:
+            self._profiler.disable()
+            stream = io.StringIO()
+            pstats.Stats(self._profiler, stream=stream).sort_stats("cumulative").print_stats(n_profile_lines)
+            self.profile = stream.getvalue()
+            self._profiler = None
+            logger.opt(lazy=True).debug("profile of {}:\n{}", lambda: self.filename, lambda: self.profile)
+        if self._stop_tracemalloc:
+            tracemalloc.stop()
+            self._stop_tracemalloc = False
+        if resource is not None:
+            # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+            maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            self.peak_rss_bytes = maxrss if sys.platform == "darwin" else maxrss*1024
+        logger.info(self.summary())
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """Time the body as stage name, and measure its peak traced memory when tracemalloc is running"""
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.reset_peak()
+            start_memory = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            record: Dict[str, float] = {"seconds": time.perf_counter() - start}
+            if tracing:
+                record["peak_bytes"] = max(tracemalloc.get_traced_memory()[1] - start_memory, 0)
+            self.stages[name] = record
+            logger.info(f'{self.filename} {name}: {record["seconds"]:.4f}s' + (f', peak {record["peak_bytes"]/2**20:.1f} MiB' if tracing else ''))
+
+    def count_lines(self, dataholder: DataHolder) -> None:
+        self.n_lines = len(dataholder.all_lines_params)
+        self.n_pairs = self.n_lines*(self.n_lines-1)//2
+
+    def count_pairs(self, dataholder: DataHolder, n_accepted: Optional[int] = None) -> None:
+        """
+        Every accepted pair of lines gives one intersection point, the others were rejected by k_epsilon.
+        n_accepted is given by estimators that don't keep the intersection points, e.g. ShardedIntersector
+        """
+        self.n_accepted_pairs = len(dataholder.intersection_points) if n_accepted is None else n_accepted
+        self.n_rejected_pairs = self.n_pairs - self.n_accepted_pairs
+
+    def skip_pairs(self) -> None:
+        """The estimator doesn't intersect lines, e.g. least squares, so pair counts don't apply"""
+        self.n_pairs = self.n_accepted_pairs = self.n_rejected_pairs = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "filename": self.filename, "capture": self.capture, "stages": self.stages, "total_seconds": self.total_seconds,
+            "n_lines": self.n_lines, "n_pairs": self.n_pairs, "n_accepted_pairs": self.n_accepted_pairs,
+            "n_rejected_pairs": self.n_rejected_pairs, "peak_rss_bytes": self.peak_rss_bytes, "profile": self.profile,
+        }
+
+    def summary(self) -> str:
+        slowest = max(self.stages, key=lambda name: self.stages[name]["seconds"]) if self.stages else None
+        return (f'{self.filename}: {self.total_seconds:.4f}s in {len(self.stages)} stages (slowest: {slowest}), '
+                f'{self.n_lines} lines, '
+                + (f'{self.n_accepted_pairs}/{self.n_pairs} pairs accepted, {self.n_rejected_pairs} rejected by k_epsilon' if self.n_pairs is not None else 'no pairs intersected')
+                + (f', peak RSS {self.peak_rss_bytes/2**20:.1f} MiB' if self.peak_rss_bytes else ''))
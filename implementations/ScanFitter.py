@@ -0,0 +1,165 @@
+from PET_radioactive_source_localization.implementations.DataHolder import DataHolder
+from PET_radioactive_source_localization.implementations.LazyImport import LazyImport
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import List, Tuple, Literal, Optional
+import os
+import numpy as np
+curve_fit = LazyImport("scipy.optimize", "curve_fit")
+logger = LazyImport("loguru", "logger")
+
+@dataclass
+class Scan:
+    """Counts of coincidences registered at every angle of the rotated detector, while the fixed one stays at theta1"""
+    theta1: float
+    angles: np.ndarray
+    counts: np.ndarray
+
+@dataclass
+class ScanFit:
+    """
+    Result of fitting a sum of Gaussians on a constant background to a scan. Peaks are sorted from the strongest.
+    u_centers are standard errors of the fitted centres, which are what S_thetas hold
+    """
+    theta1: float
+    centers: List[float] = field(default_factory=list)
+    u_centers: List[float] = field(default_factory=list)
+    widths: List[float] = field(default_factory=list)
+    amplitudes: List[float] = field(default_factory=list)
+    background: float = 0.0
+    chi_sq: float = np.nan
+
+def gaussians(x: np.ndarray, background: float, *params: float) -> np.ndarray:
+    """Constant background plus Gaussians, params are (amplitude, center, width) of each peak"""
+    y = np.full(np.shape(x), background, dtype=float)
+    for amplitude, center, width in zip(params[0::3], params[1::3], params[2::3]):
+        y = y + amplitude*np.exp(-(x-center)**2/(2*width**2))
+    return y
+
+def _fit_scan(scan: Scan, p0: np.ndarray) -> ScanFit:
+    """Fit a single scan with scipy, starting from p0 = (background, amplitude, center, width, ...)"""
+    sigma = np.sqrt(np.maximum(scan.counts, 1))
+    params, cov = curve_fit(gaussians, scan.angles, scan.counts, p0=p0, sigma=sigma, absolute_sigma=True, maxfev=10000)
+    errors = np.sqrt(np.diag(cov))
+    chi_sq = float(np.sum(((scan.counts - gaussians(scan.angles, *params))/sigma)**2))
+    peaks = sorted(zip(params[1::3], params[2::3], np.abs(params[3::3]), errors[2::3]), key=lambda peak: -peak[0])
+    return ScanFit(theta1=scan.theta1,
+                   centers=[float(center) for _, center, _, _ in peaks],
+                   u_centers=[float(u_center) for _, _, _, u_center in peaks],
+                   widths=[float(width) for _, _, width, _ in peaks],
+                   amplitudes=[float(amplitude) for amplitude, _, _, _ in peaks],
+                   background=float(params[0]), chi_sq=chi_sq)
+
+class ScanFitter:
+    """
+    Replaces fitting Gaussians to counts-vs-angle scans by hand. Raw scans are read from CSV or NPZ files
+    with columns theta1, theta2, counts (one scan per value of theta1), initial guesses for all scans are computed at once
+    on a padded array, and the fits run in a process pool. Fitted centres and their uncertainties go straight into
+    DataHolder.thetas and S_thetas
+    """
+    def __init__(self, n_workers: Optional[int] = None) -> None:
+        self.n_workers = n_workers
+
+    def load_scans(self, path: str) -> List[Scan]:
+        """Read scans from a .csv file with header theta1,theta2,counts or an .npz file with arrays of those names"""
+        extension = os.path.splitext(path)[1].lower()
+        if extension == ".csv":
+            table = np.genfromtxt(path, delimiter=",", names=True)
+            theta1, theta2, counts = table["theta1"], table["theta2"], table["counts"]
+        elif extension == ".npz":
+            with np.load(path) as table:
+                theta1, theta2, counts = table["theta1"], table["theta2"], table["counts"]
+        else:
+            raise ValueError(f'unsupported scan file format: {path}. Expected .csv or .npz')
+        scans = []
+        for value in np.unique(theta1):
+            members = theta1 == value
+            order = np.argsort(theta2[members])
+            scans.append(Scan(theta1=float(value), angles=theta2[members][order].astype(float), counts=counts[members][order].astype(float)))
+        return scans
+
+    def initial_guesses(self, scans: List[Scan], n_peaks: int) -> np.ndarray:
+        """(n_scans, 1+3*n_peaks) starting parameters: background, then amplitude, center and width of every peak"""
+        length = max(len(scan.angles) for scan in scans)
+        angles = np.full((len(scans), length), np.nan)
+        counts = np.full((len(scans), length), np.nan)
+        for row, scan in enumerate(scans):
+            angles[row, :len(scan.angles)] = scan.angles
+            counts[row, :len(scan.counts)] = scan.counts
+        rows = np.arange(len(scans))
+        background = np.nanmin(counts, axis=1)
+        residual = np.nan_to_num(counts - background[:, None], nan=-np.inf)
+        guesses = [background]
+        for _ in range(n_peaks):
+            peak = np.argmax(residual, axis=1)
+            amplitude = residual[rows, peak]
+            center = angles[rows, peak]
+            # width from the range of angles above half of the peak
+            above_half = residual >= amplitude[:, None]/2
+            span = np.nanmax(np.where(above_half, angles, -np.inf), axis=1) - np.nanmin(np.where(above_half, angles, np.inf), axis=1)
+            step = np.nanmedian(np.diff(angles, axis=1), axis=1)
+            width = np.maximum(span/2.355, step)
+            if n_peaks > 1:
+                # don't let the second peak start inside the first one
+                width = np.maximum(width/n_peaks, step)
+            guesses.extend([amplitude, center, width])
+            residual = residual - amplitude[:, None]*np.exp(-(np.nan_to_num(angles)-center[:, None])**2/(2*width[:, None]**2))
+        return np.column_stack(guesses)
+
+    def fit(self, scans: List[Scan], n_peaks: Literal[1, 2, "auto"] = "auto") -> List[ScanFit]:
+        """
+        Fit all scans. With n_peaks="auto" both one and two Gaussians are fitted and the model with lower BIC is kept,
+        so double-peak scans get a two-Gaussian fit
+        """
+        if not scans:
+            raise ValueError(f'no scans to fit: {scans}')
+        if n_peaks != "auto":
+            return self._fit_all(scans, n_peaks)
+        single, double = self._fit_all(scans, 1), self._fit_all(scans, 2)
+        fits = []
+        for scan, one, two in zip(scans, single, double):
+            n_points = len(scan.angles)
+            bic_one = one.chi_sq + 4*np.log(n_points) if one.centers else np.inf
+            bic_two = two.chi_sq + 7*np.log(n_points) if two.centers else np.inf
+            fits.append(two if bic_two < bic_one else one)
+        return fits
+
+    def fill_dataholder(self, dataholder: DataHolder, fits: List[ScanFit], peak: Literal["stronger", "weaker"] = "stronger") -> DataHolder:
+        """Put centres of the stronger (or weaker) peak of every fit into dataholder.thetas and their uncertainties into S_thetas, see to_thetas"""
+        thetas, S_thetas = self.to_thetas(fits, peak=peak)
+        dataholder.thetas = thetas
+        dataholder.S_thetas = S_thetas
+        return dataholder
+
+    def to_thetas(self, fits: List[ScanFit], peak: Literal["stronger", "weaker"] = "stronger") -> Tuple[List[Tuple[float, float]], List[Tuple[float, float]]]:
+        """
+        thetas and S_thetas in the format of lab_data, the fixed detector angle has no statistical uncertainty.
+        Failed fits are left out, and so are single-peak fits for peak="weaker", because their only peak belongs to the stronger source
+        """
+        index = 0 if peak == "stronger" else -1
+        fits = [fit for fit in fits if fit.centers]
+        if peak == "weaker":
+            for fit in fits:
+                if len(fit.centers) < 2:
+                    logger.warning(f'scan with theta1={fit.theta1} has a single peak, it has no weaker peak and is left out')
+            fits = [fit for fit in fits if len(fit.centers) > 1]
+        thetas = [(fit.theta1, fit.centers[index]) for fit in fits]
+        S_thetas = [(0.0, fit.u_centers[index]) for fit in fits]
+        return thetas, S_thetas
+
+    def _fit_all(self, scans: List[Scan], n_peaks: int) -> List[ScanFit]:
+        p0 = self.initial_guesses(scans, n_peaks)
+        if self.n_workers == 1:
+            results = [self._try_fit(scan, guess) for scan, guess in zip(scans, p0)]
+        else:
+            with ProcessPoolExecutor(max_workers=self.n_workers) as executor:
+                results = list(executor.map(ScanFitter._try_fit, scans, p0))
+        return results
+
+    @staticmethod
+    def _try_fit(scan: Scan, p0: np.ndarray) -> ScanFit:
+        try:
+            return _fit_scan(scan, p0)
+        except (RuntimeError, ValueError) as e:
+            logger.warning(f'failed to fit scan with theta1={scan.theta1}: {e}')
+            return ScanFit(theta1=scan.theta1)
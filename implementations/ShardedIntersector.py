@@ -0,0 +1,152 @@
+from PET_radioactive_source_localization.implementations.DataHolder import DataHolder
+from PET_radioactive_source_localization.implementations.UncertaintyPropagator import UncertaintyPropagator
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from multiprocessing import shared_memory
+from typing import List, Optional, Tuple
+import os
+import numpy as np
+
+@dataclass
+class IntersectionSums:
+    """
+    Partial results of the intersections of a set of line pairs: numbers of pairs and of pairs accepted by k_epsilon,
+    sums of the accepted intersection points and of their squared uncertainties, and an optional (n_bins, n_bins)
+    histogram of the points over extent (x_min, x_max, y_min, y_max). Sums of disjoint sets of pairs are merged with +
+    """
+    n_pairs: int
+    n_accepted: int
+    sum_points: np.ndarray
+    sum_u_sq: np.ndarray
+    histogram: Optional[np.ndarray] = None
+
+    def __add__(self, other: "IntersectionSums") -> "IntersectionSums":
+        histogram = self.histogram if other.histogram is None else other.histogram if self.histogram is None else self.histogram + other.histogram
+        return IntersectionSums(self.n_pairs + other.n_pairs, self.n_accepted + other.n_accepted, self.sum_points + other.sum_points,
+                                self.sum_u_sq + other.sum_u_sq, histogram)
+
+    @property
+    def source(self) -> np.ndarray:
+        """Mean of the accepted intersection points, like VectorizedLineCalculator.find_source"""
+        return self.sum_points/self.n_accepted
+
+    @property
+    def u_source(self) -> np.ndarray:
+        return np.sqrt(self.sum_u_sq)/self.n_accepted
+
+def _reduce_tile(lines: np.ndarray, u_lines: Optional[np.ndarray], tile: Tuple[int, int, int, int], k_epsilon: float,
+                 n_bins: int, extent: Tuple[float, float, float, float]) -> IntersectionSums:
+    """
+    Intersect lines[i_start:i_stop] with lines[j_start:j_stop] for i < j and reduce the accepted points to IntersectionSums.
+    Tiles on the diagonal (i_start == j_start) only take their upper triangle
+    """
+    i_start, i_stop, j_start, j_stop = tile
+    if i_start == j_start:
+        i, j = np.triu_indices(i_stop-i_start, k=1)
+        i, j = i + i_start, j + j_start
+    else:
+        i, j = np.divmod(np.arange((i_stop-i_start)*(j_stop-j_start)), j_stop-j_start)
+        i, j = i + i_start, j + j_start
+    n_pairs = len(i)
+    k_i, k_j = lines[i, 0], lines[j, 0]
+    accepted = np.abs(k_j-k_i) > k_epsilon
+    i, j, k_i, k_j = i[accepted], j[accepted], k_i[accepted], k_j[accepted]
+    b_i, b_j = lines[i, 1], lines[j, 1]
+    x = (b_j-b_i)/(k_i-k_j)
+    y = k_i*x+b_i
+    sum_u_sq = np.zeros(2)
+    if u_lines is not None and len(i):
+        propagator = UncertaintyPropagator()
+        (u_k_i, u_b_i), (u_k_j, u_b_j) = u_lines[i].T, u_lines[j].T
+        u_x = propagator.propagate("intersection_x", (k_i, b_i, k_j, b_j), (u_k_i, u_b_i, u_k_j, u_b_j))
+        u_y = propagator.propagate("intersection_y", (k_i, b_i, x), (u_k_i, u_b_i))
+        sum_u_sq = np.array([np.sum(u_x**2), np.sum(u_y**2)])
+    histogram = None
+    if n_bins:
+        histogram = np.histogram2d(x, y, bins=n_bins, range=(extent[:2], extent[2:]))[0]
+    return IntersectionSums(n_pairs=n_pairs, n_accepted=len(x), sum_points=np.array([x.sum(), y.sum()]), sum_u_sq=sum_u_sq, histogram=histogram)
+
+# lines of the parent, attached from shared memory once per worker process
+_shared: dict = {}
+
+def _attach(name: str, shape: Tuple[int, ...], has_u: bool) -> None:
+    memory = shared_memory.SharedMemory(name=name)
+    table = np.ndarray(shape, dtype=float, buffer=memory.buf)
+    _shared.update(memory=memory, lines=table[:, :2], u_lines=table[:, 2:] if has_u else None)
+
+def _reduce_shared_tile(tile: Tuple[int, int, int, int], k_epsilon: float, n_bins: int, extent: Tuple[float, float, float, float]) -> IntersectionSums:
+    return _reduce_tile(_shared["lines"], _shared["u_lines"], tile, k_epsilon, n_bins, extent)
+
+class ShardedIntersector:
+    """
+    All-pairs intersection for more lines than the (M, 2) array of intersection points fits in memory.
+    The upper triangle of the (N, N) pair space is split into tile_size x tile_size tiles, every tile is reduced
+    to IntersectionSums in a worker and only those sums are returned and merged, so memory is O(N + tile_size^2)
+    regardless of the number of pairs. Lines and their uncertainties are put into one shared memory block that the
+    workers map instead of receiving a pickled copy per task. Tiles are sent biggest first, so the pool ends on the
+    half-sized diagonal tiles and all workers stay busy. With n_workers 1, tiles are reduced in this process.
+    find_source gives the same source and u_source as VectorizedLineCalculator.find_all_intersection_points + find_source,
+    without ever filling dataholder.intersection_points
+    """
+    def __init__(self, dataholder: DataHolder, tile_size: int = 2048, n_workers: Optional[int] = None, n_bins: int = 0) -> None:
+        if tile_size < 1:
+            raise ValueError(f'tile size must be positive: {tile_size}')
+        self.dataholder = dataholder
+        self.tile_size = tile_size
+        self.n_workers = n_workers if n_workers is not None else os.cpu_count() or 1
+        self.n_bins = n_bins
+        self.sums: Optional[IntersectionSums] = None
+
+    @property
+    def extent(self) -> Tuple[float, float, float, float]:
+        """(x_min, x_max, y_min, y_max) of the histogram, the square around the circle of radius R2"""
+        radius = float(self.dataholder.R2)
+        return (-radius, radius, -radius, radius)
+
+    def tiles(self, n_lines: int) -> List[Tuple[int, int, int, int]]:
+        """(i_start, i_stop, j_start, j_stop) of the tiles covering all pairs i < j, biggest first"""
+        starts = range(0, n_lines, self.tile_size)
+        tiles = [(i, min(i+self.tile_size, n_lines), j, min(j+self.tile_size, n_lines)) for i in starts for j in starts if i <= j]
+        return sorted(tiles, key=lambda tile: (tile[1]-tile[0])*(tile[3]-tile[2])/(2 if tile[0] == tile[2] else 1), reverse=True)
+
+    def reduce(self, lines: np.ndarray, u_lines: Optional[np.ndarray] = None, k_epsilon: float = 0.2) -> IntersectionSums:
+        """IntersectionSums of all pairs of (N, 2) lines, with uncertainties if (N, 2) u_lines are given"""
+        lines = np.asarray(lines, dtype=float).reshape(-1, 2)
+        u_lines = None if u_lines is None else np.asarray(u_lines, dtype=float).reshape(-1, 2)
+        tiles = self.tiles(len(lines))
+        sums = IntersectionSums(n_pairs=0, n_accepted=0, sum_points=np.zeros(2), sum_u_sq=np.zeros(2),
+                                histogram=np.zeros((self.n_bins, self.n_bins)) if self.n_bins else None)
+        if self.n_workers == 1 or len(tiles) == 1:
+            for tile in tiles:
+                sums = sums + _reduce_tile(lines, u_lines, tile, k_epsilon, self.n_bins, self.extent)
+            return sums
+
+        table = lines if u_lines is None else np.hstack((lines, u_lines))
+        memory = shared_memory.SharedMemory(create=True, size=max(table.nbytes, 1))
+        try:
+            np.ndarray(table.shape, dtype=float, buffer=memory.buf)[:] = table
+            with ProcessPoolExecutor(max_workers=self.n_workers, initializer=_attach, initargs=(memory.name, table.shape, u_lines is not None)) as executor:
+                n_tiles = len(tiles)
+                for partial in executor.map(_reduce_shared_tile, tiles, [k_epsilon]*n_tiles, [self.n_bins]*n_tiles, [self.extent]*n_tiles):
+                    sums = sums + partial
+        finally:
+            memory.close()
+            memory.unlink()
+        return sums
+
+    def find_source(self, k_epsilon: float = 0.2, find_u: bool = False) -> Tuple[float, float]:
+        """Reduce all pairs of dataholder.all_lines_params and put the mean of the accepted intersection points into dataholder.source"""
+        if len(self.dataholder.all_lines_params) == 0:
+            raise ValueError(f'can\'t find intersection point of all lines, because all_lines_params is empty: {self.dataholder.all_lines_params}')
+        u_lines = None
+        if find_u:
+            if len(self.dataholder.u_all_lines_params) == 0:
+                raise ValueError(f'lines params is an empty list: {self.dataholder.u_all_lines_params}')
+            u_lines = self.dataholder.u_all_lines_params
+        self.sums = self.reduce(self.dataholder.all_lines_params, u_lines, k_epsilon=k_epsilon) #type: ignore
+        if self.sums.n_accepted == 0:
+            raise ValueError(f"Can\'t find source, because no pair of lines differs in slope by more than k_epsilon: {k_epsilon}")
+        self.dataholder.source = tuple(self.sums.source.tolist())
+        if find_u:
+            self.dataholder.u_source = tuple(self.sums.u_source.tolist())
+        return self.dataholder.source
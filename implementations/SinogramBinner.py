@@ -0,0 +1,107 @@
+from PET_radioactive_source_localization.implementations.DataHolder import DataHolder
+from PET_radioactive_source_localization.implementations.ColumnarDataHolder import ColumnarDataHolder
+from typing import Any, Optional, Tuple
+import numpy as np
+
+class SinogramBinner:
+    """
+    Compresses many lines of response into few weighted lines. Every line is described by its normal angle phi in [0, 180)
+    degrees and its signed offset s from the centre, x*cos(phi) + y*sin(phi) = s, and counted into a (phi, s) histogram,
+    the sinogram. Every occupied bin becomes one line through the mean (phi, s) of its events, with the mean squared
+    uncertainty of its events and their number as weight in dataholder.line_weights, so the estimators treat it
+    like that many copies of one line. Stages after binning cost O(bins) or O(bins^2) instead of O(events).
+
+    Default bin widths are resolution times the uncertainties of a line: U_thetas for the angle, and for the offset
+    the larger of u_R1, u_R2 and the shift of an endpoint moved along its ring by U_thetas
+    """
+    def __init__(self, dataholder: DataHolder, angle_width: Optional[float] = None, offset_width: Optional[float] = None, resolution: float = 0.5) -> None:
+        self.dataholder = dataholder
+        self.angle_width = angle_width if angle_width is not None else resolution*dataholder.U_thetas
+        self.offset_width = offset_width if offset_width is not None else resolution*max(
+            dataholder.u_R1, dataholder.u_R2, max(dataholder.R1, dataholder.R2)*np.deg2rad(dataholder.U_thetas))
+        if self.angle_width <= 0 or self.offset_width <= 0:
+            raise ValueError(f'bin widths must be positive, set them explicitly for data without uncertainties: {self.angle_width}, {self.offset_width}')
+        self.angles: Optional[np.ndarray] = None # mean (phi, s) and number of events of every occupied bin
+        self.offsets: Optional[np.ndarray] = None
+        self.counts: Optional[np.ndarray] = None
+        self.bin_indices: Optional[np.ndarray] = None # (B, 2) angle and offset indices of the occupied bins
+
+    def sinogram_coordinates(self, points: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """(N,) normal angles in degrees within [0, 180) and (N,) signed offsets of the lines through (N, 2, 2) point pairs"""
+        d = points[:, 1] - points[:, 0]
+        phi = np.arctan2(d[:, 0], -d[:, 1]) # angle of the normal (-dy, dx)
+        phi = np.mod(np.degrees(phi), 360)
+        phi = np.where(phi >= 180, phi-180, phi)
+        radians = np.deg2rad(phi)
+        offsets = points[:, 0, 0]*np.cos(radians) + points[:, 0, 1]*np.sin(radians)
+        return phi, offsets
+
+    def lines_of(self, angles: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+        """(B, 2) (k, b) of the lines x*cos(phi) + y*sin(phi) = s"""
+        radians = np.deg2rad(angles)
+        return np.column_stack((-np.cos(radians)/np.sin(radians), offsets/np.sin(radians)))
+
+    def bin(self, points: np.ndarray) -> np.ndarray:
+        """Bin (N, 2, 2) point pairs and return the (N,) index of the occupied bin of every line, bins ordered by their first line"""
+        angles, offsets = self.sinogram_coordinates(points)
+        angle_bins = np.floor(angles/self.angle_width).astype(np.int64)
+        offset_bins = np.floor(offsets/self.offset_width).astype(np.int64)
+        offset_min = offset_bins.min() if len(offset_bins) else 0
+        stride = int(offset_bins.max() - offset_min) + 1 if len(offset_bins) else 1
+        keys, first, inverse = np.unique(angle_bins*stride + (offset_bins-offset_min), return_index=True, return_inverse=True)
+        # number bins in order of their first event, so bins of single events keep the order of the lines
+        order = np.argsort(first, kind="stable")
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        keys, inverse = keys[order], rank[inverse.reshape(-1)]
+        self.counts = np.bincount(inverse).astype(float)
+        self.angles = np.bincount(inverse, angles)/self.counts
+        self.offsets = np.bincount(inverse, offsets)/self.counts
+        self.bin_indices = np.column_stack((keys//stride, keys % stride + offset_min))
+        return inverse
+
+    def bin_lines(self, find_u: bool = True) -> int:
+        """
+        Replace points, all_lines_params and u_all_lines_params of the dataholder by one entry per occupied bin,
+        and set line_weights to the numbers of events in the bins. Returns the number of bins
+        """
+        if len(self.dataholder.points) == 0:
+            raise ValueError(f'can\'t bin lines, because points is empty: {self.dataholder.points}')
+        points = np.asarray(self.dataholder.points, dtype=float).reshape(-1, 2, 2)
+        inverse = self.bin(points)
+        counts = self.counts
+        assert counts is not None and self.angles is not None and self.offsets is not None
+        binned_points = np.stack([np.column_stack((np.bincount(inverse, points[:, end, 0]), np.bincount(inverse, points[:, end, 1]))) for end in (0, 1)], axis=1)/counts[:, None, None]
+        self._set("points", binned_points)
+        self._set("all_lines_params", self.lines_of(self.angles, self.offsets))
+        if find_u:
+            if len(self.dataholder.u_all_lines_params) == 0:
+                raise ValueError(f'lines params is an empty list: {self.dataholder.u_all_lines_params}')
+            u_lines = np.asarray(self.dataholder.u_all_lines_params, dtype=float).reshape(-1, 2)
+            mean_sq = np.column_stack((np.bincount(inverse, u_lines[:, 0]**2), np.bincount(inverse, u_lines[:, 1]**2)))/counts[:, None]
+            self._set("u_all_lines_params", np.sqrt(mean_sq))
+        self._set("line_weights", counts)
+        return len(counts)
+
+    def sinogram(self) -> Tuple[np.ndarray, Tuple[float, float, float, float]]:
+        """Dense (n_angle_bins, n_offset_bins) histogram of event counts and its extent (phi_min, phi_max, s_min, s_max)"""
+        if self.bin_indices is None or self.counts is None:
+            raise ValueError(f'nothing is binned yet: {self.bin_indices}')
+        low = self.bin_indices.min(axis=0)
+        shape = tuple(self.bin_indices.max(axis=0) - low + 1)
+        histogram = np.zeros(shape)
+        histogram[self.bin_indices[:, 0]-low[0], self.bin_indices[:, 1]-low[1]] = self.counts
+        high = self.bin_indices.max(axis=0) + 1
+        return histogram, (low[0]*self.angle_width, high[0]*self.angle_width, low[1]*self.offset_width, high[1]*self.offset_width)
+
+    def _set(self, attr_name: str, arr: np.ndarray) -> None:
+        """Write arr in the format of the dataholder, like VectorizedLineCalculator does"""
+        value: Any = arr
+        if not isinstance(self.dataholder, ColumnarDataHolder):
+            if arr.ndim == 1:
+                value = arr.tolist()
+            elif arr.ndim == 3:
+                value = [tuple(tuple(point) for point in pair) for pair in arr.tolist()]
+            else:
+                value = [tuple(row) for row in arr.tolist()]
+        setattr(self.dataholder, attr_name, value)
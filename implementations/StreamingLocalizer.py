@@ -0,0 +1,81 @@
+from PET_radioactive_source_localization.implementations.DataHolder import DataHolder
+from PET_radioactive_source_localization.implementations.VectorizedLineCalculator import VectorizedLineCalculator
+from PET_radioactive_source_localization.implementations.LeastSquaresEstimator import LeastSquaresEstimator
+from numpy.typing import ArrayLike
+from typing import Tuple, Optional
+import numpy as np
+
+class StreamingLocalizer:
+    """
+    Incremental localization for data that is still being acquired. Coincidence lines are accepted one at a time or in chunks,
+    turned into (k, b) and their uncertainties with VectorizedLineCalculator, and folded into the constant-size
+    statistics vector of LeastSquaresEstimator. Nothing is appended to the dataholder lists, so memory stays flat;
+    only dataholder.source, u_source and cov_source are updated after every chunk.
+    The dataholder provides the geometry: R1, R2, U_thetas, u_R1, u_R2
+    """
+    def __init__(self, dataholder: DataHolder, reference_point: Tuple[float, float] = (0.0, 0.0)) -> None:
+        self.dataholder = dataholder
+        self.calculator = VectorizedLineCalculator(dataholder)
+        self.estimator = LeastSquaresEstimator(dataholder, reference_point=reference_point)
+        self.statistics = np.zeros(len(self.estimator.statistics_fields))
+
+    @property
+    def n_lines(self) -> int:
+        return int(self.statistics[0])
+
+    def reset(self) -> None:
+        self.statistics = np.zeros(len(self.estimator.statistics_fields))
+
+    def add_lines(self, thetas: ArrayLike, S_thetas: Optional[ArrayLike] = None) -> Optional[Tuple[float, float]]:
+        """
+        Fold new coincidence lines into the running estimate.
+
+        Args:
+            thetas: One (theta1, theta2) pair or an (N, 2) chunk of them, in degrees.
+            S_thetas: Statistical uncertainties of thetas in the same shape. Only U_thetas is used if not provided.
+
+        Returns:
+            Up-to-date source estimate, or None while there are not enough lines to find it.
+        """
+        return self.add_statistics(self.line_statistics(thetas, S_thetas))
+
+    def line_statistics(self, thetas: ArrayLike, S_thetas: Optional[ArrayLike] = None) -> np.ndarray:
+        """
+        Statistics vector of a chunk of lines, without touching the running estimate. Only reads the geometry,
+        so chunks can be turned into statistics concurrently and folded in with add_statistics afterwards
+        """
+        thetas = np.asarray(thetas, dtype=float).reshape(-1, 2)
+        if len(thetas) == 0:
+            return np.zeros(len(self.estimator.statistics_fields))
+        if S_thetas is None:
+            u_thetas = np.full(thetas.shape, self.dataholder.U_thetas, dtype=float)
+        else:
+            S_thetas = np.asarray(S_thetas, dtype=float).reshape(-1, 2)
+            if S_thetas.shape != thetas.shape:
+                raise ValueError(f'shapes of thetas and S_thetas don\'t match: {thetas.shape}, {S_thetas.shape}')
+            u_thetas = np.hypot(S_thetas, self.dataholder.U_thetas)
+
+        points = self.calculator.cartesian_from_polar(thetas, self.dataholder.R1, self.dataholder.R2)
+        lines = self.calculator.line_params(points)
+        return self.estimator.line_statistics(lines, weights=self.estimator.distance_weights(points, u_thetas))
+
+    def add_statistics(self, statistics: np.ndarray) -> Optional[Tuple[float, float]]:
+        """Fold a statistics vector from line_statistics into the running estimate"""
+        if statistics[0] == 0:
+            return self.dataholder.source
+        self.statistics += statistics
+        return self._update_estimate()
+
+    def estimate(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Current source and its 2x2 covariance matrix"""
+        return self.estimator.solve(self.statistics, weighted=True)
+
+    def _update_estimate(self) -> Optional[Tuple[float, float]]:
+        try:
+            source, cov = self.estimate()
+        except ValueError:
+            return None
+        self.dataholder.source = (float(source[0]), float(source[1]))
+        self.dataholder.cov_source = (tuple(cov[0].tolist()), tuple(cov[1].tolist()))
+        self.dataholder.u_source = tuple(np.sqrt(np.diag(cov)).tolist())
+        return self.dataholder.source
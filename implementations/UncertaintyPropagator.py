@@ -0,0 +1,55 @@
+from PET_radioactive_source_localization.implementations.LazyImport import LazyImport
+from typing import Callable, Dict, List, Sequence, Tuple
+import numpy as np
+from numpy.typing import ArrayLike
+anp = LazyImport("autograd.numpy") # autograd is only imported when the first jacobian is derived
+elementwise_grad = LazyImport("autograd", "elementwise_grad")
+
+class UncertaintyPropagator:
+    """
+    Linear error propagation u_f = sqrt(sum((df/dx_i * u_x_i)^2)) for the formulas used by the calculators.
+    The partial derivatives of every formula are derived with autograd only once and cached on the class,
+    afterwards they are evaluated over whole arrays of inputs instead of tracing a new lambda per value.
+
+    Each formula is registered as (f, n_differentiated): f takes n_differentiated variables followed by
+    optional constants, which take part in the evaluation, but are not differentiated
+    """
+    formulas: Dict[str, Tuple[Callable, int]] = {
+        "polar_x": (lambda r, theta: r*anp.cos(theta*np.pi/180), 2),
+        "polar_y": (lambda r, theta: r*anp.sin(theta*np.pi/180), 2),
+        "line_k": (lambda x1, y1, x2, y2: (y2-y1)/(x2-x1), 4),
+        "line_b": (lambda x1, y1, x2, y2, k: (y1-k*x1)/2 + (y2-k*x2)/2, 4), # k is held fixed, like in LineCalculator.find_line_params
+        "intersection_x": (lambda k1, b1, k2, b2: (b2-b1)/(k1-k2), 4),
+        "intersection_y": (lambda k1, b1, x: k1*x+b1, 2), # x is held fixed, like in LineCalculator.find_intersection_point_of_two_lines
+    }
+    _jacobians: Dict[str, List[Callable]] = {}
+
+    def jacobian(self, formula: str) -> List[Callable]:
+        """Get elementwise partial derivatives of a registered formula, deriving them on first use"""
+        if formula not in self.formulas:
+            raise ValueError(f'unknown formula: {formula}. Known formulas: {list(self.formulas)}')
+        if formula not in self._jacobians:
+            f, n_differentiated = self.formulas[formula]
+            self._jacobians[formula] = [elementwise_grad(f, i) for i in range(n_differentiated)]
+        return self._jacobians[formula]
+
+    def propagate(self, formula: str, vars: Sequence[ArrayLike], u_vars: Sequence[ArrayLike]) -> np.ndarray:
+        """
+        Computes uncertainty of a registered formula for whole arrays of inputs.
+
+        Args:
+            formula: Name of the formula (e.g., "polar_x").
+            vars: Values of all formula arguments, differentiated variables first, then constants. Arrays and scalars are broadcast together.
+            u_vars: Uncertainties of the differentiated variables, in the same order.
+
+        Returns:
+            Array of propagated uncertainties with the broadcast shape of vars.
+        """
+        partials = self.jacobian(formula)
+        if len(u_vars) != len(partials):
+            raise ValueError(f'formula {formula} differentiates {len(partials)} variables, meanwhile {len(u_vars)} uncertainties provided')
+        vars = np.broadcast_arrays(*[np.asarray(var, dtype=float) for var in vars])
+        sum_sq = np.zeros(vars[0].shape)
+        for df_dxi, u_xi in zip(partials, u_vars):
+            sum_sq += (df_dxi(*vars) * u_xi) ** 2
+        return np.sqrt(sum_sq)
@@ -0,0 +1,419 @@
+from PET_radioactive_source_localization.implementations.LineCalculator import LineCalculator
+from PET_radioactive_source_localization.implementations.DataHolder import DataHolder
+from PET_radioactive_source_localization.implementations.ColumnarDataHolder import ColumnarDataHolder
+from PET_radioactive_source_localization.implementations.DetectorGeometry import DetectorGeometry
+from PET_radioactive_source_localization.implementations.KLinesClustering import KLinesClustering
+from PET_radioactive_source_localization.implementations.LazyImport import LazyImport
+from dataclasses import dataclass
+from numpy.typing import ArrayLike
+from typing import List, Tuple, Optional, Dict, Any
+import time
+import numpy as np
+logger = LazyImport("loguru", "logger")
+
+@dataclass
+class KEpsilonSweep:
+    """
+    Source estimates for every threshold of a k_epsilon sweep: (T,) thresholds and n_pairs, (T, 2) sources and u_sources
+    (NaN where no pair is accepted). best_k_epsilon is the threshold with the smallest |u_source|, None without uncertainties
+    """
+    thresholds: np.ndarray
+    n_pairs: np.ndarray
+    sources: np.ndarray
+    u_sources: Optional[np.ndarray] = None
+    best_k_epsilon: Optional[float] = None
+
+@dataclass
+class ApproximateSource:
+    """
+    Source estimated from a random sample of line pairs. u_source estimates the u_source of find_source over all pairs,
+    roughly, because it is dominated by the few pairs of nearly parallel lines. sampling_error is the standard error
+    of the source due to sampling only, which shrinks as 1/sqrt(n_accepted)
+    """
+    source: np.ndarray
+    u_source: Optional[np.ndarray]
+    sampling_error: np.ndarray
+    n_sampled: int
+    n_accepted: int
+    n_rounds: int
+    seconds: float
+    exact: bool = False # every pair was evaluated, so source is the one of find_source
+    converged: bool = True # sampling_error reached tol, False when max_pairs or the time budget ended the sampling first
+
+class VectorizedLineCalculator(LineCalculator):
+    """
+    Batch implementation of ICalculator. Every stage takes the whole thetas array at once and works with
+    NumPy broadcasting instead of looping over lists of tuples.
+    Results are written to the dataholder in the same format as LineCalculator does, so PET and Plotter work unchanged.
+    Raw arrays of the latest run are also kept on the calculator:
+    points_arr (N, 2, 2), lines_arr (N, 2), intersection_arr (M, 2) and pair_indices (M, 2), plus their u_ counterparts
+    """
+    bytes_per_sampled_pair: int = 400 # peak temporaries of find_source_approximate per pair of a round, including uncertainties
+
+    def __init__(self, dataholder: DataHolder, geometry: Optional[DetectorGeometry] = None) -> None:
+        super().__init__(dataholder)
+        self.geometry = geometry
+        self.points_arr: Optional[np.ndarray] = None
+        self.u_points_arr: Optional[np.ndarray] = None
+        self.lines_arr: Optional[np.ndarray] = None
+        self.u_lines_arr: Optional[np.ndarray] = None
+        self.intersection_arr: Optional[np.ndarray] = None
+        self.u_intersection_arr: Optional[np.ndarray] = None
+        self.pair_indices: Optional[np.ndarray] = None
+        self._stored: Dict[str, Tuple[Any, np.ndarray]] = {} # dataholder attribute -> (value written there, array it was built from)
+
+    def find_theta_uncertainities(self) -> None:
+        n_thetas = len(self.dataholder.thetas)
+        if not self.dataholder.S_thetas:
+            logger.warning(f'Statistical error in dataholder is None: {self.dataholder.S_thetas}')
+            u_thetas = np.full((n_thetas, 2), self.dataholder.U_thetas, dtype=float)
+        else:
+            u_thetas = np.hypot(np.asarray(self.dataholder.S_thetas, dtype=float), self.dataholder.U_thetas)
+        self._store("u_thetas", u_thetas)
+
+    def find_points(self, find_u: bool = False) -> None:
+        """Map thetas to point pairs, or look detector IDs up in geometry when one is given"""
+        if self.geometry is not None:
+            self._find_points_in_geometry(find_u=find_u)
+            return
+        if len(self.dataholder.thetas) == 0:
+            raise ValueError(f'thetas is empty: {self.dataholder.thetas}')
+        thetas = np.asarray(self.dataholder.thetas, dtype=float)
+        self.points_arr = self.cartesian_from_polar(thetas, self.dataholder.R1, self.dataholder.R2)
+        self._store("points", self.points_arr)
+
+        if find_u:
+            if not self.dataholder.u_thetas:
+                raise ValueError(f'u_thetas is None: {self.dataholder.u_thetas}')
+            u_thetas = self._load("u_thetas", (-1, 2))
+            self.u_points_arr = self.u_cartesian_from_polar(thetas, u_thetas)
+            self._store("u_points", self.u_points_arr)
+
+    def _find_points_in_geometry(self, find_u: bool) -> None:
+        """Points and their uncertainties by indexing the lookup table of the geometry. Per-event S_thetas add to the angular uncertainty of the detectors"""
+        assert self.geometry is not None
+        if self.dataholder.detector_ids:
+            ids = np.asarray(self.dataholder.detector_ids, dtype=np.int64).reshape(-1, 2)
+        elif len(self.dataholder.thetas) > 0:
+            ids = self.geometry.ids_of(self.dataholder.thetas)
+        else:
+            raise ValueError(f'neither detector_ids nor thetas are given: {self.dataholder.detector_ids}, {self.dataholder.thetas}')
+        self.points_arr = self.geometry.coordinates(ids)
+        self._store("points", self.points_arr)
+        if find_u:
+            S_thetas = self.dataholder.S_thetas if self.dataholder.S_thetas else None
+            self.u_points_arr = self.geometry.u_coordinates(ids, S_thetas)
+            self._store("u_points", self.u_points_arr)
+
+    def find_line_params(self, find_u: bool = False) -> None:
+        """Find k and b in y=kx+b for every pair of points at once"""
+        if len(self.dataholder.points) == 0:
+            raise ValueError(f'dataholder points is an empty list: {self.dataholder.points}')
+        points = self._load("points", (-1, 2, 2))
+        self.lines_arr = self.line_params(points)
+        self._store("all_lines_params", self.lines_arr)
+
+        if find_u:
+            if len(self.dataholder.u_points) == 0:
+                raise ValueError(f'dataholder points\'s uncertainties is None: {self.dataholder.u_points}')
+            u_points = self._load("u_points", (-1, 2, 2))
+            self.u_lines_arr = self.u_line_params(points, u_points, self.lines_arr)
+            self._store("u_all_lines_params", self.u_lines_arr)
+
+    def find_all_intersection_points(self, k_epsilon = 0.2, find_u: bool = False) -> None:
+        """Find intersection points of every pair i<j of lines whose slopes differ by more than k_epsilon"""
+        if len(self.dataholder.all_lines_params) == 0:
+            raise ValueError(f'can\'t find intersection point of all lines, because all_lines_params is empty: {self.dataholder.all_lines_params}')
+        lines = self._load("all_lines_params", (-1, 2))
+        self.pair_indices, self.intersection_arr = self.intersect_lines(lines, k_epsilon=k_epsilon)
+        self._store("intersection_points", self.intersection_arr)
+
+        if find_u:
+            if len(self.dataholder.u_all_lines_params) == 0:
+                raise ValueError(f'lines params is an empty list: {self.dataholder.u_all_lines_params}')
+            u_lines = self._load("u_all_lines_params", (-1, 2))
+            self.u_intersection_arr = self.u_intersect_lines(lines, u_lines, self.pair_indices, self.intersection_arr)
+            self._store("u_intersection_points", self.u_intersection_arr)
+
+    def find_source(self, find_u: bool = False) -> Tuple[float, float]:
+        """
+        Given intersection points, find their mean coordinates, which is the estimated position of the source.
+        With line_weights, the intersection of lines i and j counts as weight_i*weight_j points
+        """
+        if len(self.dataholder.intersection_points) == 0:
+            raise ValueError(f"Can\'t find source, because no intersection points are provided. Intersection points: {self.dataholder.intersection_points}")
+        intersection_points = self._load("intersection_points", (-1, 2))
+        weights = self._pair_weights(len(intersection_points))
+        if weights is None:
+            self.dataholder.source = tuple(intersection_points.mean(axis=0))
+        else:
+            self.dataholder.source = tuple(weights @ intersection_points/weights.sum())
+        if find_u:
+            if len(self.dataholder.u_intersection_points) == 0:
+                raise ValueError(f'intersection points uncertainties is an empty list: {self.dataholder.u_intersection_points}')
+            u_intersection_points = self._load("u_intersection_points", (-1, 2))
+            if weights is None:
+                self.dataholder.u_source = tuple(np.sqrt(np.sum(u_intersection_points**2, axis=0))/len(u_intersection_points))
+            else:
+                self.dataholder.u_source = tuple(np.sqrt(weights @ u_intersection_points**2)/weights.sum())
+        return self.dataholder.source
+
+    def _pair_weights(self, n_points: int) -> Optional[np.ndarray]:
+        """weight_i*weight_j of every accepted pair, None without line_weights"""
+        if len(self.dataholder.line_weights) == 0:
+            return None
+        if self.pair_indices is None or len(self.pair_indices) != n_points:
+            raise ValueError(f'line_weights need the pair indices of find_all_intersection_points: {self.pair_indices}')
+        line_weights = np.asarray(self.dataholder.line_weights, dtype=float)
+        return line_weights[self.pair_indices[:, 0]]*line_weights[self.pair_indices[:, 1]]
+
+    def find_source_approximate(self, k_epsilon: float = 0.2, n_pairs: Optional[int] = None, time_budget: Optional[float] = None,
+                                memory_budget: Optional[int] = None, tol: Optional[float] = None, round_size: int = 100_000,
+                                max_pairs: Optional[int] = None, find_u: bool = False, seed: Optional[int] = None) -> ApproximateSource:
+        """
+        Estimate the source from randomly sampled pairs of lines instead of all n(n-1)/2 of them. Pairs are drawn uniformly
+        with replacement in rounds of round_size, the same k_epsilon rule rejects near-parallel pairs, and only running sums
+        are kept, so the cost is O(M) in the number M of sampled pairs. The estimate converges to find_source as M grows,
+        and if the budget covers all pairs they are evaluated exactly instead.
+
+        Args:
+            n_pairs: Stop after sampling this many pairs.
+            time_budget: Stop after the round that exceeds this many seconds.
+            memory_budget: Bytes of temporaries a round may use, limits round_size.
+            tol: Stop as soon as the sampling error of the source (its length) drops below tol.
+            max_pairs: Never sample more pairs than this, 10 times the number of pairs by default, so a tol below
+                the reachable sampling error still ends. converged of the result tells whether tol was met.
+            With none of n_pairs, time_budget and tol, a single round is sampled.
+        """
+        if len(self.dataholder.all_lines_params) == 0:
+            raise ValueError(f'can\'t find source, because all_lines_params is empty: {self.dataholder.all_lines_params}')
+        start = time.perf_counter()
+        lines = self._load("all_lines_params", (-1, 2))
+        u_lines = None
+        if find_u:
+            if len(self.dataholder.u_all_lines_params) == 0:
+                raise ValueError(f'lines params is an empty list: {self.dataholder.u_all_lines_params}')
+            u_lines = self._load("u_all_lines_params", (-1, 2))
+        n_lines = len(lines)
+        if n_lines < 2:
+            raise ValueError(f'can\'t sample pairs of less than 2 lines: {n_lines}')
+        total_pairs = n_lines*(n_lines-1)//2
+        max_pairs = 10*total_pairs if max_pairs is None else max_pairs
+        if max_pairs < 1:
+            raise ValueError(f'max_pairs must be positive: {max_pairs}')
+        limit = max_pairs if n_pairs is None else min(n_pairs, max_pairs)
+        if memory_budget is not None:
+            round_size = min(round_size, memory_budget//self.bytes_per_sampled_pair)
+        if round_size < 1:
+            raise ValueError(f'budget doesn\'t allow sampling a single pair per round: {round_size}')
+        line_weights = np.asarray(self.dataholder.line_weights, dtype=float) if len(self.dataholder.line_weights) > 0 else None
+        if n_pairs is not None and n_pairs >= total_pairs:
+            return self._exact_approximation(lines, u_lines, line_weights, k_epsilon, start)
+
+        rng = np.random.default_rng(seed)
+        n_sampled, n_accepted, n_rounds = 0, 0, 0
+        shift = None # points are summed relative to the mean of the first round, which keeps the variance accurate
+        # weighted sums of the sample, with w = weight_i*weight_j as in find_source and d = point-shift
+        sum_w, sum_w_sq = 0.0, 0.0
+        sum_w_d, sum_w_sq_d, sum_w_sq_d_sq, sum_w_u_sq = np.zeros(2), np.zeros(2), np.zeros(2), np.zeros(2)
+        while True:
+            m = min(round_size, limit-n_sampled)
+            i = rng.integers(0, n_lines, m)
+            j = rng.integers(0, n_lines-1, m)
+            j += j >= i # uniform over pairs of distinct lines
+            pairs = np.column_stack((np.minimum(i, j), np.maximum(i, j)))
+            pairs = pairs[np.abs(lines[pairs[:, 1], 0]-lines[pairs[:, 0], 0]) > k_epsilon]
+            (k_i, b_i), (k_j, b_j) = lines[pairs[:, 0]].T, lines[pairs[:, 1]].T
+            x = (b_j-b_i)/(k_i-k_j)
+            points = np.column_stack((x, k_i*x+b_i))
+            n_sampled += m
+            n_accepted += len(points)
+            n_rounds += 1
+            if len(points):
+                if shift is None:
+                    shift = points.mean(axis=0)
+                w = np.ones(len(points)) if line_weights is None else line_weights[pairs[:, 0]]*line_weights[pairs[:, 1]]
+                d = points-shift
+                sum_w += w.sum()
+                sum_w_sq += w @ w
+                sum_w_d += w @ d
+                sum_w_sq_d += w**2 @ d
+                sum_w_sq_d_sq += w**2 @ d**2
+                if u_lines is not None:
+                    sum_w_u_sq += w @ self.u_intersect_lines(lines, u_lines, pairs, points)**2
+            sampling_error = np.full(2, np.inf)
+            if n_accepted > 1:
+                # standard error of the ratio estimator sum(w*p)/sum(w) of the weighted mean
+                mean_d = sum_w_d/sum_w
+                sampling_error = np.sqrt(np.maximum(sum_w_sq_d_sq - 2*mean_d*sum_w_sq_d + mean_d**2*sum_w_sq, 0))/sum_w
+            if n_sampled >= limit:
+                break
+            if time_budget is not None and time.perf_counter()-start >= time_budget:
+                break
+            if tol is not None and np.hypot(*sampling_error) < tol:
+                break
+            if n_pairs is None and time_budget is None and tol is None:
+                break
+        if shift is None:
+            raise ValueError(f"Can\'t find source, because none of {n_sampled} sampled pairs differs in slope by more than k_epsilon: {k_epsilon}")
+
+        source = shift + sum_w_d/sum_w
+        self.dataholder.source = tuple(source.tolist())
+        u_source = None
+        if u_lines is not None:
+            # find_source gives sqrt(sum w*u^2)/sum w over all pairs, both sums are scaled up from the sample
+            scale = total_pairs/n_sampled
+            u_source = np.sqrt(scale*sum_w_u_sq)/(scale*sum_w)
+            self.dataholder.u_source = tuple(u_source.tolist())
+        return ApproximateSource(source=source, u_source=u_source, sampling_error=sampling_error, n_sampled=n_sampled, n_accepted=n_accepted,
+                                 n_rounds=n_rounds, seconds=time.perf_counter()-start, converged=bool(tol is None or np.hypot(*sampling_error) < tol))
+
+    def _exact_approximation(self, lines: np.ndarray, u_lines: Optional[np.ndarray], line_weights: Optional[np.ndarray],
+                             k_epsilon: float, start: float) -> ApproximateSource:
+        """find_source_approximate when the budget covers every pair"""
+        pair_indices, points = self.intersect_lines(lines, k_epsilon=k_epsilon)
+        if len(points) == 0:
+            raise ValueError(f"Can\'t find source, because no pair of lines differs in slope by more than k_epsilon: {k_epsilon}")
+        w = np.ones(len(points)) if line_weights is None else line_weights[pair_indices[:, 0]]*line_weights[pair_indices[:, 1]]
+        source = w @ points/w.sum()
+        self.dataholder.source = tuple(source.tolist())
+        u_source = None
+        if u_lines is not None:
+            u_source = np.sqrt(w @ self.u_intersect_lines(lines, u_lines, pair_indices, points)**2)/w.sum()
+            self.dataholder.u_source = tuple(u_source.tolist())
+        return ApproximateSource(source=source, u_source=u_source, sampling_error=np.zeros(2), n_sampled=len(lines)*(len(lines)-1)//2,
+                                 n_accepted=len(points), n_rounds=1, seconds=time.perf_counter()-start, exact=True)
+
+    def find_sources(self, n_sources: int = 2, find_u: bool = False, **clustering_kwargs) -> Tuple[Tuple[float, float], ...]:
+        """Multi-source mode: assign every line to one of n_sources sources with KLinesClustering and find a source per cluster"""
+        return KLinesClustering(self.dataholder, n_sources=n_sources, **clustering_kwargs).find_sources(find_u=find_u)
+
+    def sweep_k_epsilon(self, thresholds: Optional[ArrayLike] = None, find_u: bool = True, min_pairs: int = 3) -> KEpsilonSweep:
+        """
+        Evaluate find_all_intersection_points + find_source for many k_epsilon at the cost of a single run.
+        Intersections of all non-parallel pairs are found once and sorted by |k_i-k_j|, so the pairs accepted by any threshold
+        are a prefix of them and prefix sums give the mean and its uncertainty for every threshold.
+        With line_weights, pairs are weighted by weight_i*weight_j like in find_source.
+
+        Args:
+            thresholds: k_epsilon values to evaluate, 1000 values from 0 to the largest |k_i-k_j| by default.
+            find_u: Also compute uncertainties of the sources and suggest best_k_epsilon.
+            min_pairs: Thresholds accepting fewer pairs are never suggested.
+        """
+        if len(self.dataholder.all_lines_params) == 0:
+            raise ValueError(f'can\'t sweep k_epsilon, because all_lines_params is empty: {self.dataholder.all_lines_params}')
+        lines = self._load("all_lines_params", (-1, 2))
+        pair_indices, intersection_points = self.intersect_lines(lines, k_epsilon=0)
+        delta_k = np.abs(lines[pair_indices[:, 1], 0] - lines[pair_indices[:, 0], 0])
+        order = np.argsort(-delta_k, kind="stable")
+        delta_k = delta_k[order]
+        if thresholds is None:
+            thresholds = np.linspace(0, delta_k[0] if len(delta_k) else 0, 1000)
+        thresholds = np.asarray(thresholds, dtype=float).reshape(-1)
+
+        # number of pairs with |k_i-k_j| > threshold, the length of the accepted prefix
+        n_pairs = np.searchsorted(-delta_k, -thresholds, side="left")
+        weights = None
+        total_weights = n_pairs.astype(float)
+        if len(self.dataholder.line_weights) > 0:
+            line_weights = np.asarray(self.dataholder.line_weights, dtype=float)
+            weights = (line_weights[pair_indices[:, 0]]*line_weights[pair_indices[:, 1]])[order]
+            total_weights = np.concatenate(([0.0], np.cumsum(weights)))[n_pairs]
+        weighted_points = intersection_points[order] if weights is None else weights[:, None]*intersection_points[order]
+        prefix = np.vstack((np.zeros(2), np.cumsum(weighted_points, axis=0)))
+        with np.errstate(invalid="ignore", divide="ignore"):
+            sources = prefix[n_pairs]/total_weights[:, None]
+        sweep = KEpsilonSweep(thresholds=thresholds, n_pairs=n_pairs, sources=sources)
+        if find_u:
+            if len(self.dataholder.u_all_lines_params) == 0:
+                raise ValueError(f'lines params is an empty list: {self.dataholder.u_all_lines_params}')
+            u_lines = self._load("u_all_lines_params", (-1, 2))
+            u_intersection_points = self.u_intersect_lines(lines, u_lines, pair_indices, intersection_points)
+            u_sq = u_intersection_points[order]**2
+            prefix_sq = np.vstack((np.zeros(2), np.cumsum(u_sq if weights is None else weights[:, None]*u_sq, axis=0)))
+            with np.errstate(invalid="ignore", divide="ignore"):
+                sweep.u_sources = np.sqrt(prefix_sq[n_pairs])/total_weights[:, None]
+            candidates = np.flatnonzero(n_pairs >= min_pairs)
+            if len(candidates):
+                best = candidates[np.argmin(np.hypot(*sweep.u_sources[candidates].T))]
+                sweep.best_k_epsilon = float(thresholds[best])
+            else:
+                logger.warning(f'no threshold accepts at least {min_pairs} pairs, can\'t suggest k_epsilon')
+        return sweep
+
+    def cartesian_from_polar(self, thetas: np.ndarray, R1: float, R2: float) -> np.ndarray:
+        """Map (N, 2) array of angles in degrees to (N, 2, 2) array of endpoints ((x1, y1), (x2, y2)) on circles R1 and R2"""
+        radians = np.deg2rad(thetas)
+        r = np.array([R1, R2], dtype=float)
+        return np.stack((r*np.cos(radians), r*np.sin(radians)), axis=-1)
+
+    def u_cartesian_from_polar(self, thetas: np.ndarray, u_thetas: np.ndarray) -> np.ndarray:
+        """Uncertainties of cartesian_from_polar"""
+        r = (self.dataholder.R1, self.dataholder.R2)
+        u_r = (self.dataholder.u_R1, self.dataholder.u_R2)
+        u_x = self.propagator.propagate("polar_x", (r, thetas), (u_r, u_thetas))
+        u_y = self.propagator.propagate("polar_y", (r, thetas), (u_r, u_thetas))
+        return np.stack((u_x, u_y), axis=-1)
+
+    def line_params(self, points: np.ndarray) -> np.ndarray:
+        """Map (N, 2, 2) array of point pairs to (N, 2) array of (k, b)"""
+        x1, y1, x2, y2 = points[:, 0, 0], points[:, 0, 1], points[:, 1, 0], points[:, 1, 1]
+        k = (y2-y1)/(x2-x1)
+        b = (y1-k*x1)/2 + (y2-k*x2)/2
+        return np.column_stack((k, b))
+
+    def u_line_params(self, points: np.ndarray, u_points: np.ndarray, lines: np.ndarray) -> np.ndarray:
+        """Uncertainties of line_params"""
+        points = points.reshape(-1, 4).T
+        u_points = u_points.reshape(-1, 4).T
+        u_k = self.propagator.propagate("line_k", points, u_points)
+        u_b = self.propagator.propagate("line_b", (*points, lines[:, 0]), u_points)
+        return np.column_stack((u_k, u_b))
+
+    def intersect_lines(self, lines: np.ndarray, k_epsilon: float = 0.2) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Intersect every pair i<j of (N, 2) lines in the same order as the nested loop of LineCalculator.
+        Returns (M, 2) indices of accepted pairs and (M, 2) intersection points, where pairs with |k_i-k_j| <= k_epsilon are masked out
+        """
+        i, j = np.triu_indices(len(lines), k=1)
+        k_i, b_i = lines[i, 0], lines[i, 1]
+        k_j, b_j = lines[j, 0], lines[j, 1]
+        mask = np.abs(k_j-k_i) > k_epsilon
+        i, j = i[mask], j[mask]
+        k_i, b_i, k_j, b_j = k_i[mask], b_i[mask], k_j[mask], b_j[mask]
+        x = (b_j-b_i)/(k_i-k_j)
+        y = k_i*x+b_i
+        return np.column_stack((i, j)), np.column_stack((x, y))
+
+    def u_intersect_lines(self, lines: np.ndarray, u_lines: np.ndarray, pair_indices: np.ndarray, intersection_points: np.ndarray) -> np.ndarray:
+        """Uncertainties of intersect_lines for the accepted pairs"""
+        i, j = pair_indices[:, 0], pair_indices[:, 1]
+        (k_i, b_i), (k_j, b_j) = lines[i].T, lines[j].T
+        (u_k_i, u_b_i), (u_k_j, u_b_j) = u_lines[i].T, u_lines[j].T
+        u_x = self.propagator.propagate("intersection_x", (k_i, b_i, k_j, b_j), (u_k_i, u_b_i, u_k_j, u_b_j))
+        u_y = self.propagator.propagate("intersection_y", (k_i, b_i, intersection_points[:, 0]), (u_k_i, u_b_i))
+        return np.column_stack((u_x, u_y))
+
+    def _store(self, attr_name: str, arr: np.ndarray) -> None:
+        """Write arr to the dataholder as (nested) tuples and remember it, so the next stage can skip converting it back.
+        A ColumnarDataHolder takes the array as it is"""
+        if isinstance(self.dataholder, ColumnarDataHolder):
+            setattr(self.dataholder, attr_name, arr)
+            self._stored[attr_name] = (getattr(self.dataholder, attr_name), arr)
+            return
+        value = self._to_nested_tuples(arr) if arr.ndim == 3 else self._to_tuples(arr)
+        setattr(self.dataholder, attr_name, value)
+        self._stored[attr_name] = (value, arr)
+
+    def _load(self, attr_name: str, shape: Tuple[int, ...]) -> np.ndarray:
+        """Read a dataholder attribute as an array, reusing the array it was stored from if nobody replaced it since"""
+        value = getattr(self.dataholder, attr_name)
+        if attr_name in self._stored and self._stored[attr_name][0] is value:
+            return self._stored[attr_name][1]
+        return np.asarray(value, dtype=float).reshape(shape)
+
+    def _to_tuples(self, arr: np.ndarray) -> List[Tuple[float, float]]:
+        return list(zip(*arr.T.tolist()))
+
+    def _to_nested_tuples(self, arr: np.ndarray) -> List[Tuple[Tuple[float, float], Tuple[float, float]]]:
+        return list(zip(self._to_tuples(arr[:, 0]), self._to_tuples(arr[:, 1])))
@@ -1,4 +1,62 @@
-from .Coordinator import PET
-from .DataHolder import DataHolder
-from .LineCalculator import LineCalculator
-from .Plotter import Plotter 
+"""
+Classes of the package are imported on first access, e.g. `from PET_radioactive_source_localization.implementations import VectorizedLineCalculator`
+only imports the modules that calculator needs, so computing a source never pays for matplotlib, scipy or autograd
+"""
+from typing import Any, Dict, List
+import importlib
+import sys
+import types
+
+# exported name -> module defining it
+_exports: Dict[str, str] = {
+    "PET": "Coordinator",
+    "DataHolder": "DataHolder",
+    "LineCalculator": "LineCalculator",
+    "Plotter": "Plotter",
+    "VectorizedLineCalculator": "VectorizedLineCalculator",
+    "KEpsilonSweep": "VectorizedLineCalculator",
+    "ApproximateSource": "VectorizedLineCalculator",
+    "UncertaintyPropagator": "UncertaintyPropagator",
+    "LeastSquaresEstimator": "LeastSquaresEstimator",
+    "StreamingLocalizer": "StreamingLocalizer",
+    "KLinesClustering": "KLinesClustering",
+    "BackprojectionReconstructor": "BackprojectionReconstructor",
+    "ScanFitter": "ScanFitter",
+    "Scan": "ScanFitter",
+    "ScanFit": "ScanFitter",
+    "CoincidenceSimulator": "CoincidenceSimulator",
+    "ResultWriter": "ResultWriter",
+    "EventLoader": "EventLoader",
+    "ColumnarDataHolder": "ColumnarDataHolder",
+    "RunMetrics": "RunMetrics",
+    "ResultCache": "ResultCache",
+    "MonteCarloUncertainty": "MonteCarloUncertainty",
+    "MonteCarloResult": "MonteCarloUncertainty",
+    "ModeSeeker": "ModeSeeker",
+    "DetectorGeometry": "DetectorGeometry",
+    "ShardedIntersector": "ShardedIntersector",
+    "IntersectionSums": "ShardedIntersector",
+    "LiveService": "LiveService",
+    "SinogramBinner": "SinogramBinner",
+    "LazyImport": "LazyImport",
+}
+__all__: List[str] = list(_exports)
+
+class _Package(types.ModuleType):
+    def __setattr__(self, name: str, value: Any) -> None:
+        # importing a submodule binds it on the package under its own name, which is also the name of its class
+        if name in _exports and isinstance(value, types.ModuleType):
+            value = getattr(value, name)
+        super().__setattr__(name, value)
+
+sys.modules[__name__].__class__ = _Package
+
+def __getattr__(name: str) -> Any:
+    if name not in _exports:
+        raise AttributeError(f'module {__name__} has no attribute {name}')
+    value = getattr(importlib.import_module(f'.{_exports[name]}', __name__), name)
+    globals()[name] = value # later lookups don't go through __getattr__
+    return value
+
+def __dir__() -> List[str]:
+    return sorted(list(globals()) + __all__)
@@ -0,0 +1,30 @@
+"""
+Serves a running source estimate for coincidences that are still being acquired, see implementations.LiveService
+for the newline-delimited JSON protocol. A DAQ client sends batches of angle pairs, e.g.:
+    {"type": "events", "thetas": [[180, 14.1], [160, -0.17]], "S_thetas": [[0, 0.16], [0, 0.13]]}
+and can ask for the current estimate at any time with {"type": "query"}.
+
+Usage:
+    python -m PET_radioactive_source_localization.live [--host 127.0.0.1] [--port 5555] [--unix /tmp/pet.sock]
+"""
+from typing import List, Optional
+import argparse
+import asyncio
+import sys
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5555)
+    parser.add_argument("--unix", default=None, help="path of a Unix socket to listen on instead of TCP")
+    args = parser.parse_args(argv)
+
+    from PET_radioactive_source_localization.implementations import LiveService
+    try:
+        asyncio.run(LiveService().serve_forever(host=args.host, port=args.port, path=args.unix))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
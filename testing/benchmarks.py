@@ -0,0 +1,178 @@
+"""
+Benchmarks of every stage called by PET.run for growing numbers of lines, with and without find_u.
+Wall time and peak memory (tracemalloc) of each stage are written to a JSON file and compared against a stored baseline.
+Tracing memory slows Python-heavy stages down, so wall time and memory are measured in two separate passes.
+Cold-start import times of the package are measured in fresh interpreters first, see IMPORT_STATEMENTS.
+
+Usage:
+    python -m PET_radioactive_source_localization.testing.benchmarks [--sizes 10 100 1000] [--output bench.json]
+                                                                      [--baseline testing/benchmark_baseline.json] [--update-baseline]
+"""
+import matplotlib
+matplotlib.use("Agg")
+
+from PET_radioactive_source_localization.implementations import *
+from typing import Callable, Dict, List, Optional, Any
+import matplotlib.pyplot as plt
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import warnings
+
+DEFAULT_SIZES: List[int] = [10, 100, 1000, 10_000, 100_000, 1_000_000]
+DEFAULT_BASELINE: str = os.path.join(os.path.dirname(__file__), "benchmark_baseline.json")
+CALCULATORS: Dict[str, type] = {"vectorized": VectorizedLineCalculator, "line": LineCalculator}
+
+def measure(stage: Callable[[], Any], trace_memory: bool = False) -> Dict[str, float]:
+    """Wall time of a single call, or its peak traced memory if trace_memory is set (tracemalloc must be running)"""
+    if not trace_memory:
+        start = time.perf_counter()
+        stage()
+        return {"seconds": time.perf_counter() - start}
+    tracemalloc.reset_peak()
+    start_memory = tracemalloc.get_traced_memory()[0]
+    stage()
+    return {"peak_bytes": max(tracemalloc.get_traced_memory()[1] - start_memory, 0)}
+
+HEAVY_MODULES: List[str] = ["matplotlib", "autograd", "loguru", "scipy"]
+IMPORT_STATEMENTS: Dict[str, str] = {
+    "import_package": "import PET_radioactive_source_localization.implementations",
+    "import_calculator": "from PET_radioactive_source_localization.implementations import DataHolder, VectorizedLineCalculator, LeastSquaresEstimator",
+    "import_pipeline": "from PET_radioactive_source_localization.implementations import PET, DataHolder, LineCalculator, Plotter",
+}
+
+def import_time(statement: str, repeat: int = 5) -> Dict[str, Any]:
+    """Cold-start wall time of statement in a fresh interpreter (best of repeat, numpy already imported), and which HEAVY_MODULES it loaded"""
+    script = (f'import json, sys, time\nimport numpy\nstart = time.perf_counter()\n{statement}\nseconds = time.perf_counter() - start\n'
+              f'print(json.dumps({{"seconds": seconds, "modules": [m for m in {HEAVY_MODULES!r} if m in sys.modules]}}))')
+    # run from the directory containing the package, so it's importable without installation
+    cwd = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    runs = [json.loads(subprocess.run([sys.executable, "-c", script], cwd=cwd, capture_output=True, text=True, check=True).stdout) for _ in range(repeat)]
+    return {"seconds": min(run["seconds"] for run in runs), "modules": runs[0]["modules"]}
+
+def benchmark_imports(repeat: int = 5) -> List[Dict[str, Any]]:
+    return [{"n": 0, "find_u": False, "stage": stage, "calculator": "none", **import_time(statement, repeat=repeat)}
+            for stage, statement in IMPORT_STATEMENTS.items()]
+
+def plot(pet: PET, output_dir: str, scale: float = 5) -> None:
+    """Plotting part of PET.run, saved to a file instead of shown"""
+    pet.plotter.add_lines(pet.line_segments(scale=scale))
+    pet.plotter.highlight_intersection_points(show_uncertainties=True)
+    pet.plotter.highlight_source(show_uncertainty=True)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        pet.plotter.finalize() #type: ignore
+    plt.savefig(os.path.join(output_dir, "benchmark.png"))
+    plt.close("all")
+
+def benchmark_size(n: int, find_u: bool, calculator_name: str = "vectorized", k_epsilon: float = 0.2, max_pairs: int = 10_000_000,
+                   max_plot_lines: int = 10_000, trace_memory: bool = True, seed: int = 0) -> List[Dict[str, Any]]:
+    """Time every stage of PET.run for n simulated lines. Stages that would exceed max_pairs or max_plot_lines are recorded as skipped"""
+    thetas, S_thetas, _ = CoincidenceSimulator(DataHolder(), sources=[(1.0, -1.0)], seed=seed).simulate(n)
+    n_pairs = n*(n-1)//2
+    enabled = {
+        "find_theta_uncertainities": True,
+        "find_points": True,
+        "find_line_params": True,
+        "find_all_intersection_points": n_pairs <= max_pairs,
+        "find_source": n_pairs <= max_pairs,
+        "plotting": find_u and n_pairs <= max_pairs and n <= max_plot_lines,
+        "save_json": n_pairs <= max_pairs,
+    }
+    results = {stage: {"n": n, "find_u": find_u, "stage": stage, "calculator": calculator_name} for stage in enabled}
+    for stage, is_enabled in enabled.items():
+        if not is_enabled:
+            results[stage]["skipped"] = True
+
+    for tracing in ([False, True] if trace_memory else [False]):
+        dataholder = DataHolder(thetas=list(zip(*thetas.T.tolist())), S_thetas=list(zip(*S_thetas.T.tolist())))
+        calculator = CALCULATORS[calculator_name](dataholder)
+        pet = PET(dataholder, calculator, Plotter(dataholder))
+        with tempfile.TemporaryDirectory() as output_dir:
+            stages = {
+                "find_theta_uncertainities": lambda: calculator.find_theta_uncertainities(),
+                "find_points": lambda: calculator.find_points(find_u=find_u),
+                "find_line_params": lambda: calculator.find_line_params(find_u=find_u),
+                "find_all_intersection_points": lambda: calculator.find_all_intersection_points(k_epsilon=k_epsilon, find_u=find_u),
+                "find_source": lambda: calculator.find_source(find_u=find_u),
+                "plotting": lambda: plot(pet, output_dir),
+                "save_json": lambda: pet.save("both", output_dir=output_dir, filename_with_ext="benchmark.json", save_u=find_u),
+            }
+            if tracing:
+                tracemalloc.start()
+            try:
+                for stage, call in stages.items():
+                    if enabled[stage]:
+                        results[stage].update(measure(call, trace_memory=tracing))
+            finally:
+                if tracing:
+                    tracemalloc.stop()
+                plt.close("all")
+    return list(results.values())
+
+def compare(results: List[Dict[str, Any]], baseline: List[Dict[str, Any]], tolerance: float = 0.5, min_seconds: float = 0.01) -> List[str]:
+    """Descriptions of stages that got slower than baseline by more than tolerance (ignoring stages faster than min_seconds)"""
+    key = lambda record: (record["n"], record["find_u"], record["stage"], record.get("calculator", "vectorized"))
+    reference = {key(record): record for record in baseline if not record.get("skipped")}
+    regressions = []
+    for record in results:
+        if record.get("skipped") or key(record) not in reference:
+            continue
+        expected = reference[key(record)]["seconds"]
+        if record["seconds"] > max(expected*(1+tolerance), min_seconds):
+            regressions.append(f'{record["stage"]} (n={record["n"]}, find_u={record["find_u"]}, {record["calculator"]}): '
+                               f'{record["seconds"]:.4f}s vs baseline {expected:.4f}s')
+    return regressions
+
+def run(sizes: List[int], calculator_name: str = "vectorized", max_pairs: int = 10_000_000, max_plot_lines: int = 10_000, trace_memory: bool = True) -> Dict[str, Any]:
+    results = benchmark_imports()
+    print(f'benchmarked imports', file=sys.stderr)
+    for n in sizes:
+        for find_u in (False, True):
+            results.extend(benchmark_size(n, find_u, calculator_name=calculator_name, max_pairs=max_pairs,
+                                          max_plot_lines=max_plot_lines, trace_memory=trace_memory))
+            print(f'benchmarked n={n}, find_u={find_u}', file=sys.stderr)
+    return {
+        "meta": {"python": platform.python_version(), "machine": platform.machine(), "processor": platform.processor(), "time": time.strftime("%Y-%m-%dT%H:%M:%S")},
+        "results": results,
+    }
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument("--calculator", choices=list(CALCULATORS), default="vectorized")
+    parser.add_argument("--max-pairs", type=int, default=10_000_000, help="skip pairwise stages above this number of line pairs")
+    parser.add_argument("--max-plot-lines", type=int, default=10_000, help="skip plotting above this number of lines")
+    parser.add_argument("--no-memory", action="store_true", help="skip the tracemalloc pass")
+    parser.add_argument("--output", default="bench_output.json")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--tolerance", type=float, default=0.5, help="allowed relative slowdown against baseline")
+    parser.add_argument("--update-baseline", action="store_true", help="store these results as the new baseline")
+    args = parser.parse_args(argv)
+
+    report = run(args.sizes, calculator_name=args.calculator, max_pairs=args.max_pairs, max_plot_lines=args.max_plot_lines, trace_memory=not args.no_memory)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f'baseline updated: {args.baseline}')
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f'no baseline found at {args.baseline}, run with --update-baseline to create one')
+        return 0
+    with open(args.baseline) as f:
+        regressions = compare(report["results"], json.load(f)["results"], tolerance=args.tolerance)
+    for regression in regressions:
+        print(f'REGRESSION {regression}')
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,14 +1,42 @@
 import pytest
 from PET_radioactive_source_localization.implementations.LineCalculator import LineCalculator
 from PET_radioactive_source_localization.implementations.DataHolder import DataHolder
+from PET_radioactive_source_localization.implementations.VectorizedLineCalculator import VectorizedLineCalculator, KEpsilonSweep
+from PET_radioactive_source_localization.implementations.UncertaintyPropagator import UncertaintyPropagator
+from PET_radioactive_source_localization.implementations.LeastSquaresEstimator import LeastSquaresEstimator
+from PET_radioactive_source_localization.implementations.StreamingLocalizer import StreamingLocalizer
+from PET_radioactive_source_localization.implementations.KLinesClustering import KLinesClustering
+from PET_radioactive_source_localization.implementations.BackprojectionReconstructor import BackprojectionReconstructor
+from PET_radioactive_source_localization.implementations.ScanFitter import ScanFitter, Scan, gaussians
+from PET_radioactive_source_localization.implementations.CoincidenceSimulator import CoincidenceSimulator
+from PET_radioactive_source_localization.implementations.Plotter import Plotter
+from PET_radioactive_source_localization.implementations.Coordinator import PET
+from PET_radioactive_source_localization.implementations.ResultWriter import ResultWriter
+from PET_radioactive_source_localization.implementations.EventLoader import EventLoader
+from PET_radioactive_source_localization.implementations.ColumnarDataHolder import ColumnarDataHolder, Column
+from PET_radioactive_source_localization.implementations.RunMetrics import RunMetrics
+from PET_radioactive_source_localization.implementations.ResultCache import ResultCache
+from PET_radioactive_source_localization.implementations.MonteCarloUncertainty import MonteCarloUncertainty
+from PET_radioactive_source_localization.implementations.ModeSeeker import ModeSeeker
+from PET_radioactive_source_localization.implementations.DetectorGeometry import DetectorGeometry
+from PET_radioactive_source_localization.implementations.ShardedIntersector import ShardedIntersector
+from PET_radioactive_source_localization.implementations.LiveService import LiveService
+from PET_radioactive_source_localization.implementations.SinogramBinner import SinogramBinner
 
 from math import isclose
+import asyncio
+import json
+import os
+import time
+import tracemalloc
 import numpy as np
 
 def test_get_line_params():
     dataholder = DataHolder()
     calculator = LineCalculator(dataholder)
-    k, b = calculator.find_line_params(1, 1, 2, 2)
+    calculator.dataholder.points = [((1, 1), (2, 2))]
+    calculator.find_line_params()
+    k, b = calculator.dataholder.all_lines_params[0]
 
     assert isclose(k, 1)
     assert isclose(b, 0)
@@ -37,4 +65,638 @@ def test_all_intersection_points():
     calculator = LineCalculator(dataholder)
     calculator.dataholder.all_lines_params = [(0,1), (-2, 2), (2,-2)]
     calculator.find_all_intersection_points()
-    assert np.allclose(calculator.dataholder.intersection_points, [(0.5, 1), (1.5, 1), (1, 0)])
\ No newline at end of file
+    assert np.allclose(calculator.dataholder.intersection_points, [(0.5, 1), (1.5, 1), (1, 0)])
+
+def _run_calculator(calculator, k_epsilon = 0.2):
+    calculator.find_theta_uncertainities()
+    calculator.find_points(find_u=True)
+    calculator.find_line_params(find_u=True)
+    calculator.find_all_intersection_points(k_epsilon=k_epsilon, find_u=True)
+    calculator.find_source(find_u=True)
+    return calculator.dataholder
+
+def test_vectorized_calculator_matches_line_calculator():
+    thetas = [(180, 14.6), (160, -0.3), (140, -16.26), (220, 44.45), (120, -35.24)]
+    S_thetas = [(0, 0.21), (0, 0.18), (0, 0.17), (0, 1.7), (0, 0.09)]
+    expected = _run_calculator(LineCalculator(DataHolder(thetas=thetas, S_thetas=S_thetas)))
+    result = _run_calculator(VectorizedLineCalculator(DataHolder(thetas=thetas, S_thetas=S_thetas)))
+
+    for attr in ["points", "u_points", "all_lines_params", "u_all_lines_params", "intersection_points", "u_intersection_points", "source", "u_source"]:
+        assert np.allclose(getattr(result, attr), getattr(expected, attr)), attr
+
+def test_vectorized_all_intersection_points():
+    dataholder = DataHolder()
+    calculator = VectorizedLineCalculator(dataholder)
+    calculator.dataholder.all_lines_params = [(0,1), (-2, 2), (2,-2), (0.1, 0)]
+    calculator.find_all_intersection_points()
+    assert np.allclose(calculator.dataholder.intersection_points, [(0.5, 1), (1.5, 1), (1, 0), (2/2.1, 0.2/2.1), (2/1.9, 0.2/1.9)])
+    assert np.array_equal(calculator.pair_indices, [(0, 1), (0, 2), (1, 2), (1, 3), (2, 3)])
+
+def test_propagator_matches_composed_function():
+    calculator = LineCalculator(DataHolder())
+    propagator = UncertaintyPropagator()
+    k1, b1, k2, b2 = np.array([1.0, 0.5, -2.0]), np.array([0.0, 1.0, 3.0]), np.array([-1.0, 2.0, 0.3]), np.array([2.0, -1.0, 0.0])
+    u_k1, u_b1, u_k2, u_b2 = 0.01, 0.1, np.array([0.02, 0.03, 0.04]), 0.2
+    u_x = propagator.propagate("intersection_x", (k1, b1, k2, b2), (u_k1, u_b1, u_k2, u_b2))
+    expected = [calculator.find_uncertainty_of_composed_function(lambda k1, b1, k2, b2: (b2-b1)/(k1-k2),
+                                                                 {"k1": k1[i], "b1": b1[i], "k2": k2[i], "b2": b2[i]},
+                                                                 {"k1": u_k1, "b1": u_b1, "k2": u_k2[i], "b2": u_b2})
+                for i in range(3)]
+    assert np.allclose(u_x, expected)
+    assert propagator.jacobian("intersection_x") is UncertaintyPropagator().jacobian("intersection_x")
+
+def test_least_squares_source_of_concurrent_lines():
+    dataholder = DataHolder()
+    dataholder.all_lines_params = [(1, 1), (-1, 3), (0.5, 1.5), (3, -1)]
+    dataholder.u_all_lines_params = [(0.01, 0.1), (0.02, 0.1), (0.01, 0.2), (0.05, 0.3)]
+    source = LeastSquaresEstimator(dataholder).find_source(find_u=True)
+    assert np.allclose(source, (1, 2))
+    assert dataholder.cov_source is not None
+    assert np.allclose(np.sqrt(np.diag(dataholder.cov_source)), dataholder.u_source)
+
+    # singularity is judged independently of the scale of the weights
+    estimator = LeastSquaresEstimator(dataholder)
+    tiny = estimator.line_statistics(dataholder.all_lines_params, weights=np.full(4, 1e-12))
+    assert np.allclose(estimator.solve(tiny)[0], (1, 2))
+    parallel = estimator.line_statistics([(1, 0), (1, 1), (1 + 1e-9, 2)], weights=np.full(3, 1e12))
+    with pytest.raises(ValueError):
+        estimator.solve(parallel)
+
+def test_least_squares_statistics_are_additive():
+    estimator = LeastSquaresEstimator(DataHolder())
+    rng = np.random.default_rng(0)
+    lines = np.column_stack((rng.normal(size=50), rng.normal(size=50)))
+    u_lines = np.abs(rng.normal(0.1, 0.01, size=(50, 2)))
+    total = estimator.line_statistics(lines, u_lines)
+    chunked = estimator.line_statistics(lines[:20], u_lines[:20]) + estimator.line_statistics(lines[20:], u_lines[20:])
+    assert np.allclose(total, chunked)
+
+def test_least_squares_close_to_mean_of_intersections():
+    thetas = [(180, 14.10), (160, -0.17), (200, 28.15)]
+    S_thetas = [(0, 0.16), (0, 0.13), (0, 0.11)]
+    dataholder = _run_calculator(VectorizedLineCalculator(DataHolder(thetas=thetas, S_thetas=S_thetas)))
+    mean_of_intersections = dataholder.source
+    source = LeastSquaresEstimator(dataholder).find_source(find_u=True)
+    assert np.allclose(source, mean_of_intersections, atol=0.5)
+
+def test_streaming_localizer_matches_batch_least_squares():
+    thetas = [(180, 14.6), (160, -0.3), (140, -16.26), (220, 44.45), (120, -35.24)]
+    S_thetas = [(0, 0.21), (0, 0.18), (0, 0.17), (0, 1.7), (0, 0.09)]
+    dataholder = _run_calculator(VectorizedLineCalculator(DataHolder(thetas=thetas, S_thetas=S_thetas)))
+    expected = LeastSquaresEstimator(dataholder).find_source(find_u=True)
+
+    streaming_dataholder = DataHolder()
+    localizer = StreamingLocalizer(streaming_dataholder)
+    assert localizer.add_lines(thetas[0], S_thetas[0]) is None
+    localizer.add_lines(thetas[1:3], S_thetas[1:3])
+    source = localizer.add_lines(thetas[3:], S_thetas[3:])
+    assert localizer.n_lines == 5
+    assert np.allclose(source, expected)
+    assert np.allclose(streaming_dataholder.u_source, dataholder.u_source)
+    assert streaming_dataholder.points == []
+
+def test_k_lines_clustering_separates_two_sources():
+    rng = np.random.default_rng(1)
+    true_sources = np.array([(-2.0, 1.0), (3.0, -1.5)])
+    true_labels = rng.integers(0, 2, 200)
+    k = np.tan(rng.uniform(-1.3, 1.3, 200))
+    b = true_sources[true_labels, 1] - k*true_sources[true_labels, 0] + rng.normal(0, 0.05, 200)
+    dataholder = DataHolder()
+    dataholder.all_lines_params = list(zip(k, b))
+    sources = KLinesClustering(dataholder, n_sources=2, seed=0).find_sources()
+
+    order = np.argsort(np.array(sources)[:, 0])
+    assert np.allclose(np.array(sources)[order], true_sources, atol=0.1)
+    assert np.mean(order[dataholder.line_labels] == true_labels) > 0.95
+    # seeds are scored chunk by chunk, the chunk size doesn't change them
+    lines = np.column_stack((k, b))
+    assert np.array_equal(KLinesClustering(dataholder, seed=3, chunk_size=7).seed_sources(lines), KLinesClustering(dataholder, seed=3).seed_sources(lines))
+
+def _lines_of_response(sources, n_lines, R1 = 15, R2 = 11, seed = 0):
+    """Point pairs on circles R1 and R2 of lines going through randomly chosen sources in random directions"""
+    rng = np.random.default_rng(seed)
+    sources = np.asarray(sources, dtype=float)[rng.integers(0, len(sources), n_lines)]
+    phi = rng.uniform(0, np.pi, n_lines)
+    directions = np.column_stack((np.cos(phi), np.sin(phi)))
+    projection = np.sum(sources*directions, axis=1)
+    def hit(r, sign):
+        t = -projection + sign*np.sqrt(projection**2 - np.sum(sources**2, axis=1) + r**2)
+        return sources + t[:, None]*directions
+    return np.stack((hit(R1, 1), hit(R2, -1)), axis=1)
+
+def test_backprojection_finds_two_peaks():
+    dataholder = DataHolder()
+    dataholder.points = _lines_of_response([(2, -1), (-3, 2)], 5000)
+    reconstructor = BackprojectionReconstructor(dataholder, n_bins=44, chunk_size=1000)
+    image = reconstructor.reconstruct(n_iterations=2)
+    assert image.shape == (44, 44)
+    assert dataholder.image is image
+    peaks = sorted(reconstructor.find_peaks(n_peaks=2))
+    assert np.allclose(peaks, [(-3, 2), (2, -1)], atol=0.5)
+
+def test_scan_fitter_single_and_double_peaks(tmp_path):
+    rng = np.random.default_rng(0)
+    angles = np.arange(-40, 40.5, 1.0)
+    rows = []
+    for theta1, params in [(180, (5, 400, 14.6, 4)), (160, (5, 300, -7.2, 4, 150, 10.0, 3.5))]:
+        counts = rng.poisson(gaussians(angles, *params))
+        rows.extend((theta1, angle, count) for angle, count in zip(angles, counts))
+    path = tmp_path / "scans.csv"
+    np.savetxt(path, rows, delimiter=",", header="theta1,theta2,counts", comments="")
+
+    fitter = ScanFitter(n_workers=1)
+    scans = fitter.load_scans(str(path))
+    assert [scan.theta1 for scan in scans] == [160, 180]
+    fits = fitter.fit(scans)
+    assert len(fits[0].centers) == 2 and len(fits[1].centers) == 1
+    assert np.allclose(fits[0].centers, [-7.2, 10.0], atol=0.5)
+
+    dataholder = fitter.fill_dataholder(DataHolder(), fits, peak="stronger")
+    assert np.allclose(dataholder.thetas, [(160, -7.2), (180, 14.6)], atol=0.5)
+    assert all(0 < S_theta2 < 1 for _, S_theta2 in dataholder.S_thetas)
+    weaker_thetas, _ = fitter.to_thetas(fits, peak="weaker")
+    # the single-peak scan has no weaker peak, so it doesn't repeat the stronger source
+    assert len(weaker_thetas) == 1 and weaker_thetas[0][0] == 160 and np.isclose(weaker_thetas[0][1], 10.0, atol=0.5)
+
+def test_simulator_is_seeded_and_recovers_source():
+    first = CoincidenceSimulator(DataHolder(), sources=[(1.5, -2.0)], seed=42).simulate(1000)
+    second = CoincidenceSimulator(DataHolder(), sources=[(1.5, -2.0)], seed=42).simulate(1000)
+    assert all(np.array_equal(a, b) for a, b in zip(first, second))
+
+    dataholder = DataHolder()
+    thetas, S_thetas, labels = CoincidenceSimulator(dataholder, sources=[(1.5, -2.0)], seed=0).simulate(20000)
+    assert thetas.shape == S_thetas.shape == (20000, 2)
+    assert np.all(labels == 0)
+    source = StreamingLocalizer(dataholder).add_lines(thetas, S_thetas)
+    assert np.allclose(source, (1.5, -2.0), atol=0.1)
+
+def test_simulator_activities_and_background():
+    simulator = CoincidenceSimulator(DataHolder(), sources=[(1, 1), (-2, 0)], activities=[3, 1], background_fraction=0.1, seed=0, chunk_size=3000)
+    _, _, labels = simulator.simulate(10000)
+    assert np.isclose(np.mean(labels == -1), 0.1, atol=0.02)
+    assert np.isclose(np.sum(labels == 0)/np.sum(labels >= 0), 0.75, atol=0.02)
+
+def test_benchmark_compare_flags_regressions():
+    from PET_radioactive_source_localization.testing.benchmarks import compare
+    baseline = [{"n": 10, "find_u": True, "stage": "find_points", "calculator": "vectorized", "seconds": 0.1},
+                {"n": 10, "find_u": True, "stage": "find_source", "calculator": "vectorized", "seconds": 0.1}]
+    results = [{"n": 10, "find_u": True, "stage": "find_points", "calculator": "vectorized", "seconds": 0.12},
+               {"n": 10, "find_u": True, "stage": "find_source", "calculator": "vectorized", "seconds": 0.3},
+               {"n": 10, "find_u": True, "stage": "plotting", "calculator": "vectorized", "skipped": True}]
+    regressions = compare(results, baseline, tolerance=0.5)
+    assert len(regressions) == 1 and regressions[0].startswith("find_source")
+
+def test_batch_runner_collects_results_and_failures(tmp_path):
+    from PET_radioactive_source_localization.batch import run_batch
+    (tmp_path / "images").mkdir()
+    manifest = {"datasets": [
+        {"filename": "single_source", "lab_data": "single_source", "thetas": "thetas", "S_thetas": "S_thetas", "output_dir": str(tmp_path)},
+        {"filename": "inline", "thetas": [[180, 14.6], [160, -0.3], [140, -16.26]], "output_dir": str(tmp_path), "save_plot": False, "estimator": "least_squares"},
+        {"filename": "broken", "thetas": [], "output_dir": str(tmp_path)},
+    ]}
+    manifest_path = tmp_path / "manifest.json"
+    manifest_path.write_text(json.dumps(manifest))
+    summary_path = tmp_path / "summary.json"
+
+    results = run_batch(str(manifest_path), summary_path=str(summary_path), n_workers=2)
+    assert [result["status"] for result in results] == ["ok", "ok", "failed"]
+    assert (tmp_path / "images" / "single_source.png").exists()
+    assert (tmp_path / "inline.json").exists()
+    summary = json.loads(summary_path.read_text())
+    assert summary["n_failed"] == 1 and len(summary["results"]) == 3
+
+def test_plotter_draws_lines_in_one_collection():
+    dataholder = _run_calculator(VectorizedLineCalculator(DataHolder(thetas=[(180, 14.6), (160, -0.3), (140, -16.26), (220, 44.45)])))
+    plotter = Plotter(dataholder)
+    pet = PET(dataholder, VectorizedLineCalculator(dataholder), plotter)
+    segments = pet.line_segments(scale=5)
+    assert segments.shape == (4, 2, 2)
+    plotter.add_lines(segments)
+    assert len(plotter.ax.collections) == 1
+    assert len(dataholder.all_x) == 8
+    assert np.isclose(plotter.ax.get_xlim()[0], segments[..., 0].min() - 0.1*np.ptp(segments[..., 0]))
+
+    plotter.highlight_intersection_points(density=True)
+    assert len(plotter.ax.collections) == 2
+
+def test_result_writer_formats_round_trip(tmp_path):
+    dataholder = DataHolder(source=(1.234, -0.567), u_source=(0.1, 0.2),
+                            intersection_points=[(1.0, 2.0), (3.456, 4.0)], u_intersection_points=[(0.1, 0.1), (0.2, 0.3)])
+    writer = ResultWriter(dataholder)
+    attrs = ["source", "intersection_points", "u_source", "u_intersection_points"]
+    with open(writer.write(str(tmp_path / "run"), attrs)) as f:
+        data = json.load(f)
+    assert list(data) == attrs
+    assert data["source"] == [1.23, -0.57] and data["intersection_points"][1] == [3.46, 4.0]
+
+    for output_format in ("npz", "npy"):
+        loaded = ResultWriter.load(writer.write(str(tmp_path / output_format), attrs, output_format=output_format))
+        assert loaded["source"] == [1.23, -0.57]
+        assert np.array_equal(loaded["intersection_points"], np.array(dataholder.intersection_points))
+        assert loaded["shapes"]["u_intersection_points"] == [2, 2]
+
+    # saving the source alone keeps intersection points already in the file
+    dataholder.source = (0.0, 0.0)
+    writer.write(str(tmp_path / "run"), ["source"], merge=True)
+    data = ResultWriter.load(str(tmp_path / "run.json"))
+    assert data["source"] == [0.0, 0.0] and data["intersection_points"][0] == [1.0, 2.0]
+    for output_format in ("npz", "npy"):
+        writer.write(str(tmp_path / f'merged_{output_format}'), ["source", "u_source"], output_format=output_format)
+        loaded = ResultWriter.load(writer.write(str(tmp_path / f'merged_{output_format}'), ["intersection_points"], output_format=output_format, merge=True))
+        assert loaded["source"] == [0.0, 0.0] and loaded["u_source"] == [0.1, 0.2]
+        assert np.array_equal(loaded["intersection_points"], np.array(dataholder.intersection_points))
+        writer.write(str(tmp_path / f'merged_{output_format}'), ["u_intersection_points"], output_format=output_format, merge=True)
+        loaded = ResultWriter.load(str(tmp_path / f'merged_{output_format}.json'))
+        assert set(loaded["shapes"]) == {"intersection_points", "u_intersection_points"} and "intersection_points" in loaded
+    assert "intersection_points" not in ResultWriter.load(writer.write(str(tmp_path / "run"), ["source"], output_format="npz", merge=True))
+
+@pytest.mark.parametrize("extension", ["csv", "npy", "bin"])
+def test_event_loader_chunks_and_localizes(tmp_path, extension):
+    thetas, S_thetas, _ = CoincidenceSimulator(DataHolder(), sources=[(1.0, -1.0)], angular_smearing=0.5, seed=3).simulate(2_500)
+    path = str(tmp_path / f"events.{extension}")
+    EventLoader.write(path, thetas, S_thetas)
+    loader = EventLoader(path)
+    assert loader.n_events == 2_500
+    assert [len(chunk) for chunk, _ in loader.chunks(1_000)] == [1_000, 1_000, 500]
+
+    loaded_thetas, loaded_S_thetas = loader.load()
+    assert np.allclose(loaded_thetas, thetas) and np.allclose(loaded_S_thetas, S_thetas) #type: ignore
+
+    source = loader.localize(DataHolder(), chunk_size=1_000)
+    expected = StreamingLocalizer(DataHolder()).add_lines(thetas, S_thetas)
+    assert np.allclose(source, expected) #type: ignore
+    assert np.allclose(source, (1.0, -1.0), atol=0.3) #type: ignore
+
+def test_column_reads_like_a_list_of_tuples():
+    column = Column((2,), [(1.0, 2.0), (3.0, 4.0)])
+    assert len(column) == 2 and column[1] == (3.0, 4.0) and column[-2:] == [(1.0, 2.0), (3.0, 4.0)]
+    assert column == [(1.0, 2.0), (3.0, 4.0)] and list(column) == column.tolist()
+    column.append((5.0, 6.0))
+    column.extend(np.ones((20, 2)))
+    assert len(column) == 23 and column.capacity >= 23
+    assert np.asarray(column).shape == (23, 2) and not np.asarray(column).flags.writeable
+
+    # an assigned array is shared until the column is written to
+    arr = np.zeros((3, 2, 2))
+    pairs = Column((2, 2), arr)
+    assert np.shares_memory(np.asarray(pairs), arr)
+    pairs.clear()
+    pairs.append(np.ones((2, 2)))
+    assert pairs[0] == ((1.0, 1.0), (1.0, 1.0)) and not arr.any()
+
+@pytest.mark.parametrize("calculator_class", [LineCalculator, VectorizedLineCalculator])
+def test_columnar_dataholder_matches_dataholder(tmp_path, calculator_class):
+    thetas = [(180, 14.6), (160, -0.3), (140, -16.26), (220, 44.45), (200, 35.0)]
+    S_thetas = [(0.0, 0.3)]*len(thetas)
+    results = []
+    for holder_class in (DataHolder, ColumnarDataHolder):
+        dataholder = holder_class(thetas=thetas, S_thetas=S_thetas)
+        _run_calculator(calculator_class(dataholder))
+        PET(dataholder, calculator_class(dataholder), Plotter(dataholder)).save("both", output_dir=str(tmp_path), filename_with_ext=f"{holder_class.__name__}.json")
+        results.append(dataholder)
+    dataholder, columnar = results
+    assert isinstance(columnar.points, Column) and np.asarray(columnar.points).shape == (5, 2, 2)
+    for attr_name in ("points", "u_points", "all_lines_params", "u_all_lines_params", "intersection_points", "u_intersection_points"):
+        assert getattr(columnar, attr_name) == getattr(dataholder, attr_name)
+    assert columnar.source == dataholder.source and columnar.u_source == dataholder.u_source
+    assert (tmp_path / "DataHolder.json").read_text() == (tmp_path / "ColumnarDataHolder.json").read_text()
+
+def test_run_records_stage_metrics(tmp_path):
+    matplotlib = pytest.importorskip("matplotlib")
+    matplotlib.use("Agg")
+    dataholder = DataHolder(thetas=[(180, 14.6), (160, -0.3), (140, -16.26), (220, 44.45), (200, 35.0)])
+    pet = PET(dataholder, VectorizedLineCalculator(dataholder), Plotter(dataholder))
+    pet.run("metrics", output_dir=str(tmp_path), save_plot=False, show_plot=False, k_epsilon=0.2, capture="cprofile", uncertainty="monte_carlo")
+    metrics = pet.metrics
+    assert isinstance(metrics, RunMetrics)
+    assert list(metrics.stages) == ["find_theta_uncertainities", "find_points", "find_line_params", "find_all_intersection_points", "find_source", "monte_carlo_uncertainty", "plotting", "save"]
+    assert metrics.n_lines == 5 and metrics.n_pairs == 10
+    assert metrics.n_accepted_pairs == len(dataholder.intersection_points) and metrics.n_accepted_pairs + metrics.n_rejected_pairs == 10
+    assert metrics.profile and "cumulative" in metrics.profile
+    assert json.loads(json.dumps(metrics.to_dict()))["total_seconds"] == metrics.total_seconds
+
+    with pytest.raises(ValueError):
+        pet.run("metrics", output_dir=str(tmp_path), save_plot=False, show_plot=False, estimator="mode", uncertainty="monte_carlo")
+    assert pet.metrics is metrics # rejected before the pipeline started
+
+    # sharded runs count pairs without keeping intersection points, least squares intersects none
+    pet.run("metrics", output_dir=str(tmp_path), save_plot=False, show_plot=False, estimator="sharded")
+    assert pet.metrics.n_pairs == 10 and pet.metrics.n_accepted_pairs == metrics.n_accepted_pairs and pet.metrics.n_rejected_pairs == metrics.n_rejected_pairs
+    pet.run("metrics", output_dir=str(tmp_path), save_plot=False, show_plot=False, estimator="least_squares")
+    assert pet.metrics.n_pairs is None and pet.metrics.n_accepted_pairs is None and "no pairs intersected" in pet.metrics.summary()
+
+    metrics = RunMetrics(capture="tracemalloc")
+    metrics.start()
+    with metrics.stage("allocate"):
+        np.ones(1_000_000)
+    metrics.stop()
+    assert metrics.stages["allocate"]["peak_bytes"] >= 8_000_000
+
+def test_result_cache_reuses_unchanged_stages(tmp_path):
+    matplotlib = pytest.importorskip("matplotlib")
+    matplotlib.use("Agg")
+    thetas = [(180, 14.6), (160, -0.3), (140, -16.26), (220, 44.45), (200, 35.0)]
+    cache = ResultCache(str(tmp_path / "cache"))
+
+    def run(k_epsilon, calculator_class=VectorizedLineCalculator, fail=()):
+        dataholder = DataHolder(thetas=thetas)
+        calculator = calculator_class(dataholder)
+        for method in fail:
+            setattr(calculator, method, lambda *args, **kwargs: pytest.fail(f'{method} should have been cached'))
+        pet = PET(dataholder, calculator, Plotter(dataholder), cache=cache)
+        pet.run("cached", output_dir=str(tmp_path), save_plot=False, show_plot=False, k_epsilon=k_epsilon)
+        return dataholder
+
+    first = run(0.2)
+    # a rerun with other plotting options reuses everything, a new k_epsilon only recomputes intersections
+    again = run(0.2, fail=("find_points", "find_line_params", "find_all_intersection_points", "find_source"))
+    assert again.source == first.source and again.intersection_points == first.intersection_points
+    assert again.points == first.points and again.u_all_lines_params == first.u_all_lines_params
+    stricter = run(1.0, fail=("find_points", "find_line_params"))
+    assert len(stricter.intersection_points) < len(first.intersection_points)
+    assert run(0.2, calculator_class=LineCalculator).source == pytest.approx(first.source)
+
+    # lines found from a detector geometry depend on it and on the detector IDs of the events
+    dataholder = DataHolder(thetas=thetas)
+    keys = {cache.lines_key(dataholder, "VectorizedLineCalculator"), cache.lines_key(dataholder, "VectorizedLineCalculator", DetectorGeometry.from_dataholder(dataholder))}
+    shifted = DetectorGeometry.from_dataholder(DataHolder(thetas=thetas, R1=16))
+    keys |= {cache.lines_key(dataholder, "VectorizedLineCalculator", shifted), cache.lines_key(DataHolder(thetas=thetas, detector_ids=[(0, 5)]*5), "VectorizedLineCalculator")}
+    assert len(keys) == 4
+    assert cache.lines_key(dataholder, "VectorizedLineCalculator", shifted) == cache.lines_key(dataholder, "VectorizedLineCalculator", DetectorGeometry.from_dataholder(DataHolder(thetas=thetas, R1=16)))
+
+    # counts of a sharded run are cached with its source
+    sharded_runs = []
+    for _ in range(2):
+        dataholder = DataHolder(thetas=thetas)
+        pet = PET(dataholder, VectorizedLineCalculator(dataholder), Plotter(dataholder), cache=cache)
+        pet.run("cached", output_dir=str(tmp_path), save_plot=False, show_plot=False, estimator="sharded")
+        sharded_runs.append(pet.metrics)
+    assert "cached_sharded" in sharded_runs[1].stages and "find_source" not in sharded_runs[1].stages
+    assert sharded_runs[1].n_accepted_pairs == sharded_runs[0].n_accepted_pairs == len(first.intersection_points)
+
+    # least recently used entries are evicted first
+    cache.clear()
+    keys = [cache.key("test", i=i) for i in range(3)]
+    for age, key in zip((30, 20), keys):
+        cache.put(key, {"x": np.zeros(100)})
+        os.utime(cache._path(key), (time.time()-age, time.time()-age))
+    cache.max_bytes = 2*os.path.getsize(cache._path(keys[0]))
+    assert cache.get(keys[0]) is not None
+    cache.put(keys[2], {"x": np.ones(100)})
+    assert cache.get(keys[1]) is None and cache.get(keys[0]) is not None and cache.get(keys[2]) is not None
+
+def test_k_epsilon_sweep_matches_separate_runs():
+    thetas, S_thetas, _ = CoincidenceSimulator(DataHolder(), sources=[(1.0, -1.0)], seed=5).simulate(60)
+    dataholder = DataHolder(thetas=thetas.tolist(), S_thetas=S_thetas.tolist())
+    calculator = VectorizedLineCalculator(dataholder)
+    _run_calculator(calculator)
+    thresholds = [0.0, 0.2, 0.4, 1.0, 1e6]
+    sweep = calculator.sweep_k_epsilon(thresholds)
+    assert isinstance(sweep, KEpsilonSweep)
+    for k_epsilon, n_pairs, source, u_source in zip(thresholds[:-1], sweep.n_pairs, sweep.sources, sweep.u_sources): #type: ignore
+        calculator.find_all_intersection_points(k_epsilon=k_epsilon, find_u=True)
+        assert n_pairs == len(dataholder.intersection_points)
+        assert np.allclose(source, calculator.find_source(find_u=True))
+        assert np.allclose(u_source, dataholder.u_source)
+    assert sweep.n_pairs[-1] == 0 and np.all(np.isnan(sweep.sources[-1]))
+    assert sweep.best_k_epsilon in thresholds[:-1]
+
+    default = calculator.sweep_k_epsilon()
+    assert len(default.thresholds) == 1000 and np.all(np.diff(default.n_pairs) <= 0)
+
+def test_monte_carlo_uncertainty_matches_perturbed_pipeline():
+    thetas = [(180, 14.6), (160, -0.3), (140, -16.26), (220, 44.45), (200, 35.0), (120, -35.24)]
+    dataholder = DataHolder(thetas=thetas, U_thetas=0.05, u_R1=0.0, u_R2=0.0)
+    _run_calculator(VectorizedLineCalculator(dataholder))
+    LeastSquaresEstimator(dataholder).find_source(find_u=True)
+    linear_u = np.array(dataholder.u_source)
+
+    # the batched kernel must agree with rerunning the calculator and the estimator on perturbed angles
+    rng = np.random.default_rng(1)
+    pipeline_sources = []
+    for _ in range(500):
+        replicate = DataHolder(thetas=[tuple(pair) for pair in (np.array(thetas) + rng.normal(0, 0.05, (len(thetas), 2))).tolist()],
+                               U_thetas=0.05, u_R1=0.0, u_R2=0.0)
+        _run_calculator(VectorizedLineCalculator(replicate))
+        pipeline_sources.append(LeastSquaresEstimator(replicate).find_source())
+    pipeline_u = np.std(pipeline_sources, axis=0, ddof=1)
+
+    monte_carlo = MonteCarloUncertainty(dataholder, n_replicates=20_000, estimator="least_squares", seed=0)
+    result = monte_carlo.find_uncertainty(confidence=0.9)
+    assert np.allclose(result.mean, dataholder.source, atol=0.01)
+    assert np.allclose(result.u_source, pipeline_u, rtol=0.15)
+    # weights keep the correlation of k and b, so the linear covariance of the estimator is calibrated
+    assert np.allclose(linear_u, result.u_source, rtol=0.05)
+    assert np.all(result.intervals[:, 0] < result.mean) and np.all(result.mean < result.intervals[:, 1])
+    assert result.semi_axes[0] >= result.semi_axes[1] and -90 <= result.angle < 90
+    assert dataholder.u_source == pytest.approx(tuple(result.u_source))
+
+    # replicates are seeded per task, so the process pool gives the same numbers
+    serial = MonteCarloUncertainty(dataholder, n_replicates=3000, k_epsilon=0.2, seed=1, task_size=1000, n_workers=1).simulate()
+    parallel = MonteCarloUncertainty(dataholder, n_replicates=3000, k_epsilon=0.2, seed=1, task_size=1000, n_workers=2).simulate()
+    assert np.array_equal(serial, parallel)
+
+    # least squares replicates never form the O(n^2) pairs
+    many = DataHolder(thetas=[tuple(pair) for pair in np.random.default_rng(0).uniform(0, 360, (20_000, 2)).tolist()])
+    tracemalloc.start()
+    MonteCarloUncertainty(many, n_replicates=4, estimator="least_squares", seed=0, n_workers=1).simulate()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    assert peak < 100_000_000
+
+def test_mode_seeker_ignores_outliers_and_finds_several_sources():
+    rng = np.random.default_rng(0)
+    cluster = rng.normal((1.0, -1.0), 0.05, (500, 2))
+    outliers = rng.uniform(-50, 50, (100, 2))
+    dataholder = DataHolder(intersection_points=[tuple(point) for point in np.vstack((cluster, outliers)).tolist()],
+                            u_intersection_points=[(0.05, 0.05)]*600)
+    source = ModeSeeker(dataholder).find_source(find_u=True)
+    assert np.allclose(source, (1.0, -1.0), atol=0.02)
+    assert np.linalg.norm(np.mean(dataholder.intersection_points, axis=0) - (1.0, -1.0)) > 0.1
+    assert len(dataholder.u_source) == 2
+
+    # a point's weight is 1/u^2, so a precise cluster beats a larger but vaguer one
+    points = np.vstack((rng.normal((2.0, 0.0), 0.05, (300, 2)), rng.normal((-3.0, 2.0), 0.05, (200, 2))))
+    u_points = np.vstack((np.full((300, 2), 0.3), np.full((200, 2), 0.1)))
+    modes, densities, _ = ModeSeeker(DataHolder(), bandwidth=0.3).find_modes(points, u_points)
+    assert np.allclose(modes[0], (-3.0, 2.0), atol=0.05) and np.allclose(modes[1], (2.0, 0.0), atol=0.05)
+    assert densities[0] > densities[1]
+
+    sources = ModeSeeker(DataHolder(intersection_points=[tuple(point) for point in points.tolist()]), bandwidth=0.3).find_sources(n_sources=2)
+    assert np.allclose(sorted(sources), [(-3.0, 2.0), (2.0, 0.0)], atol=0.05)
+
+def test_detector_geometry_matches_trigonometry():
+    thetas = [(180, 14.6), (160, -0.3), (140, -16.26), (220, 44.45), (200, 35.0), (180, 0.0)]
+    dataholder = DataHolder(thetas=thetas, S_thetas=[(0.1, 0.2)]*len(thetas), U_thetas=0.05, R1=15, R2=11, u_R1=0.01, u_R2=0.02)
+    calculator = VectorizedLineCalculator(dataholder)
+    calculator.find_theta_uncertainities()
+    calculator.find_points(find_u=True)
+    points, u_points = np.array(dataholder.points), np.array(dataholder.u_points)
+
+    geometry = DetectorGeometry.from_dataholder(dataholder)
+    assert geometry.n_detectors == 5 + 6
+    looked_up = DataHolder(thetas=thetas, S_thetas=dataholder.S_thetas, U_thetas=0.05, R1=15, R2=11, u_R1=0.01, u_R2=0.02)
+    VectorizedLineCalculator(looked_up, geometry=geometry).find_points(find_u=True)
+    assert np.allclose(looked_up.points, points) and np.allclose(looked_up.u_points, u_points)
+
+    # events given as detector IDs need no angles at all
+    by_ids = DataHolder(detector_ids=[tuple(ids) for ids in geometry.ids_of(thetas).tolist()], S_thetas=dataholder.S_thetas)
+    VectorizedLineCalculator(by_ids, geometry=geometry).find_points(find_u=True)
+    assert np.allclose(by_ids.points, points) and np.allclose(by_ids.u_points, u_points)
+
+    # at angles 180 and 0 the x uncertainties are purely radial: u_R1 for detector 1 and u_R2 for detector 2
+    assert np.allclose(u_points[-1, :, 0], (0.01, 0.02))
+    with pytest.raises(ValueError):
+        geometry.ids_of([(181, 14.6)])
+
+def test_sharded_intersector_matches_find_source():
+    thetas, _, _ = CoincidenceSimulator(DataHolder(), sources=[(1.0, -2.0)], seed=0).simulate(60)
+    dataholder = DataHolder(thetas=[tuple(pair) for pair in thetas.tolist()], U_thetas=0.1)
+    _run_calculator(VectorizedLineCalculator(dataholder))
+    n_lines = len(dataholder.all_lines_params)
+
+    sharded = DataHolder(all_lines_params=dataholder.all_lines_params, u_all_lines_params=dataholder.u_all_lines_params)
+    intersector = ShardedIntersector(sharded, tile_size=7, n_workers=1, n_bins=10)
+    assert sum((i_stop-i_start)*(j_stop-j_start) for i_start, i_stop, j_start, j_stop in intersector.tiles(n_lines)) >= n_lines*(n_lines-1)//2
+    intersector.find_source(find_u=True)
+    assert np.allclose(sharded.source, dataholder.source) and np.allclose(sharded.u_source, dataholder.u_source)
+    assert intersector.sums.n_pairs == n_lines*(n_lines-1)//2
+    assert intersector.sums.n_accepted == len(dataholder.intersection_points)
+    assert len(sharded.intersection_points) == 0
+
+    # workers read the lines from shared memory and return only their sums
+    parallel = ShardedIntersector(sharded, tile_size=7, n_workers=2, n_bins=10).reduce(dataholder.all_lines_params, dataholder.u_all_lines_params)
+    assert np.allclose(parallel.source, dataholder.source) and np.allclose(parallel.u_source, dataholder.u_source)
+    assert np.array_equal(parallel.histogram, intersector.sums.histogram)
+
+def test_live_service_with_fake_daq_client(tmp_path):
+    thetas, S_thetas, _ = CoincidenceSimulator(DataHolder(), sources=[(1.5, -2.0)], seed=3).simulate(300)
+    expected = StreamingLocalizer(DataHolder()).add_lines(thetas, S_thetas)
+
+    async def fake_daq() -> list:
+        service = LiveService()
+        await service.start(port=0)
+        host, port = service.address
+        reader, writer = await asyncio.open_connection(host, port)
+        async def request(message: object) -> dict:
+            writer.write(json.dumps(message).encode() + b"\n")
+            await writer.drain()
+            return json.loads(await reader.readline())
+        responses = [await request({"type": "query"})]
+        for start in range(0, len(thetas), 100):
+            responses.append(await request({"type": "events", "thetas": thetas[start:start+100].tolist(), "S_thetas": S_thetas[start:start+100].tolist()}))
+        responses.append(await request({"type": "nonsense"}))
+        responses.append(await request([1, 2])) # valid JSON that is no object, the connection must stay usable
+        responses.append(await request(3))
+        responses.append(await request({"type": "query"}))
+        responses.append(await request({"type": "plot", "filepath": str(tmp_path / "live.png")}))
+        writer.close()
+        await service.close()
+        return responses
+
+    responses = asyncio.run(fake_daq())
+    assert responses[0]["source"] is None and responses[0]["n_lines"] == 0
+    assert [response["n_lines"] for response in responses[1:4]] == [100, 200, 300]
+    assert [response["type"] for response in responses[4:7]] == ["error"]*3
+    assert responses[7]["n_lines"] == 300 and responses[7]["source"] == pytest.approx(expected)
+    assert os.path.exists(responses[8]["filepath"])
+
+def test_calculator_path_imports_only_numpy():
+    from PET_radioactive_source_localization.testing.benchmarks import import_time
+    assert import_time("import PET_radioactive_source_localization.implementations", repeat=1)["modules"] == []
+    # a plotter that never draws doesn't create a figure, so the pipeline classes load no plotting either
+    statement = ("from PET_radioactive_source_localization.implementations import DataHolder, LeastSquaresEstimator, Plotter, VectorizedLineCalculator\n"
+                 "dataholder = DataHolder(thetas=[(180, 14.6), (160, -0.3), (140, -16.26)])\n"
+                 "plotter = Plotter(dataholder)\n"
+                 "calculator = VectorizedLineCalculator(dataholder)\n"
+                 "calculator.find_points()\n"
+                 "calculator.find_line_params()\n"
+                 "LeastSquaresEstimator(dataholder).find_source()")
+    assert import_time(statement, repeat=1)["modules"] == []
+    assert "autograd" in import_time(statement.replace("find_points()", "find_theta_uncertainities(); calculator.find_points(find_u=True)"), repeat=1)["modules"]
+
+def test_sinogram_bins_act_like_repeated_events():
+    thetas, S_thetas, _ = CoincidenceSimulator(DataHolder(), sources=[(1.5, -2.0)], seed=4).simulate(40)
+    repeated = DataHolder(thetas=[tuple(pair) for pair in np.repeat(thetas, 3, axis=0).tolist()], S_thetas=[tuple(pair) for pair in np.repeat(S_thetas, 3, axis=0).tolist()])
+    _run_calculator(VectorizedLineCalculator(repeated))
+    least_squares = DataHolder(all_lines_params=repeated.all_lines_params, u_all_lines_params=repeated.u_all_lines_params)
+    LeastSquaresEstimator(least_squares).find_source(find_u=True)
+
+    binned = DataHolder(thetas=repeated.thetas, S_thetas=repeated.S_thetas)
+    calculator = VectorizedLineCalculator(binned)
+    calculator.find_theta_uncertainities()
+    calculator.find_points(find_u=True)
+    calculator.find_line_params(find_u=True)
+    binner = SinogramBinner(binned, angle_width=1e-6, offset_width=1e-6)
+    assert binner.bin_lines() == 40 and binned.line_weights == [3.0]*40
+    # identical events share a bin, so weighted bins give the same estimates as the repeated events
+    LeastSquaresEstimator(binned).find_source(find_u=True)
+    assert np.allclose(binned.source, least_squares.source) and np.allclose(binned.u_source, least_squares.u_source)
+    calculator.find_all_intersection_points(find_u=True)
+    calculator.find_source(find_u=True)
+    assert np.allclose(binned.source, repeated.source) and np.allclose(binned.u_source, repeated.u_source)
+    sweep = calculator.sweep_k_epsilon([0.2])
+    assert np.allclose(sweep.sources[0], binned.source) and np.allclose(sweep.u_sources[0], binned.u_source)
+
+    # Monte Carlo replicates perturb single events, so binned lines need the weights of the unbinned ones
+    with pytest.raises(ValueError):
+        MonteCarloUncertainty(binned, n_replicates=100, estimator="least_squares").simulate()
+    event_weights = LeastSquaresEstimator(repeated).find_line_weights()
+    binned_replicates = MonteCarloUncertainty(binned, n_replicates=100, estimator="least_squares", seed=0, weights=event_weights).simulate()
+    assert np.array_equal(binned_replicates, MonteCarloUncertainty(repeated, n_replicates=100, estimator="least_squares", seed=0).simulate())
+
+def test_sinogram_binning_compresses_long_acquisitions():
+    thetas, S_thetas, _ = CoincidenceSimulator(DataHolder(), sources=[(1.5, -2.0)], seed=5).simulate(20_000)
+    thetas = np.round(thetas) # detectors 1 degree apart
+    dataholder = DataHolder(thetas=[tuple(pair) for pair in thetas.tolist()], S_thetas=[tuple(pair) for pair in S_thetas.tolist()], U_thetas=0.2, u_R1=0.05, u_R2=0.05)
+    calculator = VectorizedLineCalculator(dataholder)
+    calculator.find_theta_uncertainities()
+    calculator.find_points(find_u=True)
+    calculator.find_line_params(find_u=True)
+    exact = LeastSquaresEstimator(DataHolder(all_lines_params=dataholder.all_lines_params, u_all_lines_params=dataholder.u_all_lines_params)).find_source()
+
+    binner = SinogramBinner(dataholder)
+    n_bins = binner.bin_lines()
+    assert n_bins < len(thetas)/10 and sum(dataholder.line_weights) == len(thetas)
+    histogram, extent = binner.sinogram()
+    assert histogram.sum() == len(thetas) and 0 <= extent[0] < extent[1] <= 180 + binner.angle_width
+    LeastSquaresEstimator(dataholder).find_source(find_u=True)
+    assert np.hypot(*np.subtract(dataholder.source, exact)) < 0.05
+    assert np.hypot(*np.subtract(dataholder.source, (1.5, -2.0))) < 3*np.hypot(*dataholder.u_source) + 0.05
+
+def test_approximate_source_converges_to_exact_source():
+    thetas, S_thetas, _ = CoincidenceSimulator(DataHolder(), sources=[(2.0, -3.0)], seed=1).simulate(600)
+    dataholder = DataHolder(thetas=[tuple(pair) for pair in thetas.tolist()], S_thetas=[tuple(pair) for pair in S_thetas.tolist()])
+    calculator = VectorizedLineCalculator(dataholder)
+    _run_calculator(calculator)
+    calculator.find_source(find_u=True)
+    exact, u_exact = np.array(dataholder.source), np.array(dataholder.u_source)
+
+    errors = []
+    for n_pairs in (1_000, 10_000, 100_000):
+        result = calculator.find_source_approximate(n_pairs=n_pairs, find_u=True, seed=0)
+        assert result.n_sampled == n_pairs and not result.exact
+        assert np.all(np.abs(result.source - exact) < 4*result.sampling_error)
+        errors.append(np.hypot(*result.sampling_error))
+    assert errors[2] < errors[0]/3 # 1/sqrt(n_pairs), loosely because intersections of steep lines are heavy tailed in y
+    assert np.allclose(result.u_source, u_exact, rtol=0.5) # a few near-parallel pairs dominate, so u_source only roughly matches
+
+    refined = calculator.find_source_approximate(tol=0.005, round_size=1_000, seed=0)
+    assert refined.converged and np.hypot(*refined.sampling_error) < 0.005 and refined.n_rounds > 1
+    unreachable = calculator.find_source_approximate(tol=1e-9, round_size=20_000, max_pairs=60_000, seed=0)
+    assert not unreachable.converged and unreachable.n_sampled == 60_000 and unreachable.n_rounds == 3
+    assert calculator.find_source_approximate(memory_budget=100*calculator.bytes_per_sampled_pair, seed=0).n_sampled == 100
+    assert calculator.find_source_approximate(time_budget=0.05, round_size=1_000, seed=0).seconds < 1
+    # a budget covering every pair gives find_source itself
+    complete = calculator.find_source_approximate(n_pairs=600*599//2, find_u=True)
+    assert complete.exact and np.allclose(complete.source, exact) and np.allclose(complete.u_source, u_exact)
+
+def test_approximate_source_rejects_parallel_lines():
+    dataholder = DataHolder(all_lines_params=[(1.0, float(b)) for b in range(50)])
+    with pytest.raises(ValueError):
+        VectorizedLineCalculator(dataholder).find_source_approximate(tol=0.01, round_size=1000)
+    # rounds without an accepted pair don't end the sampling early
+    dataholder.all_lines_params[40:] = [(-1.0, 0.0)]*10
+    for seed in range(10):
+        result = VectorizedLineCalculator(dataholder).find_source_approximate(n_pairs=100, round_size=1, seed=seed)
+        assert result.n_sampled == 100 and result.n_rounds == 100 and result.n_accepted > 0